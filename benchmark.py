@@ -0,0 +1,269 @@
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+
+from btree import BTree
+from table import Index, Schema, Table
+
+# each workload builds its data untimed and returns a callable which does the
+# timed work and returns the number of operations it performed; tree workloads
+# run at every order, table workloads use the order which Index fixes
+
+
+def make_key(i, width):
+    # big-endian base 16 digits, so that keys sort in the order of i
+    key = []
+    for _ in range(width - 1):
+        i, digit = divmod(i, 16)
+        key.append(digit)
+
+    key.append(i)
+    return tuple(reversed(key))
+
+
+def make_tree(order, width, keys):
+    tree = BTree(order, (int,) * width)
+    for key in keys:
+        tree.insert(key)
+
+    return tree
+
+
+def random_keys(width, size, rng):
+    keys = [make_key(i, width) for i in range(size)]
+    rng.shuffle(keys)
+    return keys
+
+
+def insert_sequential(order, width, size, rng):
+    keys = [make_key(i, width) for i in range(size)]
+    return lambda: len(make_tree(order, width, keys))
+
+
+def insert_random(order, width, size, rng):
+    keys = random_keys(width, size, rng)
+    return lambda: len(make_tree(order, width, keys))
+
+
+def insert_descending(order, width, size, rng):
+    keys = [make_key(i, width) for i in reversed(range(size))]
+    return lambda: len(make_tree(order, width, keys))
+
+
+def lookup_point(order, width, size, rng):
+    tree = make_tree(order, width, random_keys(width, size, rng))
+
+    # half of the probes miss
+    probes = [make_key(rng.randrange(2 * size), width) for _ in range(size)]
+
+    def run():
+        for key in probes:
+            tree.contains(key)
+
+        return len(probes)
+
+    return run
+
+
+def scan_range(order, width, size, rng):
+    tree = make_tree(order, width, random_keys(width, size, rng))
+    starts = [rng.randrange(size) for _ in range(100)]
+
+    def run():
+        rows = 0
+        for start in starts:
+            bounds = slice(list(make_key(start, width)), list(make_key(start + 100, width)))
+            for _ in tree.select(bounds):
+                rows += 1
+
+        return rows
+
+    return run
+
+
+def scan_forward(order, width, size, rng):
+    tree = make_tree(order, width, random_keys(width, size, rng))
+    return lambda: sum(1 for _ in tree)
+
+
+def scan_reverse(order, width, size, rng):
+    tree = make_tree(order, width, random_keys(width, size, rng))
+    return lambda: sum(1 for _ in tree.select(slice(None), True))
+
+
+def delete_rebalance(order, width, size, rng):
+    keys = random_keys(width, size, rng)
+    deleted = keys[:size // 10]
+
+    def run():
+        tree = make_tree(order, width, keys)
+        for key in deleted:
+            del tree[list(key)]
+
+        tree.rebalance()
+        return len(deleted)
+
+    return run
+
+
+def make_table(width, size):
+    key = [("k{}".format(i), int) for i in range(width)]
+    table = Table(Index(Schema(key, [("group", int), ("value", int)])))
+    table.bulk_insert(make_key(i, width) + (i % 10, i) for i in range(size))
+    return table
+
+
+def table_auxiliary(order, width, size, rng):
+    keys = random_keys(width, size, rng)
+
+    def run():
+        table = make_table(width, 0)
+        table.add_index("group", ["group"])
+        table.add_index("value", ["value"])
+        for i, key in enumerate(keys):
+            table.insert(key + (i % 10, i))
+
+        for key in keys[:size // 10]:
+            table.upsert(key, (-1, -1))
+
+        return size + size // 10
+
+    return run
+
+
+def table_filter(order, width, size, rng):
+    table = make_table(width, size)
+
+    def run():
+        for _ in table.filter(lambda row: row["group"] == 3):
+            pass
+
+        return size
+
+    return run
+
+
+def table_group_by(order, width, size, rng):
+    table = make_table(width, size)
+    table.add_index("group", ["group"])
+
+    def run():
+        for _ in table.group_by(["group"]):
+            pass
+
+        return size
+
+    return run
+
+
+TREE_WORKLOADS = (
+    insert_sequential, insert_random, insert_descending, lookup_point,
+    scan_range, scan_forward, scan_reverse, delete_rebalance)
+
+TABLE_WORKLOADS = (table_auxiliary, table_filter, table_group_by)
+
+
+def run_benchmarks(names=None, orders=(4, 10, 32), widths=(1, 3),
+                   sizes=(1000, 10000), repeat=3, seed=0):
+
+    results = []
+    for workload in TREE_WORKLOADS + TABLE_WORKLOADS:
+        if names and not any(name in workload.__name__ for name in names):
+            continue
+
+        for size in sizes:
+            for width in widths:
+                for order in (orders if workload in TREE_WORKLOADS else (None,)):
+                    run = workload(order, width, size, random.Random(seed))
+
+                    # the minimum is the least disturbed by other processes
+                    timings = []
+                    for _ in range(repeat):
+                        start = time.perf_counter()
+                        ops = run()
+                        timings.append(time.perf_counter() - start)
+
+                    seconds = min(timings)
+                    results.append({
+                        "workload": workload.__name__,
+                        "order": order,
+                        "width": width,
+                        "size": size,
+                        "seconds": seconds,
+                        "ops_per_second": ops / seconds if seconds else None,
+                    })
+
+    return results
+
+
+def compare(results, baseline, threshold=0.1):
+    def key(result):
+        return (result["workload"], result["order"], result["width"], result["size"])
+
+    previous = {key(result): result for result in baseline}
+    comparisons = []
+    for result in results:
+        if key(result) not in previous:
+            continue
+
+        before = previous[key(result)]["seconds"]
+        ratio = result["seconds"] / before if before else None
+        comparisons.append(dict(
+            result, baseline_seconds=before, ratio=ratio,
+            regression=ratio is not None and ratio > 1 + threshold))
+
+    return comparisons
+
+
+def main(argv=None):
+    def numbers(value):
+        return tuple(int(v) for v in value.split(","))
+
+    parser = argparse.ArgumentParser(description="benchmark BTree and Table workloads")
+    parser.add_argument("workloads", nargs="*", help="run only workloads containing these names")
+    parser.add_argument("--orders", type=numbers, default=(4, 10, 32))
+    parser.add_argument("--widths", type=numbers, default=(1, 3))
+    parser.add_argument("--sizes", type=numbers, default=(1000, 10000))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this file as well as stdout")
+    parser.add_argument("--baseline", help="compare against the results saved in this file")
+    parser.add_argument(
+        "--threshold", type=float, default=0.1,
+        help="slowdown relative to the baseline which counts as a regression")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(
+        args.workloads, args.orders, args.widths, args.sizes, args.repeat, args.seed)
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "repeat": args.repeat,
+        "results": results,
+    }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+
+        report["comparison"] = compare(results, baseline, args.threshold)
+        regressions = [c for c in report["comparison"] if c["regression"]]
+        report["regressions"] = len(regressions)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,48 @@
+import json
+import os
+import tempfile
+
+from benchmark import compare, main, make_key, run_benchmarks
+
+
+def test_make_key():
+    keys = [make_key(i, 3) for i in range(1000)]
+    assert keys == sorted(keys)
+    assert len(set(keys)) == 1000
+    assert make_key(17, 1) == (17,)
+
+
+def test_run():
+    results = run_benchmarks(["insert", "table_filter"], (3, 5), (1, 2), (50,), 1)
+    assert len(results) == 3 * 2 * 2 + 2
+    assert all(r["seconds"] > 0 for r in results)
+    assert set(r["order"] for r in results if r["workload"] == "table_filter") == {None}
+
+
+def test_compare():
+    results = [{"workload": "a", "order": 3, "width": 1, "size": 10, "seconds": 2.0}]
+    baseline = [dict(results[0], seconds=1.0), dict(results[0], workload="b")]
+    (comparison,) = compare(results, baseline)
+    assert comparison["ratio"] == 2.0 and comparison["regression"]
+    assert not compare(results, baseline, threshold=1.5)[0]["regression"]
+
+
+def test_main():
+    with tempfile.TemporaryDirectory() as directory:
+        output = os.path.join(directory, "baseline.json")
+        args = ["lookup", "--orders", "3", "--widths", "1", "--sizes", "20", "--repeat", "1"]
+        assert main(args + ["--output", output]) == 0
+
+        with open(output) as f:
+            report = json.load(f)
+
+        assert [r["workload"] for r in report["results"]] == ["lookup_point"]
+        assert main(args + ["--baseline", output, "--threshold", "1000"]) == 0
+
+
+if __name__ == "__main__":
+    test_make_key()
+    test_run()
+    test_compare()
+    test_main()
+    print("PASS")
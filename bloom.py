@@ -0,0 +1,45 @@
+import math
+
+# a Bloom filter answers "definitely absent" or "maybe present"; items can
+# only be added, so removing one means building a new filter
+
+
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate=0.01):
+        assert 0 < error_rate < 1
+
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+
+        size = -self.capacity * math.log(error_rate) / (math.log(2) ** 2)
+        self._size = max(8, int(math.ceil(size)))
+        self._hashes = max(1, int(round(self._size / self.capacity * math.log(2))))
+        self._bits = bytearray((self._size + 7) // 8)
+        self._count = 0
+
+    def __contains__(self, item):
+        for i in self._positions(item):
+            if not self._bits[i >> 3] & (1 << (i & 7)):
+                return False
+
+        return True
+
+    def __len__(self):
+        return self._count
+
+    def add(self, item):
+        for i in self._positions(item):
+            self._bits[i >> 3] |= 1 << (i & 7)
+
+        self._count += 1
+
+    def size(self):
+        return self._size
+
+    def _positions(self, item):
+        # double hashing: k positions from two hashes, with an odd step so
+        # that they are distinct whenever the size is a power of two
+        h1 = hash(item)
+        h2 = hash((h1, item)) | 1
+        for i in range(self._hashes):
+            yield (h1 + i * h2) % self._size
@@ -0,0 +1,36 @@
+import random
+
+from bloom import BloomFilter
+
+
+def test_membership():
+    items = [(random.randint(0, 10 ** 9), str(i)) for i in range(1000)]
+    bloom = BloomFilter(len(items))
+    for item in items:
+        bloom.add(item)
+
+    assert len(bloom) == len(items)
+    assert all(item in bloom for item in items)
+
+
+def test_error_rate():
+    for error_rate in (0.1, 0.01):
+        bloom = BloomFilter(2000, error_rate)
+        for i in range(2000):
+            bloom.add((i,))
+
+        false_positives = sum((i,) in bloom for i in range(2000, 22000))
+        assert false_positives / 20000 < error_rate * 2
+
+
+def test_empty():
+    bloom = BloomFilter(0)
+    assert bloom.capacity == 1
+    assert (1,) not in bloom
+
+
+if __name__ == "__main__":
+    test_membership()
+    test_error_rate()
+    test_empty()
+    print("PASS")
@@ -1,7 +1,12 @@
+import array
 import bisect
 import math
+import random
+import sys
+import time
 
 from collections import deque
+from codec import successor
 
 # sources:
 #   https://gist.github.com/natekupp/1763661 (assumes, but does not enforce, unique keys)
@@ -66,7 +71,42 @@ class _BTreeKey(object):
         return self.key
 
 
+class _EncodedBTreeKey(_BTreeKey):
+    def __init__(self, codec, encoded):
+        self.codec = codec
+        self.encoded = encoded
+        self.deleted = False
+
+    def __bool__(self):
+        return len(self.encoded) > 0
+
+    def __eq__(self, other):
+        return self.encoded == other.encoded
+
+    def __ge__(self, other):
+        return self.encoded >= other.encoded
+
+    def __gt__(self, other):
+        return self.encoded > other.encoded
+
+    def __le__(self, other):
+        return self.encoded <= other.encoded
+
+    def __lt__(self, other):
+        return self.encoded < other.encoded
+
+    @property
+    def key(self):
+        return self.codec.decode(self.encoded)
+
+    @key.setter
+    def key(self, key):
+        self.encoded = self.codec.encode(key)
+
+
 class _BTreeNode(object):
+    __slots__ = ("parent", "leaf", "keys", "children", "rebalance", "size", "tombstones")
+
     def __init__(self, parent, leaf = False):
         self.parent = parent
         self.leaf = leaf
@@ -74,23 +114,73 @@ class _BTreeNode(object):
         self.children = []
         self.rebalance = False
 
+        # the number of live keys in this subtree, and of deleted ones
+        self.size = 0
+        self.tombstones = 0
+
     def __iter__(self):
         yield from self.select(slice(None))
 
     def __getitem__(self, index):
         yield from self.select(index)
 
-    def select(self, bounds, reverse=False):
-        rows = (
-            node.keys[i] for (node, i) in self._slice(bounds, reverse)
-            if not node.keys[i].deleted)
-        yield from (row.key for row in rows)
+    def __len__(self):
+        return len(self.keys)
+
+    def bisect_left(self, key):
+        return bisect.bisect_left(self.keys, key)
+
+    def bisect_right(self, key):
+        return bisect.bisect_right(self.keys, key)
+
+    def entries(self, start=0, stop=None):
+        return self.keys[start:stop]
+
+    def entry(self, i):
+        return self.keys[i]
+
+    def insert(self, i, entry):
+        self.keys.insert(i, entry)
+
+    def is_deleted(self, i):
+        return self.keys[i].deleted
+
+    def key(self, i):
+        return self.keys[i].key
+
+    def live(self, start=0, stop=None):
+        # the number of keys in the range which are not deleted
+        return sum(not k.deleted for k in self.keys[start:stop])
+
+    def matches(self, i, entry):
+        return self.keys[i] == entry
+
+    def recount(self):
+        self.size = self.live() + sum(child.size for child in self.children)
+        self.tombstones = len(self) - self.live() + sum(
+            child.tombstones for child in self.children)
+
+    def select(self, bounds, reverse=False, metrics=None):
+        for (node, i) in self._slice(bounds, reverse, metrics):
+            if not node.is_deleted(i):
+                yield node.key(i)
+            elif metrics is not None:
+                metrics.count("tombstones_skipped")
+
+    def set_deleted(self, i, deleted):
+        self.keys[i].deleted = deleted
+
+    def set_entries(self, entries):
+        self.keys = entries
+
+    def set_key(self, i, key):
+        self.keys[i].key = key
 
     def valid(self, order):
         if self.rebalance:
             return False
 
-        if not self.keys:
+        if not len(self):
             return False
 
         if not self.leaf:
@@ -102,69 +192,341 @@ class _BTreeNode(object):
             elif len(self.children) <= math.ceil(order / 2):
                 return False
 
-            if len(self.keys) != len(self.children) - 1:
+            if len(self) != len(self.children) - 1:
                 return False
 
         return True
 
-    def _slice(self, bounds, reverse):
-        if isinstance(bounds, slice):
-            l = bisect.bisect_left(self.keys, bounds.start) if bounds.start else 0
-            r = bisect.bisect_left(self.keys, bounds.stop) if bounds.stop else len(self.keys)
-            if bounds.step and bounds.step != 1:
-                raise IndexError
-        else:
-            l = bisect.bisect_left(self.keys, bounds)
-            r = bisect.bisect_right(self.keys, bounds)
+    def _slice(self, bounds, reverse, metrics=None):
+        if metrics is not None:
+            # bisect compares in C, so estimate its comparisons from the node size
+            metrics.count("nodes_visited")
+            metrics.count("comparisons", 2 * len(self).bit_length())
 
+        (l, r) = self._range(bounds)
         if self.leaf:
             r = reversed(range(l, r)) if reverse else range(l, r)
             yield from ((self, i) for i in r)
         else:
             if reverse:
-                yield from self.children[r]._slice(bounds, reverse)
+                yield from self.children[r]._slice(bounds, reverse, metrics)
 
                 for i in reversed(range(l, r)):
                     yield (self, i)
-                    yield from self.children[i]._slice(bounds, True)
+                    yield from self.children[i]._slice(bounds, True, metrics)
             else:
                 for i in range(l, r):
-                    yield from self.children[i]._slice(bounds, False)
+                    yield from self.children[i]._slice(bounds, False, metrics)
                     yield (self, i)
 
-                yield from self.children[r]._slice(bounds, reverse)
+                yield from self.children[r]._slice(bounds, reverse, metrics)
+
+    def _range(self, bounds):
+        # the positions of the first key within the bounds and the first past them
+        if isinstance(bounds, slice):
+            l = self.bisect_left(bounds.start) if bounds.start else 0
+            r = self.bisect_left(bounds.stop) if bounds.stop else len(self)
+            if bounds.step and bounds.step != 1:
+                raise IndexError
+        else:
+            l = self.bisect_left(bounds)
+            r = self.bisect_right(bounds)
+
+        return l, r
+
+
+class _PrefixBTreeNode(_BTreeNode):
+    # stores the suffix of each key after the longest prefix common to all of
+    # the keys in this node, so a search compares the prefix once per node
+    __slots__ = ("prefix",)
+
+    def __init__(self, parent, leaf = False):
+        super().__init__(parent, leaf)
+        self.prefix = ()
+
+    def bisect_left(self, key):
+        return self._bisect(key, bisect.bisect_left, 0)
+
+    def bisect_right(self, key):
+        return self._bisect(key, bisect.bisect_right, len(self.keys))
+
+    def entries(self, start=0, stop=None):
+        return [self.entry(i) for i in range(len(self.keys))[start:stop]]
+
+    def entry(self, i):
+        entry = _BTreeKey(self.prefix + self.keys[i].key)
+        entry.deleted = self.keys[i].deleted
+        return entry
+
+    def insert(self, i, entry):
+        prefix_len = len(self.prefix)
+        if tuple(entry.key[:prefix_len]) != self.prefix:
+            entries = self.entries()
+            entries.insert(i, entry)
+            self.set_entries(entries)
+        else:
+            suffix = _BTreeKey(entry.key[prefix_len:])
+            suffix.deleted = entry.deleted
+            self.keys.insert(i, suffix)
+
+    def key(self, i):
+        return self.prefix + self.keys[i].key
+
+    def matches(self, i, entry):
+        return self.key(i) == tuple(entry.key)
+
+    def set_entries(self, entries):
+        if entries:
+            first = entries[0].key
+            last = entries[-1].key
+            prefix_len = 0
+            while prefix_len < min(len(first), len(last)):
+                if first[prefix_len] != last[prefix_len]:
+                    break
+
+                prefix_len += 1
+
+            self.prefix = tuple(first[:prefix_len])
+        else:
+            prefix_len = 0
+            self.prefix = ()
+
+        self.keys = []
+        for entry in entries:
+            suffix = _BTreeKey(entry.key[prefix_len:])
+            suffix.deleted = entry.deleted
+            self.keys.append(suffix)
+
+    def set_key(self, i, key):
+        prefix_len = len(self.prefix)
+        if tuple(key[:prefix_len]) != self.prefix:
+            entries = self.entries()
+            entries[i].key = tuple(key)
+            self.set_entries(entries)
+        else:
+            self.keys[i].key = tuple(key[prefix_len:])
+
+    def _bisect(self, key, bisect_keys, matches_all):
+        prefix_len = len(self.prefix)
+        if not prefix_len:
+            return bisect_keys(self.keys, key)
+
+        head = tuple(key[:prefix_len])
+        prefix = self.prefix[:len(head)]
+        if head < prefix:
+            return 0
+        elif head > prefix:
+            return len(self.keys)
+        elif len(key) <= prefix_len:
+            return matches_all
+        else:
+            return bisect_keys(self.keys, tuple(key[prefix_len:]))
+
+
+class _ArrayBTreeNode(_BTreeNode):
+    # stores each column of a numeric schema in a typed array, with a bitmask
+    # of deleted keys, so a key costs a few machine words instead of objects;
+    # a subclass per schema sets the typecodes
+    __slots__ = ("columns", "deleted")
+
+    typecodes = ()
+
+    def __init__(self, parent, leaf = False):
+        super().__init__(parent, leaf)
+        self.keys = None
+        self.columns = tuple(array.array(typecode) for typecode in self.typecodes)
+        self.deleted = 0
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def bisect_left(self, key):
+        # narrow the range one column at a time; within the keys which share
+        # the leading columns of the probe, the next column is sorted
+        lo = 0
+        hi = len(self)
+        for c in range(len(key)):
+            column = self.columns[c]
+            value = key[c]
+            lo = bisect.bisect_left(column, value, lo, hi)
+            if lo == hi or column[lo] != value:
+                return lo
+
+            hi = bisect.bisect_right(column, value, lo, hi)
+
+        return lo
+
+    def bisect_right(self, key):
+        lo = 0
+        hi = len(self)
+        for c in range(len(key)):
+            column = self.columns[c]
+            value = key[c]
+            hi = bisect.bisect_right(column, value, lo, hi)
+            if lo == hi or column[hi - 1] != value:
+                return hi
+
+            lo = bisect.bisect_left(column, value, lo, hi)
+
+        return hi
+
+    def entries(self, start=0, stop=None):
+        return [self.entry(i) for i in range(len(self))[start:stop]]
+
+    def entry(self, i):
+        entry = _BTreeKey(self.key(i))
+        entry.deleted = self.is_deleted(i)
+        return entry
+
+    def insert(self, i, entry):
+        for column, value in zip(self.columns, entry.key):
+            column.insert(i, value)
+
+        low = self.deleted & ((1 << i) - 1)
+        high = (self.deleted >> i) << (i + 1)
+        self.deleted = low | high | (int(entry.deleted) << i)
+
+    def is_deleted(self, i):
+        return bool((self.deleted >> i) & 1)
+
+    def key(self, i):
+        return tuple(column[i] for column in self.columns)
+
+    def live(self, start=0, stop=None):
+        (start, stop, _) = slice(start, stop).indices(len(self))
+        if stop <= start:
+            return 0
+
+        deleted = (self.deleted >> start) & ((1 << (stop - start)) - 1)
+        return stop - start - bin(deleted).count("1")
+
+    def matches(self, i, entry):
+        return self.key(i) == tuple(entry.key)
+
+    def set_deleted(self, i, deleted):
+        if deleted:
+            self.deleted |= 1 << i
+        else:
+            self.deleted &= ~(1 << i)
+
+    def set_entries(self, entries):
+        self.columns = tuple(
+            array.array(typecode, (entry.key[c] for entry in entries))
+            for c, typecode in enumerate(self.typecodes))
+
+        self.deleted = 0
+        for i, entry in enumerate(entries):
+            if entry.deleted:
+                self.deleted |= 1 << i
+
+    def set_key(self, i, key):
+        for column, value in zip(self.columns, key):
+            column[i] = value
+
+
+_TYPECODES = {int: "q", float: "d"}
+_ARRAY_NODES = {}
+
+
+def _array_node(schema):
+    if not all(ctr in _TYPECODES for ctr in schema):
+        raise TypeError("compact nodes need int or float columns, not {}".format(schema))
+
+    typecodes = tuple(_TYPECODES[ctr] for ctr in schema)
+    if typecodes not in _ARRAY_NODES:
+        attrs = {"__slots__": (), "typecodes": typecodes}
+        _ARRAY_NODES[typecodes] = type("_ArrayBTreeNode", (_ArrayBTreeNode,), attrs)
+
+    return _ARRAY_NODES[typecodes]
+
+
+_CONVERTERS = {}
+
+
+def converter(schema):
+    # a function which converts a row to a tuple of the schema's types; the
+    # source is generated once per schema so that the columns are unrolled, and
+    # a value which already has its column's exact type is not converted again
+    schema = tuple(schema)
+    if schema not in _CONVERTERS:
+        values = ["v{}".format(i) for i in range(len(schema))]
+        converted = [
+            "{0} if {0}.__class__ is c{1} else c{1}({0})".format(v, i)
+            for (i, v) in enumerate(values)]
+
+        source = "def convert(row):\n    {}, = row\n    return ({},)\n".format(
+            ", ".join(values), ", ".join(converted))
+        namespace = {"c{}".format(i): ctr for (i, ctr) in enumerate(schema)}
+        exec(source, namespace)
+        _CONVERTERS[schema] = namespace["convert"]
+
+    return _CONVERTERS[schema]
+
+
+class Metrics(object):
+    # counters for one tree; a hook receives every increment as it happens,
+    # e.g. to forward it to a monitoring system
+    def __init__(self, name="", hook=None):
+        self.name = name
+        self.hook = hook
+        self.counters = {}
+
+    def count(self, counter, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+        if self.hook is not None:
+            self.hook(self.name, counter, n)
+
+    def reset(self):
+        self.counters = {}
 
 
 class BTree(object):
-    def __init__(self, order, schema, keys=[]):
+    def __init__(
+            self, order, schema, keys=[], presorted=False, codec=None,
+            compress_prefix=False, compact=False):
+
         assert order >= 2
         assert schema and schema == tuple(schema)
-
+        assert codec is None or len(codec) == len(schema)
+
+        if codec is not None and compress_prefix:
+            raise ValueError("prefix compression applies to unencoded keys")
+        elif compact and (codec is not None or compress_prefix):
+            raise ValueError("compact nodes store unencoded, uncompressed keys")
+
+        self._codec = codec
+        self._compress_prefix = compress_prefix
+        self._compact = compact
+        if compact:
+            self._node = _array_node(schema)
+        else:
+            self._node = _PrefixBTreeNode if compress_prefix else _BTreeNode
         self._len = 0
+        self.metrics = None
         self._order = order
         self._schema = schema
-        self._root = _BTreeNode(None, leaf = True)
+        self._convert = converter(schema)
+        self._root = self._node(None, leaf = True)
 
-        for key in keys:
-            self.insert(key)
+        if presorted:
+            self._build(keys)
+        else:
+            for key in keys:
+                self.insert(key)
 
-        self._rebalance_queue = []
+        # nodes with tombstones or too few children, each once, in the order queued
+        self._rebalance_queue = {}
 
     def __getitem__(self, index):
-        yield from self._root[index]
+        yield from self._root.select(self._bounds(index), False, self.metrics)
 
     def __delitem__(self, index):
-        for (node, i) in self._root._slice(index, False):
-            if not node.keys[i].deleted:
-                node.keys[i].deleted = True
-                node.rebalance = True
-                if not node in self._rebalance_queue:
-                    self._rebalance_queue.append(node)
-
-                self._len -= 1
+        for (node, i) in self._root._slice(self._bounds(index), False, self.metrics):
+            if not node.is_deleted(i):
+                self._tombstone(node, i)
 
     def __iter__(self):
-        yield from self._root
+        yield from self._root.select(slice(None), False, self.metrics)
 
     def __len__(self):
         return self._len
@@ -177,8 +539,8 @@ class BTree(object):
 
             leaf = "leaf" if node.leaf else "internal"
             as_str += "[{}]: {} keys, {} children ({}):".format(
-                path, len(node.keys), len(node.children), leaf)
-            as_str += "\t{}\n".format(", ".join([str(k) for k in node.keys]))
+                path, len(node), len(node.children), leaf)
+            as_str += "\t{}\n".format(", ".join([str(k) for k in node.entries()]))
 
             for i in range(len(node.children)):
                 unvisited.append(("{}-{}".format(path, i), node.children[i]))
@@ -191,32 +553,186 @@ class BTree(object):
 
         return False
 
+    def count(self, bounds):
+        # the number of keys within the bounds, from the sizes of the
+        # subtrees between the two paths to either end of them
+        return self._count(self._root, self._bounds(bounds), True, True, {})
+
+    def delete_range(self, bounds):
+        # deletes every key within the bounds at once: subtrees which lie
+        # wholly within them are dropped without visiting their keys one by
+        # one, and only the nodes on the paths to either end are rewritten
+        if not isinstance(bounds, slice) and not len(bounds):
+            bounds = slice(None)
+
+        bounds = self._bounds(bounds)
+        if isinstance(bounds, slice) and not (bounds.start or bounds.stop) and (
+                bounds.step in (None, 1)):
+            self._len = 0
+            self._root = self._node(None, leaf = True)
+            self._rebalance_queue = {}
+            return
+
+        self._len -= self._delete_range(self._root, bounds, True, True)
+        while not self._root.leaf and not len(self._root):
+            self._unqueue(self._root)
+            self._root = self._root.children[0]
+            self._root.parent = None
+
+    def depth(self):
+        depth = 1
+        node = self._root
+        while not node.leaf:
+            node = node.children[0]
+            depth += 1
+
+        return depth
+
     def insert(self, key):
         assert len(key) == len(self._schema)
 
-        key = tuple(self._schema[i](key[i]) for i in range(len(self._schema)))
+        key = self._convert(key)
 
-        key = _BTreeKey(key)
-        if len(self._root.keys) >= (2 * self._order) - 1:
+        key = self._key(key)
+        if len(self._root) >= (2 * self._order) - 1:
             node = self._root
-            self._root = _BTreeNode(None)
+            self._root = self._node(None)
+            self._root.size = node.size
+            self._root.tombstones = node.tombstones
             node.parent = self._root
             self._root.children.insert(0, node)
             self._split_child(self._root, 0)
 
         self._insert(self._root, key)
 
+    def key_memory(self):
+        stored = 0
+        uncompressed = 0
+        unvisited = deque([self._root])
+        while unvisited:
+            node = unvisited.popleft()
+            # the empty tuple is a shared singleton, so a key which is all
+            # prefix stores nothing of its own
+            if isinstance(node, _PrefixBTreeNode) and node.prefix:
+                stored += sys.getsizeof(node.prefix)
+
+            if isinstance(node, _ArrayBTreeNode):
+                stored += sum(column.itemsize * len(column) for column in node.columns)
+            else:
+                for i in range(len(node)):
+                    if self._codec is not None:
+                        stored += sys.getsizeof(node.keys[i].encoded)
+                    elif node.keys[i].key:
+                        stored += sys.getsizeof(node.keys[i].key)
+
+            for i in range(len(node)):
+                uncompressed += sys.getsizeof(tuple(node.key(i)))
+
+            unvisited.extend(node.children)
+
+        return {"stored": stored, "uncompressed": uncompressed}
+
+    def remove(self, prefixes):
+        # deletes the keys which match each of the prefixes, descending once
+        # into every node which may hold any of them rather than once per prefix
+        prefixes = [self._bounds(list(prefix)) for prefix in prefixes]
+        if prefixes:
+            self._remove(self._root, prefixes)
+
+    def replace(self, bounds, key):
+        assert len(key) == len(self._schema)
+
+        key = self._convert(key)
+
+        found = [
+            (node, i) for (node, i)
+            in self._root._slice(self._bounds(bounds), False, self.metrics)
+            if not node.is_deleted(i)]
+
+        if len(found) > 1:
+            raise IndexError("{} has {} keys".format(bounds, len(found)))
+
+        for (node, i) in found:
+            # overwriting a key in place is only safe if it keeps its position
+            prefix_len = len(bounds)
+            if node.key(i)[:prefix_len] != key[:prefix_len]:
+                raise ValueError(key)
+
+            node.set_key(i, key)
+
+        return len(found)
+
+    def sample(self, bounds, n, rng=random):
+        # n distinct keys within the bounds, chosen uniformly at random and
+        # returned in order; each is found by its rank, descending to the
+        # child whose subtree holds that many keys before it
+        bounds = self._bounds(bounds)
+        counts = {}
+        total = self._count(self._root, bounds, True, True, counts)
+        ranks = sorted(rng.sample(range(total), min(n, total)))
+        return [self._at(self._root, bounds, rank, True, True, counts) for rank in ranks]
+
     def select(self, bounds, reverse=False):
-        if bounds.step:
+        if isinstance(bounds, slice) and bounds.step:
             raise IndexError
 
-        return self._root.select(bounds, reverse)
+        return self._root.select(self._bounds(bounds), reverse, self.metrics)
 
     def rebalance(self):
+        queued = bool(self._rebalance_queue)
+        start = time.perf_counter()
+        self._rebalance_all()
+
+        if self.metrics is not None and queued:
+            self.metrics.count("rebalances")
+            self.metrics.count("rebalance_seconds", time.perf_counter() - start)
+
+    def stats(self):
+        nodes = 0
+        unvisited = deque([self._root])
+        while unvisited:
+            node = unvisited.popleft()
+            nodes += 1
+            unvisited.extend(node.children)
+
+        stats = {
+            "rows": len(self),
+            "depth": self.depth(),
+            "nodes": nodes,
+            "tombstones": self._root.tombstones,
+        }
+
+        if self.metrics is not None:
+            stats["counters"] = dict(self.metrics.counters)
+
+        return stats
+
+    def update(self, bounds, function):
+        # overwrites each live key within the bounds with function(key), unless
+        # that returns None, in a single walk over the range in key order; a
+        # new key must sort in the same position as the key which it replaces
+        if isinstance(bounds, slice) and bounds.step:
+            raise IndexError
+
+        updated = 0
+        for (node, i) in self._root._slice(self._bounds(bounds), False, self.metrics):
+            if node.is_deleted(i):
+                continue
+
+            key = function(node.key(i))
+            if key is not None:
+                node.set_key(i, self._convert(key))
+                updated += 1
+
+        return updated
+
+    def _rebalance_all(self):
         while self._rebalance_queue:
-            node = self._rebalance_queue.pop()
+            (node, _) = self._rebalance_queue.popitem()
             if node.parent is None:
-                self._root = self._rebalance(node)
+                # a former root was already replaced by a rebuild
+                if node is self._root:
+                    self._root = self._rebalance(node)
             elif node.valid(self._order):
                 for i in range(len(node.children)):
                     if not node.children[i].valid(self._order):
@@ -226,46 +742,391 @@ class BTree(object):
                             node.rebalance = True
 
                 if node.rebalance:
-                    self._rebalance_queue.append(node.parent)
+                    self._rebalance_queue[node.parent] = None
+            else:
+                self._rebalance_queue[node.parent] = None
+
+    def _at(self, node, bounds, rank, low, high, counts):
+        # the key of the given rank among those within the bounds
+        (l, r) = self._range(node, bounds, low, high)
+        for i in range(l, r + 1):
+            if not node.leaf:
+                (child_low, child_high) = (low and i == l, high and i == r)
+                size = self._count(node.children[i], bounds, child_low, child_high, counts)
+                if rank < size:
+                    return self._at(
+                        node.children[i], bounds, rank, child_low, child_high, counts)
 
-            elif node.parent is None:
-                self._root = self._rebalance(node)
+                rank -= size
+
+            if i < r and not node.is_deleted(i):
+                if not rank:
+                    return node.key(i)
+
+                rank -= 1
+
+    def _bounds(self, bounds):
+        if self._codec is None:
+            return bounds
+
+        # the codec converts each value to its column's type as it encodes it
+        encode = self._codec.encode
+        if isinstance(bounds, slice):
+            start = encode(bounds.start) if bounds.start else b""
+            stop = encode(bounds.stop) if bounds.stop else b""
+        else:
+            # an encoded prefix bounds exactly the keys whose encoding starts with it
+            start = encode(bounds)
+            stop = successor(start) or b""
+
+        start = _EncodedBTreeKey(self._codec, start) if start else None
+        stop = _EncodedBTreeKey(self._codec, stop) if stop else None
+        return slice(start, stop, bounds.step if isinstance(bounds, slice) else None)
+
+    def _build(self, keys):
+        # bottom-up bulk load: fill leaves left to right, then group each
+        # level into parents, promoting the key between two groups
+        leaf_size = (2 * self._order) - 2
+        fanout = (2 * self._order) - 1
+
+        leaves = [[]]
+        separators = []
+        previous = None
+        for key in keys:
+            assert len(key) == len(self._schema)
+
+            key = self._convert(key)
+            if previous is not None:
+                if key == previous:
+                    continue
+                elif key < previous:
+                    raise ValueError("{} follows {}".format(key, previous))
+
+            previous = key
+            self._len += 1
+
+            if len(leaves[-1]) == leaf_size:
+                separators.append(self._key(key))
+                leaves.append([])
             else:
-                self._rebalance_queue.append(node.parent)
+                leaves[-1].append(self._key(key))
 
-    def _insert(self, node, key):
-        i = bisect.bisect_left(node.keys, key)
+        if not leaves[-1] and separators:
+            leaves.pop()
+            leaves[-1].append(separators.pop())
+
+        nodes = []
+        for keys in leaves:
+            nodes.append(self._node(None, leaf = True))
+            nodes[-1].set_entries(keys)
+            nodes[-1].size = len(keys)
+
+        while len(nodes) > 1:
+            num_parents = -(-len(nodes) // fanout)
+            size, extra = divmod(len(nodes), num_parents)
+
+            parents = []
+            parent_separators = []
+            start = 0
+            for p in range(num_parents):
+                end = start + size + (1 if p < extra else 0)
+
+                parent = self._node(None)
+                parent.children = nodes[start:end]
+                parent.set_entries(separators[start:(end - 1)])
+                for child in parent.children:
+                    child.parent = parent
+
+                parent.recount()
+
+                parents.append(parent)
+                if end < len(nodes):
+                    parent_separators.append(separators[end - 1])
+
+                start = end
+
+            nodes = parents
+            separators = parent_separators
+
+        self._root = nodes[0]
+
+    def _count(self, node, bounds, low, high, counts):
+        # a subtree which the bounds cover whole counts its size, and the
+        # counts of the rest are kept, as sampling descends them repeatedly
+        if not (low or high):
+            return node.size
+        elif (node, low, high) in counts:
+            return counts[(node, low, high)]
+
+        (l, r) = self._range(node, bounds, low, high)
+        count = node.live(l, r)
+        if node.leaf:
+            pass
+        elif l == r:
+            count += self._count(node.children[l], bounds, low, high, counts)
+        else:
+            count += sum(child.size for child in node.children[l + 1:r])
+            count += self._count(node.children[l], bounds, low, False, counts)
+            count += self._count(node.children[r], bounds, False, high, counts)
+
+        counts[(node, low, high)] = count
+        return count
+
+    def _delete_range(self, node, bounds, low, high):
+        # returns the number of live keys removed from the subtree; low and
+        # high are whether the start and the end of the bounds fall within it
+        (l, r) = self._range(node, bounds, low, high)
+        removed = node.live(l, r)
         if node.leaf:
-            if i < len(node.keys) and node.keys[i] == key:
-                if node.keys[i].deleted:
-                    node.keys[i].deleted = False
-                    self._len += 1
-                else:
-                    pass
+            if l < r:
+                node.set_entries(node.entries(0, l) + node.entries(r))
+                node.size -= removed
+                node.tombstones -= (r - l) - removed
+
+            return removed
+
+        if l < r:
+            # the children between the first and last key within the bounds
+            # are covered whole; the last key stays behind as a tombstone, to
+            # separate the two children which are only partly covered
+            for child in node.children[l + 1:r]:
+                removed += self._detach(child)
+
+            entries = node.entries()
+            entries[r - 1].deleted = True
+            node.set_entries(entries[:l] + entries[r - 1:])
+            node.children[l + 1:r] = []
+            boundary = [(l, low, False), (l + 1, False, high)]
+        else:
+            boundary = [(l, low, high)]
+
+        for (i, child_low, child_high) in boundary:
+            if child_low or child_high:
+                removed += self._delete_range(node.children[i], bounds, child_low, child_high)
             else:
-                node.keys.insert(i, key)
-                self._len += 1
+                # covered whole; the empty leaf in its place is dropped below
+                removed += self._detach(node.children[i])
+                node.children[i] = self._node(node, leaf = True)
+
+        boundary = [i for (i, _low, _high) in boundary]
+
+        if len(boundary) == 2 and all(len(node.children[i]) for i in boundary):
+            # a live key from either side can replace the tombstone
+            entry = self._take_key(node.children[l + 1], True)
+            if entry is None:
+                entry = self._take_key(node.children[l], False)
+
+            if entry is not None:
+                entries = node.entries()
+                entries[l] = entry
+                node.set_entries(entries)
+
+        for i in reversed(boundary):
+            self._repair_child(node, i)
+
+        node.recount()
+        return removed
+
+    def _detach(self, node):
+        # drops a subtree from the tree and returns its number of live keys;
+        # any of its nodes still queued are skipped by the next rebalance
+        if self.metrics is not None:
+            self.metrics.count("subtrees_detached")
+
+        node.parent = None
+        return node.size
+
+    def _drop_child(self, node, i):
+        # removes the empty child i along with a key beside it; a tombstone
+        # is simply dropped, and a live key moves down into the subtree next
+        # to it, as its first or last key
+        self._unqueue(node.children[i])
+        del node.children[i]
+        entries = node.entries()
+        if not entries:
+            node.leaf = True
+            return
+
+        before = i > 0 and entries[i - 1].deleted
+        j = i - 1 if before or i == len(entries) else i
+        entry = entries.pop(j)
+        node.set_entries(entries)
+        if entry.deleted:
+            return
+
+        leaf = node.children[j]
+        while not leaf.leaf:
+            leaf = leaf.children[0 if j == i else -1]
+
+        leaf.insert(0 if j == i else len(leaf), entry)
+        if len(leaf) > (2 * self._order) - 1:
+            self._queue(leaf)
+
+        while leaf is not node:
+            leaf.size += 1
+            leaf = leaf.parent
+
+    def _merge_children(self, node, i):
+        # merges child i with the child after it, or shares their keys out
+        # evenly between them if that would overfill one node
+        left, right = node.children[i:i + 2]
+        entries = node.entries()
+        keys = left.entries() + [entries[i]] + right.entries()
+        children = left.children + right.children
+        queued = left.rebalance or right.rebalance
+        if len(keys) < (2 * self._order) - 1:
+            left.set_entries(keys)
+            left.children = children
+            node.set_entries(entries[:i] + entries[i + 1:])
+            del node.children[i + 1]
+            right.children = []
+            self._unqueue(right)
         else:
-            if len(node.children[i].keys) == (2 * self._order) - 1:
+            m = len(keys) // 2
+            left.set_entries(keys[:m])
+            right.set_entries(keys[m + 1:])
+            left.children = children[:m + 1]
+            right.children = children[m + 1:]
+            entries[i] = keys[m]
+            node.set_entries(entries)
+            if queued:
+                self._queue(right)
+
+        for child in left.children:
+            child.parent = left
+        for child in right.children:
+            child.parent = right
+
+        left.recount()
+        right.recount()
+        if queued:
+            self._queue(left)
+
+    def _insert(self, node, key):
+        if self.metrics is not None:
+            self.metrics.count("nodes_visited")
+            self.metrics.count("comparisons", len(node).bit_length())
+
+        # returns whether the key was added, so that each node on the path
+        # counts it in the size of its subtree
+        i = node.bisect_left(key)
+        if i < len(node) and node.matches(i, key):
+            if not node.is_deleted(i):
+                return False
+
+            node.set_deleted(i, False)
+            parent = node
+            while parent is not None:
+                parent.tombstones -= 1
+                parent = parent.parent
+        elif node.leaf:
+            node.insert(i, key)
+        else:
+            if len(node.children[i]) == (2 * self._order) - 1:
                 self._split_child(node, i)
-                if key > node.keys[i]:
+                if node.matches(i, key):
+                    return self._insert(node, key)
+                elif key > node.entry(i):
                     i += 1
 
-            self._insert(node.children[i], key)
+            if not self._insert(node.children[i], key):
+                return False
+
+            node.size += 1
+            return True
+
+        node.size += 1
+        self._len += 1
+        return True
+
+    def _key(self, key):
+        if self._codec is None:
+            return _BTreeKey(key)
+        else:
+            return _EncodedBTreeKey(self._codec, self._codec.encode(key))
+
+    def _queue(self, node):
+        node.rebalance = True
+        self._rebalance_queue[node] = None
+
+    def _range(self, node, bounds, low, high):
+        # bounds which end before they start hold no keys
+        (l, r) = node._range(bounds)
+        l = l if low else 0
+        r = r if high else len(node)
+        return l, max(l, r)
 
     def _rebalance(self, node):
-        return BTree(self._order, self._schema, node[:])._root
+        # the rebuilt subtree has no tombstones, so neither do its ancestors;
+        # the old subtree is detached, so that a rebuild of any of its nodes
+        # still queued does not count against them again
+        parent = node.parent
+        while parent is not None:
+            parent.tombstones -= node.tombstones
+            parent = parent.parent
+
+        node.parent = None
+
+        tree = BTree(
+            self._order, self._schema, node[:], False, self._codec,
+            self._compress_prefix, self._compact)
+        if self.metrics is not None:
+            self.metrics.count("rebalance_rows", len(tree))
+
+        return tree._root
+
+    def _repair_child(self, node, i):
+        # after a range delete, child i may be left with a single child of
+        # its own, with no keys, or with too few keys
+        child = node.children[i]
+        while not child.leaf and not len(child):
+            self._unqueue(child)
+            child = child.children[0]
+
+        child.parent = node
+        node.children[i] = child
+        if child.leaf and not len(child):
+            self._drop_child(node, i)
+        elif len(child) < math.ceil(self._order / 2) and len(node):
+            j = i if i < len(node) else i - 1
+            if node.children[j].leaf == node.children[j + 1].leaf:
+                self._merge_children(node, j)
+            else:
+                # a leaf and an internal node cannot be merged, so the next
+                # rebalance rebuilds the child instead
+                self._rebalance_queue[child] = None
+
+    def _remove(self, node, prefixes):
+        if self.metrics is not None:
+            self.metrics.count("nodes_visited")
+
+        children = {}
+        for prefix in prefixes:
+            (l, r) = node._range(prefix)
+            for i in range(l, r):
+                if not node.is_deleted(i):
+                    self._tombstone(node, i)
+
+            if not node.leaf:
+                for i in range(l, r + 1):
+                    children.setdefault(i, []).append(prefix)
+
+        for (i, child_prefixes) in children.items():
+            self._remove(node.children[i], child_prefixes)
 
     def _split_child(self, node, i):
+        if self.metrics is not None:
+            self.metrics.count("splits")
+
         order = self._order
         child = node.children[i]
-        new_node = _BTreeNode(node, child.leaf)
+        new_node = self._node(node, child.leaf)
 
         node.children.insert(i + 1, new_node)
-        node.keys.insert(i, child.keys[order - 1])
+        node.insert(i, child.entry(order - 1))
 
-        new_node.keys = child.keys[order:]
-        child.keys = child.keys[0:(order - 1)]
+        new_node.set_entries(child.entries(order))
+        child.set_entries(child.entries(0, order - 1))
 
         if not child.leaf:
             new_node.children = child.children[order:]
@@ -276,3 +1137,45 @@ class BTree(object):
             for node in child.children:
                 node.parent = child
 
+        child.recount()
+        new_node.recount()
+
+    def _take_key(self, node, first):
+        # removes the first or the last live key of a subtree from its leaf,
+        # unless that would leave the leaf empty; tombstones before it go too
+        top = node
+        while not node.leaf:
+            node = node.children[0 if first else -1]
+
+        entries = node.entries() if first else node.entries()[::-1]
+        tombstones = 0
+        while tombstones < len(entries) and entries[tombstones].deleted:
+            tombstones += 1
+
+        if len(entries) - tombstones < 2:
+            return None
+
+        entries = entries[tombstones:]
+        entry = entries.pop(0)
+        node.set_entries(entries if first else entries[::-1])
+        while node is not top.parent:
+            node.size -= 1
+            node.tombstones -= tombstones
+            node = node.parent
+
+        return entry
+
+    def _tombstone(self, node, i):
+        if self.metrics is not None:
+            self.metrics.count("tombstones_created")
+
+        node.set_deleted(i, True)
+        self._queue(node)
+        self._len -= 1
+        while node is not None:
+            node.size -= 1
+            node.tombstones += 1
+            node = node.parent
+
+    def _unqueue(self, node):
+        self._rebalance_queue.pop(node, None)
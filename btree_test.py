@@ -3,20 +3,33 @@ import math
 import random
 
 from btree import BTree
+from codec import KeyCodec
 from collections import deque
 
 
 def assert_valid(tree):
+    try:
+        _assert_valid(tree)
+    except AssertionError:
+        print()
+        print("BEGIN TREE")
+        print(tree)
+        print("END TREE")
+        print()
+        raise
+
+
+def _assert_valid(tree):
+    # keys are compared as tuples, since an encoded key only compares with
+    # another encoded key
+    def keys_of(node):
+        return [tuple(node.key(i)) for i in range(len(node))]
+
     root = tree._root
     order = tree._order
 
-    print()
-    print("BEGIN TREE")
-    print(tree)
-    print("END TREE")
-    print()
-
-    assert root.keys == sorted(list(k) for k in root.keys)
+    keys = keys_of(root)
+    assert keys == sorted(keys)
     assert len(root.children) <= (2 * order)
     if not root.leaf:
         assert len(root.children) >= 2
@@ -24,24 +37,35 @@ def assert_valid(tree):
     unvisited = deque(root.children)
     while unvisited:
         node = unvisited.popleft()
+        keys = keys_of(node)
 
-        assert node.keys
-        assert node.keys == sorted(list(k) for k in node.keys)
+        assert keys
+        assert keys == sorted(keys)
         assert len(node.children) <= (2 * order)
         if node.leaf:
             assert not node.children
         else:
-            assert len(node.children) == len(node.keys) + 1
+            assert len(node.children) == len(keys) + 1
             assert len(node.children) >= math.ceil(order / 2)
 
-            for i in range(len(node.keys)):
-                assert node.children[i].keys
-                assert node.children[i + 1].keys
-                assert node.children[i].keys[-1] <= node.keys[i]
-                assert node.children[i + 1].keys[0] >= node.keys[i]
+            for i in range(len(keys)):
+                assert len(node.children[i])
+                assert len(node.children[i + 1])
+                assert keys_of(node.children[i])[-1] <= keys[i]
+                assert keys_of(node.children[i + 1])[0] >= keys[i]
 
         unvisited.extend(node.children)
 
+    # the running count of tombstones matches the deleted keys in the tree
+    tombstones = 0
+    unvisited = deque([root])
+    while unvisited:
+        node = unvisited.popleft()
+        tombstones += sum(node.is_deleted(i) for i in range(len(node)))
+        unvisited.extend(node.children)
+
+    assert tree.stats()["tombstones"] == tombstones
+
 
 def test_search(tree, validate):
     present = set()
@@ -136,6 +160,97 @@ def test_delete(tree, validate):
         assert len(list(tree[[i]])) == 0
 
 
+def test_delete_range(tree, validate):
+    present = set()
+    for i in range(20):
+        for j in range(30):
+            tree.insert([i, j])
+            present.add((i, j))
+
+    for key in [[3, 3], [3, 4], [7, 0], [12, 29]]:
+        del tree[key]
+        present.discard(tuple(key))
+
+    tree.delete_range([5])
+    if validate:
+        assert_valid(tree)
+
+    present = set(k for k in present if k[0] != 5)
+    assert list(tree) == sorted(present)
+    assert len(tree) == len(present)
+
+    tree.delete_range(slice([2, 10], [8, 5]))
+    if validate:
+        assert_valid(tree)
+
+    present = set(k for k in present if not (2, 10) <= k < (8, 5))
+    assert list(tree) == sorted(present)
+    assert list(tree.select(slice(None), reverse=True)) == sorted(present, reverse=True)
+    assert len(tree) == len(present)
+
+    tree.delete_range(slice([15], None))
+    if validate:
+        assert_valid(tree)
+
+    present = set(k for k in present if k[0] < 15)
+    assert list(tree) == sorted(present)
+
+    for j in range(5):
+        tree.insert([6, j])
+        present.add((6, j))
+
+    tree.rebalance()
+    if validate:
+        assert_valid(tree)
+
+    assert list(tree) == sorted(present)
+    assert len(tree) == len(present)
+
+    removed = sorted(present)[::3] + [(6, 99), (30, 0)]
+    tree.remove([list(key) for key in removed] + [[7]])
+    if validate:
+        assert_valid(tree)
+
+    present = set(k for k in present if k not in removed and k[0] != 7)
+    assert list(tree) == sorted(present)
+    assert len(tree) == len(present)
+
+    tree.delete_range(slice(None))
+    assert len(tree) == 0 and list(tree) == []
+    assert not tree._rebalance_queue
+
+
+def test_sample(tree, validate):
+    present = set()
+    for i in random.Random(0).sample(range(400), 400):
+        tree.insert([i // 20, i % 20])
+        present.add((i // 20, i % 20))
+
+    for i in range(0, 400, 7):
+        del tree[[i // 20, i % 20]]
+        present.discard((i // 20, i % 20))
+
+    tree.delete_range([13])
+    present = set(k for k in present if k[0] != 13)
+
+    rng = random.Random(1)
+    for bounds in ([], [4], slice([2, 5], [9, 11]), slice([16], None), slice([7], [3])):
+        if isinstance(bounds, slice):
+            expected = [
+                k for k in sorted(present)
+                if (bounds.start is None or list(k) >= bounds.start) and
+                (bounds.stop is None or list(k) < bounds.stop)]
+        else:
+            expected = [k for k in sorted(present) if list(k[:len(bounds)]) == bounds]
+
+        assert tree.count(bounds) == len(expected)
+        assert sorted(tree.sample(bounds, 1000, rng)) == expected
+
+        sample = tree.sample(bounds, 10, rng)
+        assert len(sample) == min(10, len(expected))
+        assert sample == sorted(set(sample)) and set(sample) <= set(expected)
+
+
 def test_compound_keys(tree, validate):
     for i in range(10):
         for j in range(10):
@@ -184,8 +299,145 @@ def test_reverse_ordering(tree, validate):
     assert list(tree.select(slice([1], [2]), reverse=True)) == expected
 
 
-def run_test(test, order, schema, validate = False):
-    test(BTree(order, schema), validate)
+def test_replace(tree, validate):
+    for i in range(100):
+        tree.insert([i, i, 0])
+
+    for i in range(0, 100, 2):
+        assert tree.replace([i, i], [i, i, 1]) == 1
+        if validate:
+            assert_valid(tree)
+
+    assert tree.replace([100, 100], [100, 100, 1]) == 0
+    assert not tree._rebalance_queue
+    assert len(tree) == 100
+    assert list(tree) == [(i, i, (i + 1) % 2) for i in range(100)]
+
+    try:
+        tree.replace([1, 1], [1, 2, 1])
+        assert False
+    except ValueError:
+        pass
+
+    try:
+        tree.replace([1], [1, 1, 1])
+    except IndexError:
+        assert False
+
+    for i in range(10):
+        tree.insert([1, 2, 0])
+
+    try:
+        tree.replace([1], [1, 1, 1])
+        assert False
+    except IndexError:
+        pass
+
+
+def test_presorted(tree, validate):
+    keys = sorted(random.sample(range(-1000, 1000), 500))
+    keys = [(key,) for key in keys]
+    tree = BTree(
+        tree._order, tree._schema, keys + keys[-1:], True, tree._codec,
+        tree._compress_prefix, tree._compact)
+    if validate:
+        assert_valid(tree)
+
+    assert len(tree) == len(keys)
+    assert list(tree) == keys
+
+    for i in range(-1000, 1000, 10):
+        tree.insert([i])
+
+    for key in keys[::10]:
+        del tree[key]
+
+    tree.rebalance()
+    if validate:
+        assert_valid(tree)
+
+    expected = set(keys) | set((i,) for i in range(-1000, 1000, 10))
+    expected -= set(keys[::10])
+    assert list(tree) == sorted(expected)
+    assert len(tree) == len(expected)
+
+    try:
+        BTree(tree._order, tree._schema, [[2], [1]], presorted=True)
+        assert False
+    except ValueError:
+        pass
+
+
+def test_prefix_compression(tree, validate):
+    for i in range(20):
+        for j in range(20):
+            tree.insert(["node", i % 4, i, j])
+            if validate:
+                assert_valid(tree)
+
+    memory = tree.key_memory()
+    if tree._order >= 5:
+        assert memory["stored"] < memory["uncompressed"]
+
+    assert len(list(tree[["node"]])) == 400
+    assert len(list(tree[["node", 1]])) == 100
+    assert len(list(tree[["node", 1, 5]:["node", 1, 13]])) == 40
+    assert list(tree.select(slice(["node", 3, 7, 18], None), reverse=True))[:2] == [
+        ("node", 3, 19, 19), ("node", 3, 19, 18)]
+
+    for j in range(0, 20, 3):
+        tree.replace(["node", 2, 6, j], ["node", 2, 6, j])
+        del tree[["node", 2, 6, j]]
+
+    tree.insert(["edge", 0, 0, 0])
+    tree.rebalance()
+    if validate:
+        assert_valid(tree)
+
+    assert len(tree) == 394
+    assert list(tree)[0] == ("edge", 0, 0, 0)
+
+
+def test_compact(tree, validate):
+    for i in range(200):
+        tree.insert([i % 7, i / 4])
+        if validate:
+            assert_valid(tree)
+
+    memory = tree.key_memory()
+    assert memory["stored"] == 200 * 16
+
+    assert list(tree[[3]]) == [(3, i / 4) for i in range(3, 200, 7)]
+    assert list(tree[[3, 0.75]]) == [(3, 0.75)]
+    assert len(list(tree[[2, 10.]:[4]])) == len([i for i in range(200) if (
+        (i % 7, i / 4) >= (2, 10.) and i % 7 < 4)])
+
+    for i in range(0, 200, 2):
+        del tree[[i % 7, i / 4]]
+
+    tree.replace([1, 2.0], [1, 2.0])
+    tree.insert([1, 0.5])
+    tree.rebalance()
+    if validate:
+        assert_valid(tree)
+
+    assert len(tree) == 101
+    assert list(tree)[:2] == [(0, 1.75), (0, 5.25)]
+
+    try:
+        BTree(tree._order, (int, str), compact=True)
+        assert False
+    except TypeError:
+        pass
+
+
+def run_test(
+        test, order, schema, validate = False, binary = False, compress_prefix = False,
+        compact = False):
+
+    codec = KeyCodec(schema) if binary else None
+    tree = BTree(order, schema, codec=codec, compress_prefix=compress_prefix, compact=compact)
+    test(tree, validate)
 
 
 if __name__ == "__main__":
@@ -195,7 +447,39 @@ if __name__ == "__main__":
         run_test(test_iteration, order, (int,))
         run_test(test_delete, order, (int,))
         run_test(test_compound_keys, order, (int, int))
+        run_test(test_delete_range, order, (int, int))
+        run_test(test_sample, order, (int, int))
         run_test(test_slicing, order, (int, int))
         run_test(test_reverse_ordering, order, (int, int, int))
+        run_test(test_replace, order, (int, int, int))
+        run_test(test_presorted, order, (int,))
+        for options in ({"binary": True}, {"compress_prefix": True}, {"compact": True}):
+            run_test(test_delete, order, (int,), **options)
+            run_test(test_compound_keys, order, (int, int), **options)
+            run_test(test_delete_range, order, (int, int), **options)
+            run_test(test_sample, order, (int, int), **options)
+            run_test(test_slicing, order, (int, int), **options)
+            run_test(test_reverse_ordering, order, (int, int, int), **options)
+            run_test(test_replace, order, (int, int, int), **options)
+            run_test(test_presorted, order, (int,), **options)
+
+        run_test(test_prefix_compression, order, (str, int, int, int), compress_prefix=True)
+        run_test(test_compact, order, (int, float), compact=True)
         print("pass: {}".format(order))
 
+    # small trees split, merge and drop nodes most often, so their structure
+    # is checked after every change, in each layout of the keys
+    for order in range(2, 6):
+        for options in ({}, {"binary": True}, {"compress_prefix": True}, {"compact": True}):
+            run_test(test_delete, order, (int,), True, **options)
+            run_test(test_compound_keys, order, (int, int), True, **options)
+            run_test(test_delete_range, order, (int, int), True, **options)
+            run_test(test_replace, order, (int, int, int), True, **options)
+            run_test(test_presorted, order, (int,), True, **options)
+
+        run_test(test_search, order, (int,), True)
+        run_test(test_duplicate_keys, order, (int,), True)
+        run_test(test_prefix_compression, order, (str, int, int, int), True, compress_prefix=True)
+        run_test(test_compact, order, (int, float), True, compact=True)
+        print("valid: {}".format(order))
+
@@ -0,0 +1,222 @@
+import struct
+
+# an order-preserving ("memcmp-comparable") binary encoding of keys:
+# for two keys a and b of the same schema, encode(a) < encode(b) exactly when
+# a < b, and every column encoding is self-delimiting, so the encoding of a
+# key prefix is a byte prefix of the encoding of every key which shares it
+
+
+class KeyCodec(object):
+    def __init__(self, schema):
+        assert schema and schema == tuple(schema)
+
+        self._schema = schema
+        self._columns = tuple(column_codec(ctr) for ctr in schema)
+
+    def __len__(self):
+        return len(self._schema)
+
+    def decode(self, data):
+        key = []
+        pos = 0
+        for (ctr, (_encode, decode)) in zip(self._schema, self._columns):
+            if pos == len(data):
+                break
+
+            value, pos = decode(data, pos)
+            key.append(ctr(value))
+
+        if pos != len(data):
+            raise ValueError("trailing bytes in encoded key")
+
+        return tuple(key)
+
+    def encode(self, key):
+        if len(key) > len(self._schema):
+            raise IndexError
+
+        out = bytearray()
+        for i in range(len(key)):
+            encode, _decode = self._columns[i]
+            encode(self._schema[i](key[i]), out)
+
+        return bytes(out)
+
+
+def column_codec(ctr):
+    if ctr not in _COLUMNS:
+        raise TypeError("no binary encoding for {}".format(ctr))
+
+    return _COLUMNS[ctr]
+
+
+def encode_value(value):
+    out = bytearray()
+    _encode_tagged(value, out)
+    return bytes(out)
+
+
+def decode_value(data):
+    value, pos = _decode_tagged(data, 0)
+    if pos != len(data):
+        raise ValueError("trailing bytes in encoded value")
+
+    return value
+
+
+def successor(prefix):
+    # the least byte string which is greater than every string with this prefix
+    prefix = prefix.rstrip(b"\xff")
+    if not prefix:
+        return None
+
+    return prefix[:-1] + bytes([prefix[-1] + 1])
+
+
+def _encode_int(value, out):
+    if value >= 0:
+        size = (value.bit_length() + 7) // 8
+        if size > 126:
+            raise OverflowError(value)
+
+        out.append(0x80 + size)
+        out += value.to_bytes(size, "big")
+    else:
+        size = ((-value).bit_length() + 7) // 8
+        if size > 126:
+            raise OverflowError(value)
+
+        out.append(0x7f - size)
+        out += ((1 << (8 * size)) - 1 + value).to_bytes(size, "big")
+
+
+def _decode_int(data, pos):
+    head = data[pos]
+    pos += 1
+    if head >= 0x80:
+        size = head - 0x80
+        return int.from_bytes(data[pos:pos + size], "big"), pos + size
+    else:
+        size = 0x7f - head
+        complement = int.from_bytes(data[pos:pos + size], "big")
+        return complement - ((1 << (8 * size)) - 1), pos + size
+
+
+_SIGN = 1 << 63
+_MASK = (1 << 64) - 1
+
+
+def _encode_float(value, out):
+    (bits,) = struct.unpack(">Q", struct.pack(">d", value + 0.0))
+    bits = (bits ^ _MASK) if bits & _SIGN else (bits | _SIGN)
+    out += bits.to_bytes(8, "big")
+
+
+def _decode_float(data, pos):
+    bits = int.from_bytes(data[pos:pos + 8], "big")
+    bits = (bits ^ _SIGN) if bits & _SIGN else (bits ^ _MASK)
+    (value,) = struct.unpack(">d", bits.to_bytes(8, "big"))
+    return value, pos + 8
+
+
+def _encode_complex(value, out):
+    _encode_float(value.real, out)
+    _encode_float(value.imag, out)
+
+
+def _decode_complex(data, pos):
+    real, pos = _decode_float(data, pos)
+    imag, pos = _decode_float(data, pos)
+    return complex(real, imag), pos
+
+
+def _encode_bytes(value, out):
+    # escape NUL as 00 ff and terminate with 00 01, so that a shorter string
+    # sorts before any longer string which it prefixes
+    out += bytes(value).replace(b"\x00", b"\x00\xff")
+    out += b"\x00\x01"
+
+
+def _decode_bytes(data, pos):
+    out = bytearray()
+    while True:
+        end = data.index(b"\x00", pos)
+        out += data[pos:end]
+        if data[end + 1] == 0xff:
+            out.append(0)
+            pos = end + 2
+        else:
+            return bytes(out), end + 2
+
+
+def _encode_str(value, out):
+    _encode_bytes(value.encode("utf-8", "surrogatepass"), out)
+
+
+def _decode_str(data, pos):
+    value, pos = _decode_bytes(data, pos)
+    return value.decode("utf-8", "surrogatepass"), pos
+
+
+def _encode_tuple(value, out):
+    for item in value:
+        _encode_tagged(item, out)
+
+    out.append(_END)
+
+
+def _decode_tuple(data, pos):
+    items = []
+    while data[pos] != _END:
+        item, pos = _decode_tagged(data, pos)
+        items.append(item)
+
+    return tuple(items), pos + 1
+
+
+# the elements of a tuple column have no declared type, so each one is
+# prefixed with a tag; values of different types order by tag, which differs
+# from Python only when comparing an int with a float at the same position
+_END = 0x00
+_TAGS = (
+    (type(None), 0x10, lambda value, out: None, lambda data, pos: (None, pos)),
+    (bool, 0x20, lambda value, out: out.append(int(value)),
+        lambda data, pos: (bool(data[pos]), pos + 1)),
+    (int, 0x30, _encode_int, _decode_int),
+    (float, 0x40, _encode_float, _decode_float),
+    (complex, 0x50, _encode_complex, _decode_complex),
+    (str, 0x60, _encode_str, _decode_str),
+    (bytes, 0x70, _encode_bytes, _decode_bytes),
+    (tuple, 0x80, _encode_tuple, _decode_tuple),
+)
+
+_ENCODE_TAGGED = {t: (tag, encode) for (t, tag, encode, _decode) in _TAGS}
+_DECODE_TAGGED = {tag: decode for (_t, tag, _encode, decode) in _TAGS}
+
+
+def _encode_tagged(value, out):
+    if type(value) not in _ENCODE_TAGGED:
+        raise TypeError("no binary encoding for {}".format(type(value)))
+
+    tag, encode = _ENCODE_TAGGED[type(value)]
+    out.append(tag)
+    encode(value, out)
+
+
+def _decode_tagged(data, pos):
+    tag = data[pos]
+    if tag not in _DECODE_TAGGED:
+        raise ValueError("unknown tag {}".format(tag))
+
+    return _DECODE_TAGGED[tag](data, pos + 1)
+
+
+_COLUMNS = {
+    bool: (_encode_int, _decode_int),
+    int: (_encode_int, _decode_int),
+    float: (_encode_float, _decode_float),
+    complex: (_encode_complex, _decode_complex),
+    str: (_encode_str, _decode_str),
+    bytes: (_encode_bytes, _decode_bytes),
+    tuple: (_encode_tuple, _decode_tuple),
+}
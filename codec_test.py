@@ -0,0 +1,45 @@
+import itertools
+import random
+
+from codec import KeyCodec, decode_value, encode_value, successor
+
+
+def test_round_trip():
+    codec = KeyCodec((int, float, str, bytes, complex, bool, tuple))
+    key = (-2 ** 80, -0.5, "a\x00b", b"\x00\xff", 1-2j, True, (1, ("two", 3.), None))
+    assert codec.decode(codec.encode(key)) == key
+
+    value = (1, "two", (3.,), None, False, b"", -4j)
+    assert decode_value(encode_value(value)) == value
+
+
+def test_order():
+    ints = [0, 1, -1, 127, 128, -128, -129, 255, 256, -256, 2 ** 64, -2 ** 64]
+    floats = [0., -1.5, 1.5, 1e-300, -1e-300, 1e300, float("inf"), float("-inf")]
+    strings = ["", "a", "a\x00", "a\x00b", "ab", "b", "\xe9"]
+    tuples = [(), (1,), (1, 2), (1, -2), (2,), (-3, 1)]
+
+    codec = KeyCodec((int, float, str, tuple))
+    keys = list(itertools.product(ints, floats, strings, tuples))
+    random.shuffle(keys)
+    assert sorted(keys, key=codec.encode) == sorted(keys)
+
+
+def test_prefix():
+    codec = KeyCodec((str, int))
+    keys = [(s, i) for s in ["a", "ab", "b"] for i in range(-300, 300, 7)]
+    prefix = codec.encode(["a"])
+    stop = successor(prefix)
+
+    matches = [key for key in keys if prefix <= codec.encode(key) < stop]
+    assert matches == [key for key in keys if key[0] == "a"]
+
+    assert successor(b"\x01\xff") == b"\x02"
+    assert successor(b"\xff") is None
+
+
+if __name__ == "__main__":
+    test_round_trip()
+    test_order()
+    test_prefix()
+    print("PASS")
@@ -0,0 +1,114 @@
+import heapq
+import pickle
+import tempfile
+
+
+class ExternalSort(object):
+    def __init__(self, run_size=100000, key=None, reverse=False, fan_in=64):
+        assert run_size > 0
+        assert fan_in >= 2
+
+        self._run_size = run_size
+        self._key = key
+        self._reverse = reverse
+        self._fan_in = fan_in
+        self._run = []
+        self._levels = []
+        self._len = 0
+
+    def __iter__(self):
+        runs = [iter(run) for level in self._levels for run in level]
+        self._levels = []
+
+        run = sorted(self._run, key=self._key, reverse=self._reverse)
+        self._run = []
+        if not runs:
+            yield from run
+            return
+
+        runs.append(iter(run))
+        yield from heapq.merge(*runs, key=self._key, reverse=self._reverse)
+
+    def __len__(self):
+        return self._len
+
+    def add(self, item):
+        self._run.append(item)
+        self._len += 1
+
+        if len(self._run) >= self._run_size:
+            self._run.sort(key=self._key, reverse=self._reverse)
+            self._spill(0, self._run)
+            self._run = []
+
+    def extend(self, items):
+        for item in items:
+            self.add(item)
+
+    def _spill(self, level, items):
+        while len(self._levels) <= level:
+            self._levels.append([])
+
+        self._levels[level].append(_write_run(items))
+
+        # merge a full level into a single run one level up, so that the
+        # number of open run files stays bounded by fan_in per level
+        if len(self._levels[level]) == self._fan_in:
+            runs = [iter(run) for run in self._levels[level]]
+            self._levels[level] = []
+            merged = heapq.merge(*runs, key=self._key, reverse=self._reverse)
+            self._spill(level + 1, merged)
+
+
+def external_sort(items, run_size=100000, key=None, reverse=False):
+    runs = ExternalSort(run_size, key, reverse)
+    runs.extend(items)
+    yield from runs
+
+
+_BATCH_SIZE = 1024
+
+
+class SpillFile(object):
+    # items appended to a temporary file in pickled batches, which can be read
+    # back once, in the order they were added
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+        self._batch = []
+        self._len = 0
+
+    def __iter__(self):
+        self._flush()
+        self._file.seek(0)
+        try:
+            while True:
+                try:
+                    batch = pickle.load(self._file)
+                except EOFError:
+                    return
+
+                yield from batch
+        finally:
+            self._file.close()
+
+    def __len__(self):
+        return self._len
+
+    def add(self, item):
+        self._batch.append(item)
+        self._len += 1
+        if len(self._batch) == _BATCH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if self._batch:
+            pickle.dump(self._batch, self._file, pickle.HIGHEST_PROTOCOL)
+            self._batch = []
+
+
+def _write_run(items):
+    run = SpillFile()
+    for item in items:
+        run.add(item)
+
+    return run
@@ -0,0 +1,29 @@
+import random
+
+from extsort import ExternalSort, external_sort
+
+
+def test_in_memory():
+    items = [random.random() for _ in range(100)]
+    assert list(external_sort(items)) == sorted(items)
+
+
+def test_spill():
+    items = [random.randint(0, 1000) for _ in range(5000)]
+    runs = ExternalSort(run_size=10, fan_in=3)
+    runs.extend(items)
+    assert len(runs) == 5000
+    assert list(runs) == sorted(items)
+
+
+def test_key():
+    items = [(random.randint(0, 10), i) for i in range(1000)]
+    actual = list(external_sort(items, 50, key=lambda item: item[0], reverse=True))
+    assert actual == sorted(items, key=lambda item: item[0], reverse=True)
+
+
+if __name__ == "__main__":
+    test_in_memory()
+    test_spill()
+    test_key()
+    print("PASS")
@@ -0,0 +1,324 @@
+import bisect
+import heapq
+import itertools
+import threading
+import zlib
+
+from btree import converter
+from codec import encode_value
+from concurrent.futures import ThreadPoolExecutor
+from extsort import SpillFile
+from table import Index, MergeSelection, Selection, Table
+
+# a table whose rows are split across independent Tables, either by ranges of
+# the primary key or by a hash of a key prefix; each partition has its own trees
+# and indices, so that point operations touch only one of them
+
+
+class PartitionedTable(Selection):
+    def __init__(self, schema, boundaries=None, partitions=None, hash_prefix=None, **options):
+        if (boundaries is None) == (partitions is None):
+            raise ValueError("partition either by boundaries or by hash")
+
+        super().__init__(None)
+        self._schema = schema
+        self._options = options
+        self._indices = {}
+        self._lock = threading.RLock()
+
+        ctrs = tuple(c.ctr for c in schema.key)
+        self._convert_key = converter(ctrs)
+        if partitions is None:
+            # partition i holds the keys from boundaries[i - 1] up to, but not
+            # including, boundaries[i]; a boundary may be a key prefix
+            boundaries = [
+                tuple(ctr(v) for (ctr, v) in zip(ctrs, boundary)) for boundary in boundaries]
+            if any(not b for b in boundaries) or boundaries != sorted(set(boundaries)):
+                raise ValueError("boundaries must be distinct, non-empty and sorted")
+
+            self._boundaries = boundaries
+            self._hash_prefix = None
+            partitions = len(boundaries) + 1
+        else:
+            if partitions < 1:
+                raise ValueError("partitions must be positive")
+
+            self._boundaries = None
+            self._hash_prefix = len(schema.key) if hash_prefix is None else hash_prefix
+            assert 0 < self._hash_prefix <= len(schema.key)
+
+        self._partitions = [self._new_partition() for _ in range(partitions)]
+
+    def __iter__(self):
+        yield from self._merge(self._partitions, self._schema.key_names())
+
+    def __len__(self):
+        return sum(len(partition) for partition in self._partitions)
+
+    def add_index(self, name, key_columns, include=(), hashed=False):
+        with self._lock:
+            if name in self._indices:
+                raise ValueError
+
+            for partition in self._partitions:
+                partition.add_index(name, key_columns, include, hashed)
+
+            self._indices[name] = (tuple(key_columns), tuple(include), hashed)
+
+    def boundaries(self):
+        return None if self._boundaries is None else list(self._boundaries)
+
+    def bulk_insert(self, rows, run_size=100000):
+        key_len = len(self._schema.key)
+        with self._lock:
+            # the rows of each partition spill to disk until all are routed
+            grouped = [SpillFile() for _ in self._partitions]
+            for row in rows:
+                grouped[self._route(row[:key_len])].add(row)
+
+            for (partition, rows) in zip(self._partitions, grouped):
+                if len(rows):
+                    partition.bulk_insert(rows, run_size)
+
+    def delete(self):
+        with self._lock:
+            for partition in self._partitions:
+                partition.delete()
+
+    def insert(self, row):
+        with self._lock:
+            self._partition(row[:len(self._schema.key)]).insert(row)
+
+    def map(self, function, bounds=None, workers=None):
+        # applies the function to every partition which may hold rows within
+        # the bounds, on a pool of threads, and returns the results in
+        # partition order
+        partitions = self._partitions_for(bounds or {})
+        if bounds:
+            partitions = [partition.slice(bounds) for partition in partitions]
+
+        if not partitions:
+            return []
+
+        with ThreadPoolExecutor(workers or len(partitions)) as pool:
+            return list(pool.map(function, partitions))
+
+    def merge(self, i):
+        # joins range partition i with the one after it
+        with self._lock:
+            if self._boundaries is None:
+                raise ValueError("only range partitions can be merged")
+            elif not 0 <= i < len(self._boundaries):
+                raise IndexError
+
+            left, right = self._partitions[i:i + 2]
+            merged = self._new_partition(itertools.chain(left, right))
+            self._partitions = self._partitions[:i] + [merged] + self._partitions[i + 2:]
+            self._boundaries = self._boundaries[:i] + self._boundaries[i + 1:]
+
+    def order_by(self, columns, reverse=False):
+        # an order which an index serves comes in the order of its whole key,
+        # and a sorted one by the columns and then the primary key
+        partition = self._partitions[0]
+        selection, residual = partition._plan_order(list(columns))
+        order = columns
+        if not residual and partition.supports_order(list(columns)):
+            order = self._index_order(selection)
+
+        partitions = self._partitions
+        return MergedSelection(
+            self, [partition.order_by(columns, reverse) for partition in partitions],
+            order, reverse)
+
+    def partitions(self):
+        return list(self._partitions)
+
+    def rebalance(self):
+        with self._lock:
+            for partition in self._partitions:
+                partition.rebalance()
+
+    def schema(self):
+        return self._schema
+
+    def slice(self, bounds):
+        if not self.supports_bounds(bounds):
+            raise IndexError
+
+        # each partition yields rows in the order of the index which serves
+        # the bounds, which every partition plans alike
+        partition = self._partitions[0]
+        selection, _residual = partition._plan_bounds(partition._normalize_bounds(bounds))
+        columns = self._index_order(selection)
+        partitions = self._partitions_for(bounds)
+        return MergedSelection(
+            self, [partition.slice(bounds) for partition in partitions], columns)
+
+    def split(self, i, boundary=None):
+        # splits range partition i in two at the boundary, by default at its
+        # median key; rows are copied into two new partitions, so that scans
+        # already running over the old one are not disturbed
+        with self._lock:
+            if self._boundaries is None:
+                raise ValueError("only range partitions can be split")
+            elif not 0 <= i < len(self._partitions):
+                raise IndexError
+
+            partition = self._partitions[i]
+            key_len = len(self._schema.key)
+            if boundary is None:
+                if len(partition) < 2:
+                    raise ValueError("too few rows to split")
+
+                row = next(itertools.islice(partition, len(partition) // 2, None))
+                boundary = tuple(row[:key_len])
+            else:
+                boundary = tuple(
+                    c.ctr(v) for (c, v) in zip(self._schema.key, boundary))
+
+            low = self._boundaries[i - 1] if i > 0 else None
+            high = self._boundaries[i] if i < len(self._boundaries) else None
+            if not boundary or (low is not None and boundary <= low) or (
+                    high is not None and boundary >= high):
+                raise ValueError("{} is not within partition {}".format(boundary, i))
+
+            # the rows stream into the two partitions in order, the first
+            # row at or past the boundary being held over for the right one
+            rows = iter(partition)
+            held = []
+
+            def before():
+                for row in rows:
+                    if tuple(row[:len(boundary)]) >= boundary:
+                        held.append(row)
+                        return
+
+                    yield row
+
+            left = self._new_partition(before())
+            right = self._new_partition(itertools.chain(held, rows))
+            self._partitions = self._partitions[:i] + [left, right] + self._partitions[i + 1:]
+            self._boundaries = self._boundaries[:i] + [boundary] + self._boundaries[i:]
+
+    def supports_bounds(self, bounds):
+        partition = self._partitions[0]
+        return partition.supports_bounds(partition._normalize_bounds(bounds))
+
+    def supports_order(self, columns):
+        return self._partitions[0].supports_order(list(columns))
+
+    def upsert(self, key, value):
+        with self._lock:
+            self._partition(key).upsert(key, value)
+
+    def _delete_row(self, key):
+        with self._lock:
+            self._partition(key)._delete_row(key)
+
+    def _index_order(self, selection):
+        # the key columns of the index which drives a partition's plan
+        while isinstance(selection, MergeSelection):
+            selection = selection._right
+
+        return selection._source.schema().key_names()
+
+    def _merge(self, partitions, columns, reverse=False):
+        key_names = self._schema.key_names()
+        columns = list(columns) + [c for c in key_names if c not in columns]
+
+        # range partitions are already in order of any primary key prefix
+        if self._boundaries is not None and columns == key_names:
+            partitions = reversed(partitions) if reverse else partitions
+            return itertools.chain.from_iterable(partitions)
+
+        return heapq.merge(
+            *partitions, key=self._schema.projector(columns), reverse=reverse)
+
+    def _new_partition(self, rows=()):
+        partition = Table(Index(self._schema, rows, True, **self._options))
+        for (name, (key_columns, include, hashed)) in self._indices.items():
+            partition.add_index(name, key_columns, include, hashed)
+
+        return partition
+
+    def _partition(self, key):
+        if len(key) != len(self._schema.key):
+            raise IndexError
+
+        return self._partitions[self._route(key)]
+
+    def _partitions_for(self, bounds):
+        # the exact leading key columns, and a range on the next one
+        prefix = []
+        start = stop = None
+        for c in self._schema.key:
+            if c.name not in bounds:
+                break
+            elif isinstance(bounds[c.name], slice):
+                start = c.ctr(bounds[c.name].start) if bounds[c.name].start else None
+                stop = c.ctr(bounds[c.name].stop) if bounds[c.name].stop else None
+                break
+
+            prefix.append(c.ctr(bounds[c.name]))
+
+        prefix = tuple(prefix)
+        partitions = self._partitions
+        if self._boundaries is None:
+            if len(prefix) < self._hash_prefix:
+                return list(partitions)
+
+            return [partitions[self._hash(prefix[:self._hash_prefix])]]
+
+        # every matching key is at least low, and a partition starting at or
+        # past high holds none of them
+        low = prefix + (start,) if start is not None else prefix
+        high = prefix + (stop,) if stop is not None else None
+        selected = []
+        for i in range(len(partitions)):
+            lower = self._boundaries[i - 1] if i > 0 else None
+            upper = self._boundaries[i] if i < len(self._boundaries) else None
+            if upper is not None and upper <= low:
+                continue
+            elif lower is not None and high is not None and lower >= high:
+                continue
+            elif lower is not None and prefix and lower[:len(prefix)] > prefix:
+                continue
+
+            selected.append(partitions[i])
+
+        return selected
+
+    def _route(self, key):
+        key = self._convert_key(key)
+        if self._boundaries is not None:
+            return bisect.bisect_right(self._boundaries, key)
+
+        return self._hash(key[:self._hash_prefix])
+
+    def _hash(self, prefix):
+        # crc32 rather than hash(), which varies between processes for strings
+        return zlib.crc32(encode_value(prefix)) % len(self._partitions)
+
+    def _update_row(self, key, value):
+        with self._lock:
+            self._partition(key)._update_row(key, value)
+
+
+class MergedSelection(Selection):
+    def __init__(self, table, sources, columns, reverse=False):
+        super().__init__(sources)
+        self._table = table
+        self._columns = columns
+        self._reverse = reverse
+
+    def __iter__(self):
+        yield from self._table._merge(self._source, self._columns, self._reverse)
+
+    def schema(self):
+        return self._table.schema()
+
+    def _delete_row(self, key):
+        self._table._delete_row(key)
+
+    def _update_row(self, key, value):
+        self._table._update_row(key, value)
@@ -0,0 +1,137 @@
+import random
+
+from partition import PartitionedTable
+from table import Index, Schema, Table
+
+
+def new_schema():
+    return Schema((("a", int), ("b", int)), (("c", str),))
+
+
+def rows(n):
+    return [(i // 10, i % 10, str(i % 7)) for i in range(n)]
+
+
+def test_range():
+    t = PartitionedTable(new_schema(), boundaries=[(3,), (6, 5)])
+    t.add_index("c", ["c"])
+    shuffled = rows(100)
+    random.shuffle(shuffled)
+    for row in shuffled:
+        t.insert(row)
+
+    assert len(t) == 100
+    assert [len(p) for p in t.partitions()] == [30, 35, 35]
+    assert list(t) == rows(100)
+
+    # point operations and pruned ranges touch only the partitions which
+    # may hold matching keys
+    assert t._partitions_for({"a": 6, "b": 7}) == t.partitions()[2:]
+    assert t._partitions_for({"a": 6}) == t.partitions()[1:]
+    assert t._partitions_for({"a": slice(1, 3)}) == t.partitions()[:1]
+    assert t._partitions_for({"c": "1"}) == t.partitions()
+
+    assert list(t.slice({"a": 6, "b": slice(3, 7)})) == [(6, b, str((60 + b) % 7)) for b in range(3, 7)]
+    assert list(t.slice({"a": slice(2, 4)})) == rows(40)[20:]
+    assert list(t.slice({"c": "3"}).select(["a", "b"])) == [
+        (i // 10, i % 10) for i in range(3, 100, 7)]
+
+    assert list(t.order_by(["a", "b"], reverse=True)) == list(reversed(rows(100)))
+    by_c = list(t.order_by(["c"]))
+    assert by_c == sorted(rows(100), key=lambda row: (row[2], row[0], row[1]))
+
+    t.upsert((6, 6), ("x",))
+    t.slice({"a": 9}).delete()
+    t.slice({"a": 0}).update({"c": "y"})
+    assert len(t) == 90
+    assert list(t.slice({"c": "x"})) == [(6, 6, "x")]
+    assert len(list(t.slice({"c": "y"}))) == 10
+
+    assert sum(t.map(len)) == 90
+    assert t.map(lambda s: s.count(), {"a": 6}) == [5, 5]
+
+    try:
+        t.insert((6, 6, "z"))
+        assert False
+    except ValueError:
+        pass
+
+
+def test_split_merge():
+    t = PartitionedTable(new_schema(), boundaries=[])
+    t.add_index("c", ["c"])
+    t.bulk_insert(rows(100))
+
+    t.split(0)
+    assert t.boundaries() == [(5, 0)]
+    assert [len(p) for p in t.partitions()] == [50, 50]
+
+    t.split(1, (8,))
+    assert t.boundaries() == [(5, 0), (8,)]
+    assert [len(p) for p in t.partitions()] == [50, 30, 20]
+    assert list(t) == rows(100)
+    assert len(list(t.slice({"c": "2"}))) == 14
+
+    try:
+        t.split(1, (9,))
+        assert False
+    except ValueError:
+        pass
+
+    t.merge(0)
+    assert t.boundaries() == [(8,)]
+    assert [len(p) for p in t.partitions()] == [80, 20]
+    assert list(t) == rows(100)
+
+    t.insert((100, 0, "0"))
+    assert len(t.partitions()[1]) == 21
+
+
+def test_hash():
+    t = PartitionedTable(new_schema(), partitions=4, hash_prefix=1)
+    t.bulk_insert(rows(200))
+    assert sorted(len(p) for p in t.partitions())[0] > 0
+    assert list(t) == rows(200)
+
+    # every row sharing a hashed prefix lives in one partition
+    assert len(t._partitions_for({"a": 3})) == 1
+    assert len(t._partitions_for({"a": slice(3, 5)})) == 4
+    assert list(t.slice({"a": 3})) == rows(40)[30:]
+    assert list(t.slice({"a": slice(3, 5)})) == rows(50)[30:]
+
+    try:
+        t.split(0)
+        assert False
+    except ValueError:
+        pass
+
+
+def test_composite_index():
+    # partitions are merged by the whole key of the index which serves a
+    # query, so that they come out as from a single table
+    schema = Schema((("a", int), ("b", int)), (("c", str), ("v", int)))
+    shuffled = [(i // 10, i % 10, str(i % 3), (i * 7) % 11) for i in range(300)]
+    random.Random(1).shuffle(shuffled)
+    single = Table(Index(schema))
+    single.add_index("cv", ["c", "v"])
+    single.bulk_insert(shuffled)
+    for t in (
+            PartitionedTable(schema, boundaries=[(10,), (20,)]),
+            PartitionedTable(schema, partitions=3)):
+        t.add_index("cv", ["c", "v"])
+        t.bulk_insert(shuffled)
+
+        assert list(t.slice({"c": "1"})) == list(single.slice({"c": "1"}))
+        assert list(t.slice({"c": "2", "v": slice(3, 8)})) == list(
+            single.slice({"c": "2", "v": slice(3, 8)}))
+        assert list(t.order_by(["c"])) == list(single.order_by(["c"]))
+        assert list(t.order_by(["c"], reverse=True)) == list(single.order_by(["c"], reverse=True))
+        assert list(t.order_by(["v"])) == list(single.order_by(["v"]))
+
+
+if __name__ == "__main__":
+    test_range()
+    test_split_merge()
+    test_hash()
+    test_composite_index()
+    print("PASS")
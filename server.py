@@ -0,0 +1,376 @@
+import operator
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+
+from codec import decode_value, encode_value
+
+# a server which shares named Tables with other processes over a Unix domain
+# socket; every message is a frame of a 4 byte length and a tagged codec value
+#
+#   request:  (id, table, operation, arguments)
+#   response: (id, "rows", batch of rows), repeated for queries, and then
+#             (id, "done", result) or (id, "error", (exception name, message))
+#
+# a connection answers its requests in order, so a client may send several
+# before reading any responses
+
+_LENGTH = struct.Struct(">I")
+_BATCH_SIZE = 256
+_QUERIES = ("filter", "order_by", "slice")
+
+_CONDITIONS = {
+    "==": operator.eq, "!=": operator.ne, "<": operator.lt,
+    "<=": operator.le, ">": operator.gt, ">=": operator.ge,
+}
+
+_ERRORS = {
+    error.__name__: error
+    for error in (IndexError, KeyError, NotImplementedError, TypeError, ValueError)}
+
+
+class TableServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, tables, batch_size=_BATCH_SIZE):
+        self.tables = dict(tables)
+        self.batch_size = batch_size
+
+        # Tables are not thread safe, so each serves one request at a time
+        self.locks = {name: threading.Lock() for name in self.tables}
+        super().__init__(path, _TableHandler)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+class _TableHandler(socketserver.StreamRequestHandler):
+    wbufsize = 1 << 16
+
+    def handle(self):
+        try:
+            while True:
+                frame = _read_frame(self.rfile)
+                if frame is None:
+                    return
+
+                (request_id, name, operation, arguments) = decode_value(frame)
+                try:
+                    result = self._dispatch(request_id, name, operation, arguments)
+                except ConnectionError:
+                    raise
+                except Exception as e:
+                    self._respond(request_id, "error", (type(e).__name__, str(e)))
+                else:
+                    self._respond(request_id, "done", result)
+
+                self.wfile.flush()
+        except ConnectionError:
+            # the client went away, e.g. abandoning a query part way through
+            # its rows, so there is no one left to answer
+            return
+
+    def finish(self):
+        try:
+            super().finish()
+        except ConnectionError:
+            # the responses still buffered for a client which went away
+            self.rfile.close()
+
+    def _dispatch(self, request_id, name, operation, arguments):
+        if name not in self.server.tables:
+            raise KeyError("no table named {}".format(name))
+
+        table = self.server.tables[name]
+        with self.server.locks[name]:
+            if operation == "insert":
+                (row,) = arguments
+                table.insert(row)
+            elif operation == "upsert":
+                (key, value) = arguments
+                table.upsert(key, value)
+            elif operation in _QUERIES:
+                count = 0
+                batch = []
+                for row in _query(table, operation, arguments):
+                    batch.append(row)
+                    if len(batch) == self.server.batch_size:
+                        self._respond(request_id, "rows", tuple(batch))
+                        count += len(batch)
+                        batch = []
+
+                if batch:
+                    self._respond(request_id, "rows", tuple(batch))
+                    count += len(batch)
+
+                return count
+            else:
+                raise ValueError("unknown operation {}".format(operation))
+
+    def _respond(self, request_id, status, payload):
+        _write_frame(self.wfile, encode_value((request_id, status, payload)))
+
+
+class TableClient(object):
+    def __init__(self, path, pool_size=4):
+        self._path = path
+        self._pool = queue.LifoQueue(pool_size)
+        self._next_id = 0
+        self._id_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def filter(self, table, where):
+        return self._query(table, "filter", (_encode_where(where),))
+
+    def insert(self, table, row):
+        pipeline = self.pipeline()
+        pipeline.insert(table, row)
+        pipeline.execute()
+
+    def order_by(self, table, columns, reverse=False, where=()):
+        return self._query(table, "order_by", (tuple(columns), reverse, _encode_where(where)))
+
+    def pipeline(self):
+        return Pipeline(self)
+
+    def slice(self, table, bounds, where=()):
+        return self._query(table, "slice", (_encode_bounds(bounds), _encode_where(where)))
+
+    def upsert(self, table, key, value):
+        pipeline = self.pipeline()
+        pipeline.upsert(table, key, value)
+        pipeline.execute()
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return _Connection(self._path)
+
+    def _query(self, table, operation, arguments):
+        # rows are yielded as their batches arrive, and the connection goes
+        # back to the pool once the last one has been read
+        connection = self._acquire()
+        request_id = self._request_id()
+        error = None
+        try:
+            connection.send([(request_id, table, operation, arguments)])
+            while True:
+                (status, payload) = connection.receive(request_id)
+                if status == "rows":
+                    yield from payload
+                elif status == "done":
+                    break
+                else:
+                    error = _remote_error(payload)
+                    break
+        except BaseException:
+            # e.g. the rows were abandoned, so responses may still be in flight
+            connection.close()
+            raise
+
+        self._release(connection)
+        if error is not None:
+            raise error
+
+    def _release(self, connection):
+        try:
+            self._pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def _request_id(self):
+        with self._id_lock:
+            self._next_id += 1
+            return self._next_id
+
+
+class Pipeline(object):
+    # requests which are sent together and answered in order; execute returns
+    # a list of the rows of each query and None for each write, and raises
+    # the first error once every response has been read
+    def __init__(self, client):
+        self._client = client
+        self._requests = []
+
+    def __len__(self):
+        return len(self._requests)
+
+    def execute(self):
+        requests, self._requests = self._requests, []
+        if not requests:
+            return []
+
+        connection = self._client._acquire()
+        results = []
+        error = None
+        try:
+            connection.send(requests)
+            for (request_id, _table, operation, _arguments) in requests:
+                rows = []
+                while True:
+                    (status, payload) = connection.receive(request_id)
+                    if status == "rows":
+                        rows.extend(payload)
+                    elif status == "done":
+                        results.append(rows if operation in _QUERIES else payload)
+                        break
+                    else:
+                        results.append(None)
+                        error = error or _remote_error(payload)
+                        break
+        except BaseException:
+            connection.close()
+            raise
+
+        self._client._release(connection)
+        if error is not None:
+            raise error
+
+        return results
+
+    def filter(self, table, where):
+        self._add(table, "filter", (_encode_where(where),))
+
+    def insert(self, table, row):
+        self._add(table, "insert", (tuple(row),))
+
+    def order_by(self, table, columns, reverse=False, where=()):
+        self._add(table, "order_by", (tuple(columns), reverse, _encode_where(where)))
+
+    def slice(self, table, bounds, where=()):
+        self._add(table, "slice", (_encode_bounds(bounds), _encode_where(where)))
+
+    def upsert(self, table, key, value):
+        self._add(table, "upsert", (tuple(key), tuple(value)))
+
+    def _add(self, table, operation, arguments):
+        self._requests.append((self._client._request_id(), table, operation, arguments))
+
+
+class _Connection(object):
+    def __init__(self, path):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(path)
+        self._file = self._socket.makefile("rb")
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def receive(self, request_id):
+        frame = _read_frame(self._file)
+        if frame is None:
+            raise ConnectionError("the server closed the connection")
+
+        (response_id, status, payload) = decode_value(frame)
+        if response_id != request_id:
+            raise ConnectionError("response {} out of order".format(response_id))
+
+        return status, payload
+
+    def send(self, requests):
+        frames = bytearray()
+        for request in requests:
+            data = encode_value(request)
+            frames += _LENGTH.pack(len(data))
+            frames += data
+
+        self._socket.sendall(frames)
+
+
+def _remote_error(payload):
+    (name, message) = payload
+    return _ERRORS.get(name, RuntimeError)(message)
+
+
+def _encode_bounds(bounds):
+    encoded = []
+    for (column, bound) in bounds.items():
+        if isinstance(bound, slice):
+            encoded.append((column, ":", bound.start, bound.stop))
+        else:
+            encoded.append((column, "=", bound))
+
+    return tuple(encoded)
+
+
+def _decode_bounds(bounds):
+    decoded = {}
+    for bound in bounds:
+        if bound[1] == ":":
+            (column, _, start, stop) = bound
+            decoded[column] = slice(start, stop)
+        else:
+            (column, _, value) = bound
+            decoded[column] = value
+
+    return decoded
+
+
+def _encode_where(where):
+    # conditions which every row must meet, as (column, operator, value)
+    where = tuple(tuple(condition) for condition in where)
+    for (_column, condition, _value) in where:
+        if condition not in _CONDITIONS:
+            raise ValueError("unknown condition {}".format(condition))
+
+    return where
+
+
+def _query(table, operation, arguments):
+    if operation == "slice":
+        (bounds, where) = arguments
+        rows = table.slice(_decode_bounds(bounds))
+    elif operation == "order_by":
+        (columns, reverse, where) = arguments
+        rows = table.order_by(list(columns), reverse)
+    else:
+        (where,) = arguments
+        rows = table
+
+    if where:
+        columns = table.schema().column_names()
+        where = [
+            (columns.index(column), _CONDITIONS[condition], value)
+            for (column, condition, value) in where]
+        rows = (row for row in rows if all(test(row[i], value) for (i, test, value) in where))
+
+    return rows
+
+
+def _read_frame(f):
+    length = f.read(_LENGTH.size)
+    if not length:
+        return None
+    elif len(length) != _LENGTH.size:
+        raise ConnectionError("truncated frame")
+
+    (length,) = _LENGTH.unpack(length)
+    frame = f.read(length)
+    if len(frame) != length:
+        raise ConnectionError("truncated frame")
+
+    return frame
+
+
+def _write_frame(f, data):
+    f.write(_LENGTH.pack(len(data)))
+    f.write(data)
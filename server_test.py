@@ -0,0 +1,133 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from server import TableClient, TableServer
+from table import Index, Schema, Table
+
+
+def start_server(**kwargs):
+    t = Table(Index(Schema((("a", int), ("b", int)), (("c", str),))))
+    t.add_index("c", ["c"])
+    path = os.path.join(tempfile.mkdtemp(), "socket")
+    server = TableServer(path, {"t": t}, **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, path, t
+
+
+def test_operations():
+    server, path, t = start_server(batch_size=7)
+    try:
+        with TableClient(path) as client:
+            for i in range(50):
+                client.insert("t", (i // 10, i % 10, str(i % 3)))
+
+            client.upsert("t", (4, 9), ("x",))
+            assert len(t) == 50
+
+            assert list(client.slice("t", {"a": 2, "b": slice(3, 6)})) == [
+                (2, 3, "2"), (2, 4, "0"), (2, 5, "1")]
+            assert list(client.slice("t", {"c": "x"})) == [(4, 9, "x")]
+            assert list(client.slice("t", {"a": 1}, where=[("c", "==", "0")])) == [
+                (1, b, "0") for b in (2, 5, 8)]
+            assert list(client.order_by("t", ["a", "b"], reverse=True)) == list(reversed(list(t)))
+            assert len(list(client.order_by("t", ["c"]))) == 50
+            assert list(client.filter("t", [("b", ">=", 8), ("a", "<", 2)])) == [
+                (0, 8, "2"), (0, 9, "0"), (1, 8, "0"), (1, 9, "1")]
+
+            try:
+                client.insert("t", (0, 0, "0"))
+                assert False
+            except ValueError:
+                pass
+
+            try:
+                list(client.slice("u", {"a": 1}))
+                assert False
+            except KeyError:
+                pass
+
+            # errors leave the pooled connection usable
+            assert client._pool.qsize() == 1
+            assert len(list(client.slice("t", {"a": 0}))) == 10
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert not os.path.exists(path)
+
+
+def test_abandoned_query():
+    server, path, t = start_server()
+    errors = []
+    server.handle_error = lambda request, address: errors.append(sys.exc_info()[1])
+    try:
+        t.bulk_insert((i // 100, i % 100, "x" * 200) for i in range(20000))
+        with TableClient(path) as client:
+            # the connection closes with most of the rows still unsent
+            rows = client.slice("t", {"a": slice(0, None)})
+            assert next(rows) == (0, 0, "x" * 200)
+            rows.close()
+
+            # the abandoned query releases the table once its writes fail
+            assert len(list(client.slice("t", {"a": 3}))) == 100
+            time.sleep(0.1)
+            assert errors == []
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_pipeline():
+    server, path, t = start_server(batch_size=4)
+    try:
+        with TableClient(path, pool_size=2) as client:
+            pipeline = client.pipeline()
+            for i in range(20):
+                pipeline.insert("t", (i, 0, str(i % 2)))
+
+            pipeline.slice("t", {"c": "1"})
+            pipeline.upsert("t", (0, 0), ("2",))
+            pipeline.order_by("t", ["a", "b"], where=[("c", "!=", "1")])
+            assert len(pipeline) == 23
+
+            results = pipeline.execute()
+            assert results[:20] == [None] * 20
+            assert results[20] == [(i, 0, "1") for i in range(1, 20, 2)]
+            assert results[22] == [(0, 0, "2")] + [(i, 0, "0") for i in range(2, 20, 2)]
+
+            # the later requests still run when an earlier one fails
+            pipeline.insert("t", (0, 0, "0"))
+            pipeline.insert("t", (20, 0, "0"))
+            try:
+                pipeline.execute()
+                assert False
+            except ValueError:
+                pass
+
+            assert len(t) == 21
+
+            # an abandoned stream closes its connection rather than pooling it
+            rows = client.order_by("t", ["a", "b"])
+            assert next(rows) == (0, 0, "2")
+            rows.close()
+            assert client._pool.qsize() == 0
+
+            # concurrent streams use separate connections
+            first = client.slice("t", {"c": "0"})
+            second = client.slice("t", {"c": "1"})
+            assert len(list(zip(first, second))) == 10
+            assert list(first) == list(second) == []
+            assert client._pool.qsize() == 2
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    test_operations()
+    test_abandoned_query()
+    test_pipeline()
+    print("PASS")
@@ -0,0 +1,96 @@
+import os
+import struct
+
+from codec import decode_value, encode_value
+
+# a snapshot file is a magic string and a format version, a header value, and
+# then sections of rows; every part is stored as blocks, each a 4 byte length
+# followed by a tagged codec value, and an empty block ends each section, so
+# that a section can be read as a stream without knowing its length up front
+
+MAGIC = b"BTREESNAP"
+VERSION = 1
+
+_BATCH_SIZE = 1024
+_LENGTH = struct.Struct(">I")
+
+
+class SnapshotReader(object):
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        try:
+            magic = self._file.read(len(MAGIC) + 1)
+            if magic[:len(MAGIC)] != MAGIC:
+                raise ValueError("{} is not a snapshot".format(path))
+            elif magic[len(MAGIC)] != VERSION:
+                raise ValueError("unsupported snapshot version {}".format(magic[len(MAGIC)]))
+
+            self.header = decode_value(self._read_block())
+        except Exception:
+            self._file.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def rows(self):
+        # the rows of the next section, which must be read to the end before
+        # the section after it
+        while True:
+            block = self._read_block()
+            if not block:
+                return
+
+            yield from decode_value(block)
+
+    def _read_block(self):
+        length = self._file.read(_LENGTH.size)
+        if len(length) != _LENGTH.size:
+            raise ValueError("truncated snapshot")
+
+        (length,) = _LENGTH.unpack(length)
+        block = self._file.read(length)
+        if len(block) != length:
+            raise ValueError("truncated snapshot")
+
+        return block
+
+
+def write_snapshot(path, header, sections):
+    # write to a temporary file and rename it, so that a failed save leaves
+    # any previous snapshot at this path intact
+    partial = path + ".partial"
+    try:
+        with open(partial, "wb") as f:
+            f.write(MAGIC + bytes([VERSION]))
+            _write_block(f, encode_value(header))
+            for rows in sections:
+                batch = []
+                for row in rows:
+                    batch.append(tuple(row))
+                    if len(batch) == _BATCH_SIZE:
+                        _write_block(f, encode_value(tuple(batch)))
+                        batch = []
+
+                if batch:
+                    _write_block(f, encode_value(tuple(batch)))
+
+                _write_block(f, b"")
+
+        os.replace(partial, path)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+
+        raise
+
+
+def _write_block(f, block):
+    f.write(_LENGTH.pack(len(block)))
+    f.write(block)
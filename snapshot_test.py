@@ -0,0 +1,67 @@
+import os
+import tempfile
+
+from snapshot import SnapshotReader, write_snapshot
+
+
+def test_round_trip():
+    path = os.path.join(tempfile.mkdtemp(), "snapshot")
+    sections = [[(i, str(i), i / 2) for i in range(3000)], [], [((1, 2), b"x\x00", None)]]
+    write_snapshot(path, 1, sections)
+
+    with SnapshotReader(path) as snapshot:
+        assert snapshot.header == 1
+        for rows in sections:
+            assert list(snapshot.rows()) == rows
+
+
+def test_invalid():
+    path = os.path.join(tempfile.mkdtemp(), "snapshot")
+    with open(path, "wb") as f:
+        f.write(b"not a snapshot")
+
+    try:
+        SnapshotReader(path)
+        assert False
+    except ValueError:
+        pass
+
+    write_snapshot(path, (), [[(1,)]])
+    with open(path, "rb") as f:
+        data = f.read()
+
+    with open(path, "wb") as f:
+        f.write(data[:-6])
+
+    with SnapshotReader(path) as snapshot:
+        try:
+            list(snapshot.rows())
+            assert False
+        except ValueError:
+            pass
+
+
+def test_failed_write():
+    path = os.path.join(tempfile.mkdtemp(), "snapshot")
+    write_snapshot(path, "old", [])
+
+    def rows():
+        yield (1,)
+        raise RuntimeError
+
+    try:
+        write_snapshot(path, "new", [rows()])
+        assert False
+    except RuntimeError:
+        pass
+
+    assert os.listdir(os.path.dirname(path)) == ["snapshot"]
+    with SnapshotReader(path) as snapshot:
+        assert snapshot.header == "old"
+
+
+if __name__ == "__main__":
+    test_round_trip()
+    test_invalid()
+    test_failed_write()
+    print("PASS")
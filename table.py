@@ -1,23 +1,125 @@
-from btree import BTree
-from collections import deque, OrderedDict
+import base64
+import binascii
+import bisect
+import copy
+import heapq
+import itertools
+import math
+import operator
+import random
+import time
+import weakref
+
+from bloom import BloomFilter
+from btree import BTree, converter, Metrics
+from codec import decode_value, encode_value, KeyCodec
+from collections import deque, namedtuple, OrderedDict
+from extsort import external_sort, ExternalSort, SpillFile
+from snapshot import SnapshotReader, write_snapshot
 
 
 class Column(object):
-    def __init__(self, name, constructor):
+    def __init__(self, name, constructor, dictionary=False):
         self.name = name
         self.ctr = constructor
 
+        # a column of few distinct values may be stored as integer codes, which
+        # every index of the column shares, and decoded only as rows are read
+        self.dictionary = Dictionary() if dictionary else None
+
     def __eq__(self, other):
-        return self.name == other.name and self.ctr == other.ctr
+        return (
+            self.name == other.name and self.ctr == other.ctr and
+            (self.dictionary is None) == (other.dictionary is None))
 
     def __str__(self):
         return "{}({})".format(self.name, self.ctr)
 
 
+class Dictionary(object):
+    # order-preserving integer codes for the values of a column; codes are
+    # spaced apart, so that a new value takes a code between those of its
+    # neighbours, and when there is no room left every value is renumbered and
+    # the indices which store the codes are rebuilt
+    def __init__(self):
+        self._values = []
+        self._codes = []
+        self._code = {}
+        self._value = {}
+        self._indices = weakref.WeakSet()
+
+    def __len__(self):
+        return len(self._values)
+
+    def add(self, value):
+        if value in self._code:
+            return
+
+        i = bisect.bisect_left(self._values, value)
+        low = self._codes[i - 1] if i > 0 else None
+        high = self._codes[i] if i < len(self._codes) else None
+        self._values.insert(i, value)
+        if low is not None and high is not None and high - low < 2:
+            self._renumber()
+            return
+
+        if low is None and high is None:
+            code = 0
+        elif high is None:
+            code = low + _CODE_SPACING
+        elif low is None:
+            code = high - _CODE_SPACING
+        else:
+            code = (low + high) // 2
+
+        self._codes.insert(i, code)
+        self._code[value] = code
+        self._value[code] = value
+
+    def bound(self, value):
+        # the code of the value and True, or if no row has the value, the code
+        # of the least value above it and False
+        if value in self._code:
+            return self._code[value], True
+
+        i = bisect.bisect_left(self._values, value)
+        if i < len(self._codes):
+            return self._codes[i], False
+
+        return (self._codes[-1] + 1 if self._codes else 0), False
+
+    def code(self, value):
+        return self._code[value]
+
+    def decoder(self):
+        # renumbering replaces the map, so a scan which started before it goes
+        # on decoding the rows of the tree which it started on
+        return self._value.__getitem__
+
+    def values(self):
+        return list(self._values)
+
+    def _renumber(self):
+        codes = [i * _CODE_SPACING for i in range(len(self._values))]
+        recoded = {
+            self._code[value]: code
+            for (value, code) in zip(self._values, codes) if value in self._code}
+
+        self._codes = codes
+        self._code = dict(zip(self._values, codes))
+        self._value = dict(zip(codes, self._values))
+        for index in list(self._indices):
+            index._recode(self, recoded)
+
+
+_CODE_SPACING = 1 << 32
+
+
 class Schema(object):
     def __init__(self, key, value):
         self.key = tuple(c if isinstance(c, Column) else Column(*c) for c in key)
         self.value = tuple(c if isinstance(c, Column) else Column(*c) for c in value)
+        self._projectors = {}
 
     def __eq__(self, other):
         key = len(self.key) == len(other.key)
@@ -38,13 +140,34 @@ class Schema(object):
     def column_names(self):
         return list(c.name for c in self.columns())
 
+    def converter(self):
+        return converter(c.ctr for c in self.columns())
+
     def key_names(self):
         return list(c.name for c in self.key)
 
+    def projector(self, column_names):
+        # a function which picks the named columns out of a row as a tuple
+        column_names = tuple(column_names)
+        if column_names not in self._projectors:
+            names = self.column_names()
+            indices = [names.index(c) for c in column_names]
+            if len(indices) == 1:
+                (index,) = indices
+                self._projectors[column_names] = lambda row: (row[index],)
+            else:
+                self._projectors[column_names] = operator.itemgetter(*indices)
+
+        return self._projectors[column_names]
+
     def value_names(self):
         return list(c.name for c in self.value)
 
 
+# the rows which a bulk write reads before it writes any of them
+_BATCH_SIZE = 1024
+
+
 class Selection(object):
     def __init__(self, source):
         self._source = source
@@ -52,6 +175,10 @@ class Selection(object):
     def __iter__(self):
         yield from self._source
 
+    def approx_count(self, sample_size=1000, rng=None):
+        # selections which can estimate their size without a scan override this
+        return CountEstimate(self.count(), 0)
+
     def count(self):
         count = 0
         for row in self:
@@ -60,22 +187,67 @@ class Selection(object):
         return count
 
     def delete(self):
+        # deletes leave tombstones, which do not move any rows of the index
+        # being scanned, so the rows are deleted as they stream past
         key_len = len(self.schema().key)
         for row in self:
             key = row[:key_len]
             self._delete_row(key)
 
+    def _batches(self, size=_BATCH_SIZE):
+        # the rows in batches, each read in full before any of it is written;
+        # the scan resumes after the last row read with a fresh descent, so
+        # that writes which move rows within the index being scanned, e.g.
+        # updates to its key columns, cannot disturb it
+        position = None
+        while True:
+            try:
+                batch = list(itertools.islice(self._scan(position, False), size))
+            except (IndexError, NotImplementedError):
+                # a selection which cannot resume its scan is read in full
+                # before any of it is written, since a write could move a row
+                # ahead of the scan to be read again; the rows past the first
+                # batch spill to disk
+                rows = iter(self)
+                batch = list(itertools.islice(rows, size))
+                spill = SpillFile()
+                for row in rows:
+                    spill.add(row)
+
+                rows = iter(spill)
+                while batch:
+                    yield batch
+                    batch = list(itertools.islice(rows, size))
+
+                return
+
+            if batch:
+                yield [row for (_position, row) in batch]
+
+            if len(batch) < size:
+                return
+
+            position = batch[-1][0]
+
     def _delete_row(self, key):
         if isinstance(self._source, Selection):
             return self._source._delete_row(key)
         else:
             raise NotImplementedError
 
+    def distinct(self):
+        return HashAggregate(self, self.schema().column_names())
+
     def filter(self, bool_filter):
         return FilterSelection(self, bool_filter)
 
     def group_by(self, columns):
-        return Aggregate(self, columns)
+        # groups stream out of an index order when there is one, and are
+        # otherwise collected by hashing, in the order they are first seen
+        if self.supports_order(columns):
+            return Aggregate(self, columns)
+
+        return HashAggregate(self, columns)
 
     def index(self, columns=None):
         if columns is None:
@@ -90,7 +262,58 @@ class Selection(object):
         return LimitSelection(self, limit)
 
     def order_by(self, columns, reverse=False):
-        return OrderSelection(self, columns, reverse)
+        if self.supports_order(columns):
+            return OrderSelection(self, columns, reverse)
+
+        return SortSelection(self, columns, reverse)
+
+    def page(self, size, cursor=None, reverse=False):
+        if size < 1:
+            raise ValueError("page size must be positive")
+
+        bounds = _cursor_bounds(self._scan_bounds())
+        position = None
+        if cursor is not None:
+            (cursor_bounds, position, reverse) = _decode_cursor(cursor)
+            if cursor_bounds != bounds:
+                raise ValueError("cursor does not match this selection")
+
+        rows = []
+        for (position, row) in self._scan(position, reverse):
+            rows.append(row)
+            if len(rows) == size:
+                return rows, _encode_cursor(bounds, position, reverse)
+
+        return rows, None
+
+    def _scan(self, position, reverse):
+        # yields (position, row) pairs, where position is the row of the index
+        # which drives the scan; resuming from a position skips past it
+        if isinstance(self._source, Selection):
+            return self._source._scan(position, reverse)
+        else:
+            raise NotImplementedError
+
+    def _scan_bounds(self):
+        if isinstance(self._source, Selection):
+            return self._source._scan_bounds()
+        else:
+            return {}
+
+    def sample(self, n, rng=None):
+        # n distinct rows chosen uniformly at random, by reservoir sampling
+        # over a scan; selections over an index choose them from its tree
+        rng = rng or random
+        rows = []
+        for (i, row) in enumerate(self):
+            if i < n:
+                rows.append(row)
+            else:
+                j = rng.randrange(i + 1)
+                if j < n:
+                    rows[j] = row
+
+        return rows
 
     def schema(self):
         if isinstance(self._source, Selection):
@@ -118,9 +341,9 @@ class Selection(object):
 
     def update(self, value):
         key_len = len(self.schema().key)
-        for row in self:
-            key = row[:key_len]
-            self._update_row(key, value)
+        for rows in self._batches():
+            for row in rows:
+                self._update_row(row[:key_len], value)
 
         return self
 
@@ -152,6 +375,60 @@ class Aggregate(object):
                 yield group
 
 
+class CachedSelection(Selection):
+    def __init__(self, cache, key, bounds, source):
+        super().__init__(source)
+        self._cache = cache
+        self._key = key
+        self._bounds = bounds
+
+    def __getitem__(self, key):
+        return self._source[key]
+
+    def __iter__(self):
+        rows = self._cache.get(self._key)
+        if rows is not None:
+            yield from rows
+            return
+
+        writes = self._cache.writes
+        rows = []
+        for row in self._source:
+            if rows is not None:
+                rows.append(row)
+                if self._cache.max_rows is not None and len(rows) > self._cache.max_rows:
+                    rows = None
+
+            yield row
+
+        if rows is not None:
+            self._cache.put(self._key, self._bounds, rows, writes)
+
+    def approx_count(self, sample_size=1000, rng=None):
+        return self._source.approx_count(sample_size, rng)
+
+    def delete(self):
+        self._source.delete()
+
+    def reversed(self):
+        yield from self._source.reversed()
+
+    def sample(self, n, rng=None):
+        return self._source.sample(n, rng)
+
+    def select(self, columns):
+        # the source may answer from a covering index, so it projects, and
+        # each projection is cached apart from the rows it is taken from
+        key = self._key + ("select", tuple(columns))
+        return CachedSelection(self._cache, key, self._bounds, self._source.select(columns))
+
+    def slice(self, bounds):
+        return self._source.slice(bounds)
+
+    def upsert(self, key, value):
+        return self._source.upsert(key, value)
+
+
 class ColumnSelection(Selection):
     def __init__(self, source, columns):
         if set(columns) > set(source.schema().column_names()):
@@ -170,23 +447,28 @@ class ColumnSelection(Selection):
             key.get(c, slice(None))
             for c in self._source.schema().column_names())
 
-        columns = self._column_indices()
-        for row in self._source[key]:
-            yield tuple(row[i] for i in columns)
+        yield from map(self._projector(), self._source[key])
 
     def __iter__(self):
-        columns = self._column_indices()
-        for row in self._source:
-            yield tuple(row[i] for i in columns)
+        yield from map(self._projector(), self._source)
+
+    def approx_count(self, sample_size=1000, rng=None):
+        return self._source.approx_count(sample_size, rng)
+
+    def sample(self, n, rng=None):
+        return list(map(self._projector(), self._source.sample(n, rng)))
+
+    def _scan(self, position, reverse):
+        project = self._projector()
+        for (position, row) in self._source._scan(position, reverse):
+            yield position, project(row)
 
     def schema(self):
         source_columns = {c.name: c for c in self._source.schema().columns()}
         return Schema([source_columns[c] for c in self._columns], [])
 
-    def _column_indices(self):
-        columns = self._source.schema().column_names()
-        columns = dict(zip(columns, range(len(columns))))
-        return tuple(columns[c] for c in self._columns)
+    def _projector(self):
+        return self._source.schema().projector(self._columns)
 
     def update(self, value):
         if len(value) != len(self._columns):
@@ -206,8 +488,9 @@ class FilterSelection(Selection):
 
     def __iter__(self):
         allowed = []
+        columns = self.schema().column_names()
         for row in self._source:
-            allow = self._filter(dict(zip(self.schema().column_names(), row)))
+            allow = self._filter(dict(zip(columns, row)))
             if allow:
                 allowed.append(row)
             else:
@@ -216,6 +499,22 @@ class FilterSelection(Selection):
 
         yield from allowed
 
+    def _accepts(self):
+        columns = self.schema().column_names()
+        return lambda row: self._filter(dict(zip(columns, row)))
+
+    def approx_count(self, sample_size=1000, rng=None):
+        return _estimate_count(self._source, self._accepts(), sample_size, rng)
+
+    def sample(self, n, rng=None):
+        return _sample_accepted(self._source, n, self._accepts(), rng)
+
+    def _scan(self, position, reverse):
+        columns = self.schema().column_names()
+        for (position, row) in self._source._scan(position, reverse):
+            if self._filter(dict(zip(columns, row))):
+                yield position, row
+
     def slice(self, bounds):
         return FilterSelection(self._source.slice(bounds), self._filter)
 
@@ -223,6 +522,55 @@ class FilterSelection(Selection):
         return self._source.upsert(key, value)
 
 
+class HashAggregate(Selection):
+    # the distinct values of some columns in one pass over the rows; once
+    # max_groups values are held, rows with unseen values are spilled to
+    # partitions by hash, and each partition is then read back on its own
+    def __init__(self, source, columns, max_groups=100000, fan_out=16):
+        if set(columns) > set(source.schema().column_names()):
+            raise IndexError
+
+        super().__init__(source)
+        self._columns = list(columns)
+        self._max_groups = max_groups
+        self._fan_out = fan_out
+
+    def __iter__(self):
+        project = self._source.schema().projector(self._columns)
+        yield from self._distinct(map(project, self._source), 0)
+
+    def schema(self):
+        source_columns = {c.name: c for c in self._source.schema().columns()}
+        return Schema([source_columns[c] for c in self._columns], [])
+
+    def _distinct(self, rows, depth):
+        seen = set()
+        partitions = None
+        for row in rows:
+            if row in seen:
+                continue
+            elif len(seen) < self._max_groups:
+                seen.add(row)
+                yield row
+                continue
+
+            if partitions is None:
+                partitions = [SpillFile() for _ in range(self._fan_out)]
+
+            # the depth salts the hash, so that a partition splits again
+            partitions[hash((depth, row)) % self._fan_out].add(row)
+
+        seen = None
+        for partition in partitions or ():
+            yield from self._distinct(partition, depth + 1)
+
+    def _scan(self, _position, _reverse):
+        raise IndexError
+
+    def supports_order(self, _columns):
+        return False
+
+
 class LimitSelection(Selection):
     def __init__(self, source, limit):
         self._source = source
@@ -237,6 +585,9 @@ class LimitSelection(Selection):
             if i == self._limit:
                 break
 
+    def _scan(self, _position, _reverse):
+        raise IndexError
+
     def slice(self, _bounds):
         raise IndexError
 
@@ -252,10 +603,92 @@ class MergeSelection(Selection):
             yield from self._source[key]
 
     def __iter__(self):
+        covering = self._covering(self.schema().column_names())
+        if covering is not None:
+            yield from covering
+            return
+
         key_names = self.schema().key_names()
         for key in self._right.select(key_names):
             yield from self._source[key]
 
+    def approx_count(self, sample_size=1000, rng=None):
+        covering = self._covering(self.schema().key_names())
+        if covering is not None:
+            return covering.approx_count(sample_size, rng)
+
+        return _estimate_count(self._right, self._joins(), sample_size, rng)
+
+    def sample(self, n, rng=None):
+        covering = self._covering(self.schema().column_names())
+        if covering is not None:
+            return covering.sample(n, rng)
+
+        # each right row joins at most one left row, so a uniform sample of
+        # the right rows which join is a uniform sample of the merged rows
+        right_columns = self._right.schema().column_names()
+        key = [right_columns.index(c) for c in self.schema().key_names()]
+        rows = []
+        for right_row in _sample_accepted(self._right, n, self._joins(), rng):
+            rows.extend(self._source[tuple(right_row[i] for i in key)])
+
+        return rows
+
+    def _scan(self, position, reverse):
+        covering = self._covering(self.schema().column_names())
+        if covering is not None:
+            yield from covering._scan(position, reverse)
+            return
+
+        right_columns = self._right.schema().column_names()
+        key = [right_columns.index(c) for c in self.schema().key_names()]
+        for (position, right_row) in self._right._scan(position, reverse):
+            for row in self._source[tuple(right_row[i] for i in key)]:
+                yield position, row
+
+    def reversed(self):
+        for (_, row) in self._scan(None, True):
+            yield row
+
+    def _scan_bounds(self):
+        bounds = self._source._scan_bounds()
+        bounds.update(self._right._scan_bounds())
+        return bounds
+
+    def select(self, columns):
+        covering = self._covering(columns)
+        if covering is None:
+            return ColumnSelection(self, columns)
+        else:
+            return ColumnSelection(covering, columns)
+
+    def supports_order(self, columns):
+        # the right side drives the merge, so its order is the order of the rows
+        return self._right.supports_order(columns)
+
+    def _covering(self, columns):
+        # the right index can only answer alone if the left side is the
+        # whole primary index, since otherwise it filters the right rows
+        if not isinstance(self._source, TableIndexSliceSelection):
+            return None
+        elif self._source._bounds:
+            return None
+
+        index_columns = set(self._right.schema().column_names())
+        if not set(columns) <= index_columns:
+            return None
+
+        schema = self.schema()
+        value = [c for c in schema.value if c.name in columns]
+        covered = Schema(schema.key, value)
+        columns = ColumnSelection(self._right, covered.column_names())
+        return SchemaSelection(columns, covered)
+
+    def _joins(self):
+        right_columns = self._right.schema().column_names()
+        key = [right_columns.index(c) for c in self.schema().key_names()]
+        return lambda row: any(True for _ in self._source[tuple(row[i] for i in key)])
+
 
 class OrderSelection(Selection):
     def __init__(self, source, columns, reverse):
@@ -272,12 +705,64 @@ class OrderSelection(Selection):
         else:
             yield from self._source
 
+    def approx_count(self, sample_size=1000, rng=None):
+        return self._source.approx_count(sample_size, rng)
+
+    def sample(self, n, rng=None):
+        rows = self._source.sample(n, rng)
+        return rows[::-1] if self._reverse else rows
+
+    def _scan(self, position, reverse):
+        return self._source._scan(position, reverse != self._reverse)
+
+
+class SortSelection(Selection):
+    # orders rows which no index holds in that order; followed by a limit, the
+    # first rows are kept in a heap of that size, and otherwise rows are sorted
+    # in runs which spill to disk, so that memory is bounded either way
+    def __init__(self, source, columns, reverse=False, limit=None, run_size=100000):
+        if set(columns) > set(source.schema().column_names()):
+            raise IndexError
+
+        super().__init__(source)
+        self._columns = list(columns)
+        self._reverse = reverse
+        self._limit = limit
+        self._run_size = run_size
+
+    def __iter__(self):
+        key = self.schema().projector(self._columns)
+        if self._limit is None:
+            yield from external_sort(self._source, self._run_size, key, self._reverse)
+        elif self._reverse:
+            yield from heapq.nlargest(self._limit, self._source, key)
+        else:
+            yield from heapq.nsmallest(self._limit, self._source, key)
+
+    def limit(self, limit):
+        if self._limit is not None:
+            limit = min(limit, self._limit)
+
+        return SortSelection(self._source, self._columns, self._reverse, limit, self._run_size)
+
+    def _scan(self, _position, _reverse):
+        raise IndexError
+
+    def supports_order(self, _columns):
+        return False
+
 
 class SchemaSelection(Selection):
     def __init__(self, source, schema):
         super().__init__(source)
         self._schema = schema
 
+    def approx_count(self, sample_size=1000, rng=None):
+        return self._source.approx_count(sample_size, rng)
+
+    def sample(self, n, rng=None):
+        return self._source.sample(n, rng)
+
     def schema(self):
         return self._schema
 
@@ -297,6 +782,9 @@ class TableIndexSliceSelection(Selection):
     def __iter__(self):
         yield from self._source.slice(self._bounds)
 
+    def approx_count(self, sample_size=1000, rng=None):
+        return self._source.approx_count(sample_size, rng, self._bounds)
+
     def contains(self, key):
         columns = self.schema().column_names()
         if len(key) > len(columns):
@@ -316,14 +804,40 @@ class TableIndexSliceSelection(Selection):
 
         return True
 
+    def delete(self):
+        # a range of the primary index is deleted as a whole, not row by row
+        if self._source is self._table._source:
+            self._table._delete_range(self._bounds)
+        else:
+            super().delete()
+
     def reversed(self):
         yield from self._source.reversed(self._bounds)
 
+    def sample(self, n, rng=None):
+        return self._source.sample(n, rng, self._bounds)
+
+    def _scan(self, position, reverse):
+        return self._source._scan(position, reverse, self._bounds)
+
+    def _scan_bounds(self):
+        return dict(self._bounds)
+
     def slice(self, bounds):
         return self._source.slice(bounds)
 
     def supports_order(self, order):
-        return self._table.supports_order(order)
+        # the rows come in the order of the index being scanned, whichever
+        # other index the table may have
+        return self._source.supports_order(order)
+
+    def update(self, value):
+        # a range of the primary index is rewritten in place, in one walk
+        if self._source is self._table._source:
+            self._table._update_range(self._bounds, value)
+            return self
+
+        return super().update(value)
 
     def upsert(self, key, value):
         return self._table.upsert(key, value)
@@ -335,40 +849,321 @@ class TableIndexSliceSelection(Selection):
         self._table._update_row(key, value)
 
 
+class _MeasuredSelection(Selection):
+    # stands in for one stage of a plan under Table.explain(analyze=True) to
+    # count the rows which the stage produces and the time spent producing
+    # them, which includes the time spent in its sources
+    def __init__(self, stage):
+        super().__init__(stage)
+        self.rows = 0
+        self.seconds = 0.
+        self.lookups = 0
+
+    def __getitem__(self, key):
+        self.lookups += 1
+        return self._measure(self._source[key])
+
+    def __iter__(self):
+        return self._measure(self._source)
+
+    def reversed(self):
+        return self._measure(self._source.reversed())
+
+    def _measure(self, rows):
+        rows = iter(rows)
+        while True:
+            start = time.perf_counter()
+            try:
+                row = next(rows)
+            except StopIteration:
+                self.seconds += time.perf_counter() - start
+                return
+
+            self.seconds += time.perf_counter() - start
+            self.rows += 1
+            yield row
+
+    def _scan(self, position, reverse):
+        return self._measure(self._source._scan(position, reverse))
+
+
+def _analyze(selection, measured):
+    # a copy of the plan with each stage measured, leaving the plan itself
+    # untouched; measured maps each stage of the plan to its measurement
+    stage = copy.copy(selection)
+    if isinstance(selection, MergeSelection):
+        stage._right = _analyze(selection._right, measured)
+        # a covering merge never reads its left side, and must still find the
+        # primary index there to know that it covers
+        if selection._covering(selection.schema().column_names()) is None:
+            stage._source = _analyze(selection._source, measured)
+    elif isinstance(selection._source, Selection) and not isinstance(selection._source, Index):
+        stage._source = _analyze(selection._source, measured)
+
+    measured[id(selection)] = _MeasuredSelection(stage)
+    return measured[id(selection)]
+
+
 class Index(Selection):
-    def __init__(self, schema, keys=[]):
+    def __init__(
+            self, schema, keys=[], presorted=False, binary_keys=False,
+            compress_prefix=False, hashed=False, bloom_error_rate=None,
+            compact=False):
+
         assert isinstance(schema, Schema)
 
         self._schema = schema
-        super().__init__(BTree(10, tuple(c.ctr for c in schema.columns()), keys))
+        self._binary_keys = binary_keys
+        self._compress_prefix = compress_prefix
+        self._hashed = hashed
+        self._compact = compact
+        self._convert = schema.converter()
+
+        # the tree stores the code of each value of a dictionary column
+        self._coded = [
+            (i, c.dictionary) for (i, c) in enumerate(schema.columns())
+            if c.dictionary is not None]
+        if not self._coded:
+            super().__init__(self._new_tree(keys, presorted))
+        elif presorted:
+            # new values are added in order before any row is encoded, so that
+            # the codes cannot be renumbered while the tree is being built; a
+            # first pass keeps only the distinct values, and the rows of a
+            # one-shot iterator spill to disk for the second
+            spill = SpillFile() if iter(keys) is keys else None
+            distinct = [set() for _ in self._coded]
+            for row in map(self._convert, keys):
+                for (values, (i, _dictionary)) in zip(distinct, self._coded):
+                    values.add(row[i])
+
+                if spill is not None:
+                    spill.add(row)
+
+            for (values, (_i, dictionary)) in zip(distinct, self._coded):
+                for value in sorted(values):
+                    dictionary.add(value)
+
+            rows = spill if spill is not None else map(self._convert, keys)
+            super().__init__(self._new_tree(map(self._encode, rows), True))
+        else:
+            super().__init__(self._new_tree([], False))
+
+        for (_i, dictionary) in self._coded:
+            dictionary._indices.add(self)
+
+        if self._coded and not presorted:
+            for row in keys:
+                self._insert(self._convert(row))
+
+        # hashed=True hashes the whole key, an int hashes that many leading
+        # key columns; exact lookups on at least that many columns skip the tree
+        self._hash = None
+        if hashed:
+            self._hash_len = len(schema.key) if hashed is True else hashed
+            assert 0 < self._hash_len <= len(schema.key)
+
+            self._hash = {}
+            for row in self:
+                self._hash_add(row)
+
+        self._bloom = None
+        self._bloom_error_rate = bloom_error_rate
+        self._bloom_queries = 0
+        self._bloom_negatives = 0
+        self._bloom_false_positives = 0
+        if bloom_error_rate is not None:
+            self._build_bloom()
 
     def __bool__(self):
         return len(self._source) > 0
 
     def __getitem__(self, bounds):
-        yield from self._source[bounds]
+        if self.hashes(bounds):
+            yield from self._hashed_rows(bounds)
+            return
+
+        maybe = self._bloom_check(bounds)
+        if maybe is False:
+            return
+
+        found = False
+        encoded = self._encode_bounds(bounds)
+        for row in self._decoded(self._source[encoded] if encoded is not None else ()):
+            found = True
+            yield row
+
+        if maybe and not found:
+            self._bloom_false_positives += 1
 
     def __delitem__(self, key):
-        del self._source[key]
+        # the tree is not written until the rows have been read
+        if self._hash is not None:
+            for row in self[key]:
+                self._hash_discard(row)
+
+        # an exact key leaves a tombstone, and a range or prefix of the key,
+        # which may cover many rows, drops them from the tree at once
+        encoded = self._encode_bounds(key)
+        if encoded is None:
+            return
+        elif isinstance(key, slice) or len(key) < len(self._schema.key):
+            self._source.delete_range(encoded)
+        else:
+            del self._source[encoded]
+
+    def __iter__(self):
+        yield from self._decoded(self._source)
 
     def __len__(self):
         return len(self._source)
 
+    def approx_count(self, sample_size=1000, rng=None, bounds={}):
+        # the tree counts the keys within any bounds exactly, from the sizes
+        # of the subtrees which they cover
+        bounds = self._encode_bounds(convert_bounds(bounds))
+        return CountEstimate(self._source.count(bounds) if bounds is not None else 0, 0)
+
+    def bloom_info(self):
+        if self._bloom is None:
+            return None
+
+        return BloomInfo(
+            self._bloom_queries, self._bloom_negatives,
+            self._bloom_false_positives, self._bloom_error_rate,
+            self._bloom.capacity)
+
     def contains(self, key):
-        return self._source.contains(list(key))
+        if self.hashes(key):
+            key = tuple(key)
+            rows = self._hash.get(key[:self._hash_len], ())
+            return any(row[:len(key)] == key for row in rows)
+
+        maybe = self._bloom_check(key)
+        if maybe is False:
+            return False
+
+        encoded = self._encode_bounds(list(key))
+        found = encoded is not None and self._source.contains(encoded)
+        if maybe and not found:
+            self._bloom_false_positives += 1
+
+        return found
 
     def delete(self):
-        del self._source[:]
+        self._source.delete_range(slice(None))
+        if self._hash is not None:
+            self._hash.clear()
+
+        if self._bloom is not None:
+            self._build_bloom()
+
+    def hashes(self, bounds):
+        if self._hash is None:
+            return False
+        elif isinstance(bounds, dict):
+            bounds = list(bounds.values())
+
+        if isinstance(bounds, slice) or len(bounds) < self._hash_len:
+            return False
+
+        return not any(isinstance(v, slice) for v in bounds)
 
     def insert(self, row):
-        self._source.insert(row)
+        row = self._convert(row)
+        self._insert(row)
+        if self._hash is not None:
+            self._hash_add(row)
+
+        if self._bloom is not None:
+            if len(self._bloom) >= self._bloom.capacity:
+                self._build_bloom()
+            else:
+                self._bloom.add(row[:len(self._schema.key)])
+
+    def key_memory(self):
+        return self._source.key_memory()
 
     def rebalance(self):
         self._source.rebalance()
 
+        # deleted keys stay in the filter until it is rebuilt
+        if self._bloom is not None and len(self._bloom) > len(self):
+            self._build_bloom()
+
+    def remove(self, keys):
+        # deletes each of the exact keys, in key order and with a single walk
+        # down the tree for all of them
+        keys = sorted(tuple(key) for key in keys)
+        if self._hash is not None:
+            for key in keys:
+                for row in self._hashed_rows(key):
+                    self._hash_discard(row)
+
+        encoded = (self._encode_bounds(list(key)) for key in keys)
+        self._source.remove(bound for bound in encoded if bound is not None)
+
+    def replace(self, key, row):
+        if self._coded:
+            # the row is encoded first, since a new value may renumber the codes
+            encoded = self._encode(self._convert(row))
+            bounds = self._encode_bounds(list(key))
+            if bounds is None:
+                return 0
+        else:
+            (encoded, bounds) = (row, list(key))
+
+        if self._hash is None:
+            return self._source.replace(bounds, encoded)
+
+        old_rows = list(self[key])
+        replaced = self._source.replace(bounds, encoded)
+        for old_row in old_rows:
+            self._hash_discard(old_row)
+
+        self._hash_add(self._convert(row))
+        return replaced
+
+    def rewrite(self, function, bounds={}):
+        # replaces each row within the bounds with function(row), unless that
+        # returns None, in place and in key order; the key must not change, and
+        # any new values of dictionary columns must already be in them, since
+        # renumbering their codes would rebuild the tree in the middle of the walk
+        bounds = self._encode_bounds(convert_bounds(bounds))
+        if bounds is None:
+            return 0
+        elif self._hash is None and not self._coded:
+            return self._source.update(bounds, function)
+
+        decode = self._decoder()
+
+        def rewrite(row):
+            old_row = decode(row) if decode is not None else row
+            new_row = function(old_row)
+            if new_row is None:
+                return None
+
+            new_row = self._convert(new_row)
+            if self._hash is not None:
+                self._hash_discard(old_row)
+                self._hash_add(new_row)
+
+            return self._encode(new_row) if self._coded else new_row
+
+        return self._source.update(bounds, rewrite)
+
+    def sample(self, n, rng=None, bounds={}):
+        bounds = self._encode_bounds(convert_bounds(bounds))
+        if bounds is None:
+            return []
+
+        return list(self._decoded(self._source.sample(bounds, n, rng or random)))
+
     def schema(self):
         return self._schema
 
+    def set_metrics(self, metrics):
+        self._source.metrics = metrics
+
     def slice(self, bounds, reverse=False):
         if not self.supports_bounds(bounds):
             raise IndexError
@@ -400,6 +1195,13 @@ class Index(Selection):
 
         return True
 
+    def stats(self):
+        stats = self._source.stats()
+        if self._bloom is not None:
+            stats["bloom"] = self.bloom_info()._asdict()
+
+        return stats
+
     def supports_order(self, columns):
         schema_columns = self.schema().column_names()
         return schema_columns[:len(columns)] == columns
@@ -408,9 +1210,195 @@ class Index(Selection):
         if bounds is None:
             bounds = slice(None)
         else:
-            bounds = convert_bounds(bounds)
+            bounds = self._encode_bounds(convert_bounds(bounds))
+            if bounds is None:
+                return
+
+        yield from self._decoded(self._source.select(bounds, True))
+
+    def _copy(self, keys, presorted=False, schema=None, hashed=None):
+        schema = self._schema if schema is None else schema
+        hashed = self._hashed if hashed is None else hashed
+        return Index(
+            schema, keys, presorted, self._binary_keys, self._compress_prefix, hashed,
+            self._bloom_error_rate, self._compact)
+
+    def _bloom_check(self, key):
+        # None if the filter cannot answer, otherwise whether the key may exist
+        if self._bloom is None or isinstance(key, slice):
+            return None
+        elif len(key) != len(self._schema.key):
+            return None
+
+        self._bloom_queries += 1
+        if tuple(key) in self._bloom:
+            return True
+
+        self._bloom_negatives += 1
+        return False
+
+    def _build_bloom(self):
+        # leave room to grow, so that inserts rebuild the filter rarely
+        key_len = len(self._schema.key)
+        capacity = max(2 * len(self), 1024)
+        self._bloom = BloomFilter(capacity, self._bloom_error_rate)
+        for row in self:
+            self._bloom.add(tuple(row[:key_len]))
+
+    def _decoded(self, rows):
+        decode = self._decoder()
+        return rows if decode is None else map(decode, rows)
+
+    def _decoder(self):
+        if not self._coded:
+            return None
+
+        columns = [(i, dictionary.decoder()) for (i, dictionary) in self._coded]
+
+        def decode(row):
+            row = list(row)
+            for (i, value) in columns:
+                row[i] = value(row[i])
+
+            return tuple(row)
+
+        return decode
+
+    def _encode(self, row):
+        # every value is added before any is looked up, in case adding one
+        # renumbers the codes
+        for (i, dictionary) in self._coded:
+            dictionary.add(row[i])
+
+        row = list(row)
+        for (i, dictionary) in self._coded:
+            row[i] = dictionary.code(row[i])
+
+        return tuple(row)
+
+    def _encode_bounds(self, bounds):
+        # bounds over the codes which the tree stores, or None if nothing can
+        # match; a value which no row has is replaced by the code of the next
+        # value above it, and the columns after it no longer matter
+        if not self._coded:
+            return bounds
+        elif isinstance(bounds, slice):
+            start = bounds.start and self._encode_bound(bounds.start)[0]
+            stop = bounds.stop and self._encode_bound(bounds.stop)[0]
+            return slice(start, stop, bounds.step)
+
+        (bound, exact) = self._encode_bound(bounds)
+        return bound if exact else None
+
+    def _encode_bound(self, values):
+        columns = self._schema.columns()
+        dictionaries = dict(self._coded)
+        bound = []
+        for (i, value) in enumerate(values):
+            if i not in dictionaries:
+                bound.append(value)
+                continue
+
+            (code, exact) = dictionaries[i].bound(columns[i].ctr(value))
+            bound.append(code)
+            if not exact:
+                return bound, False
+
+        return bound, True
+
+    def _hash_add(self, row):
+        self._hash.setdefault(tuple(row[:self._hash_len]), set()).add(tuple(row))
+
+    def _hash_discard(self, row):
+        key = tuple(row[:self._hash_len])
+        rows = self._hash.get(key)
+        if rows is not None:
+            rows.discard(tuple(row))
+            if not rows:
+                del self._hash[key]
+
+    def _insert(self, row):
+        if self._coded:
+            # encoding may rebuild the tree, so it is found again afterwards
+            row = self._encode(row)
+
+        self._source.insert(row)
+
+    def _new_tree(self, keys, presorted):
+        # compact storage applies to schemas of ints and floats, so an index
+        # of other columns copied from a compact one stores keys as objects
+        ctrs = tuple(
+            int if c.dictionary is not None else c.ctr for c in self._schema.columns())
+        codec = KeyCodec(ctrs) if self._binary_keys else None
+        compact = self._compact and all(ctr in (int, float) for ctr in ctrs)
+        return BTree(10, ctrs, keys, presorted, codec, self._compress_prefix, compact)
+
+    def _recode(self, dictionary, codes):
+        # the dictionary renumbered its codes in the same order, so the rows
+        # are still sorted, and the tree is rebuilt from them bottom-up
+        columns = [i for (i, d) in self._coded if d is dictionary]
+
+        def recode(row):
+            row = list(row)
+            for i in columns:
+                row[i] = codes[row[i]]
+
+            return tuple(row)
+
+        tree = self._new_tree(map(recode, self._source), True)
+        tree.metrics = self._source.metrics
+        self._source = tree
+
+    def _hashed_rows(self, bounds):
+        # each bucket is a set, so the matching rows are sorted into index
+        # order, and the copy also lets the rows be deleted as they are read
+        bounds = tuple(bounds)
+        rows = self._hash.get(bounds[:self._hash_len], ())
+        yield from sorted(row for row in rows if row[:len(bounds)] == bounds)
+
+    def _scan(self, position, reverse, bounds={}):
+        bounds = self._encode_bounds(convert_bounds(bounds))
+        if bounds is None:
+            return
+        elif position is None:
+            for row in self._decoded(self._source.select(bounds, reverse)):
+                yield row, row
+
+            return
+
+        # resume with a single descent, bounded on one side by the position
+        decode = self._decoder()
+        if decode is not None:
+            position = self._encode_bound(position)[0]
+
+        position = tuple(position)
+        if isinstance(bounds, slice):
+            prefix = []
+            start = bounds.start
+            stop = bounds.stop
+        else:
+            prefix = bounds
+            start = bounds
+            stop = None
+
+        if reverse:
+            rows = self._source.select(slice(start, list(position)), True)
+        else:
+            rows = self._source.select(slice(list(position), stop))
+
+        for row in rows:
+            if list(row[:len(prefix)]) != prefix:
+                break
+            elif tuple(row) != position:
+                row = decode(row) if decode is not None else row
+                yield row, row
+
 
-        yield from self._source.select(bounds, True)
+BloomInfo = namedtuple(
+    "BloomInfo", ["queries", "negatives", "false_positives", "error_rate", "capacity"])
+
+# a row count, and how far the true count may be from it
+CountEstimate = namedtuple("CountEstimate", ["count", "error"])
 
 
 def convert_bounds(bounds):
@@ -431,23 +1419,467 @@ def convert_bounds(bounds):
         return bounds
 
 
-class ReadOnlyIndex(Index):
-    def __init__(self, source, schema):
-        Index.__init__(self, schema, source.select(schema.column_names()))
+def _cursor_bounds(bounds):
+    cursor_bounds = []
+    for (col, bound) in bounds.items():
+        if isinstance(bound, slice):
+            cursor_bounds.append((col, ":", bound.start, bound.stop))
+        else:
+            cursor_bounds.append((col, "=", bound))
 
-    def __delitem__(self, key):
-        raise NotImplementedError
+    return tuple(cursor_bounds)
 
-    def insert(self, _row):
-        raise NotImplementedError
 
+def _decode_cursor(cursor):
+    try:
+        data = base64.urlsafe_b64decode(cursor.encode("ascii"))
+        (bounds, position, reverse) = decode_value(data)
+    except (binascii.Error, IndexError, TypeError, UnicodeError, ValueError):
+        raise ValueError("invalid cursor")
 
-class Table(Selection):
-    def __init__(self, index):
-        assert isinstance(index, Index)
+    return bounds, position, reverse
 
-        super().__init__(index)
-        self._auxiliary_indices = {}
+
+def _encode_cursor(bounds, position, reverse):
+    data = encode_value((bounds, tuple(position), bool(reverse)))
+    return base64.urlsafe_b64encode(data).decode("ascii")
+
+
+def _estimate_count(source, accept, sample_size, rng):
+    # scales the share of a sample of the source which is accepted up to the
+    # size of the source; the error is the half width of a 95% confidence
+    # interval for that share, plus the error in the size of the source
+    total = source.approx_count(sample_size, rng)
+    rows = source.sample(sample_size, rng)
+    if not rows:
+        return CountEstimate(0, total.error)
+
+    n = max(total.count, len(rows))
+    share = sum(1 for row in rows if accept(row)) / len(rows)
+
+    # a sample of the whole source has no error, and the share is smoothed
+    # so that a sample which accepts all or none of its rows still has some
+    correction = (n - len(rows)) / (n - 1) if n > len(rows) else 0
+    p = (share * len(rows) + 1) / (len(rows) + 2)
+    error = 1.96 * n * math.sqrt(p * (1 - p) / len(rows) * correction)
+    return CountEstimate(round(n * share), math.ceil(error + share * total.error))
+
+
+def _sample_accepted(source, n, accept, rng):
+    # samples twice as many rows of the source each time until n of them are
+    # accepted, or the source runs out; the accepted rows of a uniform sample
+    # are a uniform sample of those the whole source would accept
+    rng = rng or random
+    size = n
+    while True:
+        rows = source.sample(size, rng)
+        accepted = [row for row in rows if accept(row)]
+        if len(accepted) >= n or len(rows) < size:
+            break
+
+        size *= 2
+
+    chosen = sorted(rng.sample(range(len(accepted)), min(n, len(accepted))))
+    return [accepted[i] for i in chosen]
+
+
+class ReadOnlyIndex(Index):
+    def __init__(self, source, schema):
+        Index.__init__(self, schema, source.select(schema.column_names()))
+
+    def __delitem__(self, key):
+        raise NotImplementedError
+
+    def insert(self, _row):
+        raise NotImplementedError
+
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+class QueryCache(object):
+    def __init__(self, maxsize, max_rows=None):
+        assert maxsize > 0
+
+        self.maxsize = maxsize
+        self.max_rows = max_rows
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self.writes += 1
+        self._entries.clear()
+
+    def get(self, key):
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][1]
+        else:
+            self.misses += 1
+            return None
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
+
+    def invalidate(self, row):
+        self.writes += 1
+        stale = [
+            key for key, (bounds, _rows) in self._entries.items()
+            if _bounds_contain(bounds, row)]
+
+        for key in stale:
+            del self._entries[key]
+
+    def put(self, key, bounds, rows, writes):
+        # a write during the scan may have changed rows which were already read
+        if writes != self.writes:
+            return
+
+        self._entries[key] = (bounds, rows)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+def _bounds_contain(bounds, row):
+    # err on the side of containment, since a missed eviction serves stale rows
+    try:
+        for col, bound in bounds.items():
+            val = row[col]
+            if isinstance(bound, slice):
+                if bound.start and bound.start > val:
+                    return False
+                if bound.stop and bound.stop <= val:
+                    return False
+            elif bound < val or bound > val:
+                return False
+    except TypeError:
+        return True
+
+    return True
+
+
+def _freeze(value):
+    if isinstance(value, slice):
+        return (slice, _freeze(value.start), _freeze(value.stop), _freeze(value.step))
+    elif isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    else:
+        return value
+
+
+class Batch(object):
+    # buffers changes to a table and applies them together on commit, either
+    # all of them or, if any fails, none
+    def __init__(self, table, rebuild_ratio=0.125):
+        self._table = table
+        self._rebuild_ratio = rebuild_ratio
+        self._convert = table.schema().converter()
+        self._convert_key = converter(c.ctr for c in table.schema().key)
+        self._key_len = len(table.schema().key)
+
+        # the final row (None once deleted) of each key, and whether the
+        # batch inserted the key without deleting it first
+        self._changes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self._changes = {}
+
+    def __len__(self):
+        return len(self._changes)
+
+    def commit(self):
+        changes, self._changes = self._changes, {}
+        table = self._table
+        if not changes:
+            return
+
+        # a batch which changes much of the table is merged into new indices
+        # as bulk_insert does, and the rest are applied in place
+        rebuild = len(changes) >= self._rebuild_ratio * len(table)
+
+        # the rows to delete from and insert into each index, primary first
+        projectors = [(lambda row: row, table._source)] + [
+            (project, index) for (index, project, _) in table._projectors()]
+        deltas = [(index, [], []) for (_, index) in projectors]
+        keys = sorted(changes)
+        for (key, old) in zip(keys, self._rows(keys, rebuild)):
+            (inserted, row) = changes[key]
+            if inserted and old is not None:
+                raise ValueError("duplicate key {}".format(key))
+            elif old == row:
+                continue
+
+            for ((project, _), (_, deletes, inserts)) in zip(projectors, deltas):
+                old_index_row = None if old is None else project(old)
+                index_row = None if row is None else project(row)
+                if old_index_row == index_row:
+                    continue
+
+                if old_index_row is not None:
+                    deletes.append(old_index_row)
+                if index_row is not None:
+                    inserts.append(index_row)
+
+        if rebuild:
+            self._rebuild(deltas)
+        else:
+            self._apply(deltas)
+
+    def delete(self, key):
+        key = self._key(key)
+        (inserted, _row) = self._changes.get(key, (False, None))
+        self._changes[key] = (inserted, None)
+
+    def insert(self, row):
+        row = self._row(row)
+        key = row[:self._key_len]
+        (inserted, previous) = self._changes.get(key, (True, None))
+        if previous is not None:
+            raise ValueError("duplicate key {}".format(key))
+
+        self._changes[key] = (inserted, row)
+
+    def upsert(self, key, value):
+        row = self._row(tuple(key) + tuple(value))
+        key = row[:self._key_len]
+        (inserted, _row) = self._changes.get(key, (False, None))
+        self._changes[key] = (inserted, row)
+
+    def _apply(self, deltas):
+        table = self._table
+        start = time.perf_counter()
+        undo = []
+        try:
+            for (index, deletes, inserts) in deltas:
+                key_len = len(index.schema().key)
+                for row in sorted(deletes):
+                    del index[list(row[:key_len])]
+                    undo.append((index.insert, row))
+
+                for row in sorted(inserts):
+                    index.insert(row)
+                    undo.append((index.__delitem__, list(row[:key_len])))
+        except BaseException:
+            for (action, argument) in reversed(undo):
+                action(argument)
+
+            raise
+
+        for (_, deletes, inserts) in deltas[:1]:
+            for row in deletes + inserts:
+                table._invalidate(row)
+
+            for row in deletes:
+                table._update_views(row, None)
+            for row in inserts:
+                table._update_views(None, row)
+
+        deltas = deltas[1:]
+        table._maintained("auxiliary_deletes", start, sum(len(d[1]) for d in deltas))
+        table._maintained("auxiliary_inserts", start, sum(len(d[2]) for d in deltas))
+
+    def _key(self, key):
+        if len(key) != self._key_len:
+            raise IndexError
+
+        return self._convert_key(key)
+
+    def _rebuild(self, deltas):
+        indices = []
+        for (index, deletes, inserts) in deltas:
+            deletes = set(deletes)
+            rows = (row for row in index if row not in deletes)
+            indices.append(index._copy(heapq.merge(rows, sorted(inserts)), presorted=True))
+
+        table = self._table
+        names = list(table._auxiliary_indices)
+        table._swap(indices[0], dict(zip(names, indices[1:])))
+
+    def _row(self, row):
+        if len(row) != len(self._table.schema()):
+            raise ValueError(row)
+
+        return self._convert(row)
+
+    def _rows(self, keys, scan):
+        # the current row of each of the sorted keys, or None; either looked
+        # up one at a time, or found by a single pass over the primary index
+        source = self._table._source
+        if not scan:
+            for key in keys:
+                rows = list(source[list(key)])
+                yield rows[0] if rows else None
+
+            return
+
+        rows = iter(source)
+        row = next(rows, None)
+        for key in keys:
+            while row is not None and row[:self._key_len] < key:
+                row = next(rows, None)
+
+            yield row if row is not None and row[:self._key_len] == key else None
+
+
+class MaterializedView(object):
+    # aggregates of a table's rows per group, kept up to date from the rows
+    # which the table inserts and deletes rather than recomputed by a scan;
+    # each aggregate is ("count", None) or one of count, sum, min and max of
+    # a column, which ignore None values
+    def __init__(self, schema, columns, aggregates):
+        names = schema.column_names()
+        if not set(columns) <= set(names):
+            raise IndexError
+
+        self._columns = tuple(columns)
+        self._group = schema.projector(columns)
+        self._aggregates = []
+        for (function, column) in aggregates:
+            if function not in _AGGREGATES:
+                raise ValueError("unknown aggregate {}".format(function))
+            elif column is None and function != "count":
+                raise ValueError("{} needs a column".format(function))
+            elif column is not None and column not in names:
+                raise IndexError
+
+            index = None if column is None else names.index(column)
+            self._aggregates.append((function, index))
+
+        # a group's row count, and then the state of each of its aggregates
+        self._groups = {}
+
+    def __getitem__(self, group):
+        group = tuple(group)
+        if group not in self._groups:
+            raise KeyError(group)
+
+        return self._results(self._groups[group])
+
+    def __iter__(self):
+        for group in sorted(self._groups):
+            yield group + self._results(self._groups[group])
+
+    def __len__(self):
+        return len(self._groups)
+
+    def add(self, row):
+        group = self._group(row)
+        if group not in self._groups:
+            self._groups[group] = [0] + [
+                _ValueCounts() if function in ("min", "max") else 0
+                for (function, _) in self._aggregates]
+
+        state = self._groups[group]
+        state[0] += 1
+        for (i, (function, index)) in enumerate(self._aggregates, 1):
+            value = None if index is None else row[index]
+            if index is not None and value is None:
+                continue
+            elif function == "count":
+                state[i] += 1
+            elif function == "sum":
+                state[i] += value
+            else:
+                state[i].add(value)
+
+    def clear(self):
+        self._groups = {}
+
+    def columns(self):
+        return self._columns
+
+    def remove(self, row):
+        group = self._group(row)
+        state = self._groups[group]
+        state[0] -= 1
+        if not state[0]:
+            del self._groups[group]
+            return
+
+        for (i, (function, index)) in enumerate(self._aggregates, 1):
+            value = None if index is None else row[index]
+            if index is not None and value is None:
+                continue
+            elif function == "count":
+                state[i] -= 1
+            elif function == "sum":
+                state[i] -= value
+            else:
+                state[i].remove(value)
+
+    def _results(self, state):
+        results = []
+        for (i, (function, _)) in enumerate(self._aggregates, 1):
+            if function == "min":
+                results.append(state[i].min())
+            elif function == "max":
+                results.append(state[i].max())
+            else:
+                results.append(state[i])
+
+        return tuple(results)
+
+
+_AGGREGATES = ("count", "sum", "min", "max")
+
+
+class _ValueCounts(object):
+    # a multiset of values, so that a minimum or maximum can be found again
+    # once the values holding it are removed
+    __slots__ = ("counts", "values")
+
+    def __init__(self):
+        self.counts = {}
+        self.values = []
+
+    def add(self, value):
+        if value in self.counts:
+            self.counts[value] += 1
+        else:
+            self.counts[value] = 1
+            bisect.insort(self.values, value)
+
+    def max(self):
+        return self.values[-1] if self.values else None
+
+    def min(self):
+        return self.values[0] if self.values else None
+
+    def remove(self, value):
+        self.counts[value] -= 1
+        if not self.counts[value]:
+            del self.counts[value]
+            del self.values[bisect.bisect_left(self.values, value)]
+
+
+# the column constructors which a snapshot can name
+_SNAPSHOT_CTRS = {ctr.__name__: ctr for ctr in (bool, bytes, complex, float, int, str, tuple)}
+
+
+class Table(Selection):
+    def __init__(self, index):
+        assert isinstance(index, Index)
+
+        super().__init__(index)
+        self._auxiliary_indices = {}
+        self._projections = None
+        self._cache = None
+        self._metrics = None
+        self._index_metrics = {}
+        self._views = {}
 
     def __getitem__(self, bounds):
         yield from self._source[bounds]
@@ -455,25 +1887,166 @@ class Table(Selection):
     def __len__(self):
         return len(self._source)
 
-    def add_index(self, name, key_columns):
+    def add_index(self, name, key_columns, include=(), hashed=False):
         if name in self._auxiliary_indices:
             raise ValueError
 
         if set(key_columns) > set(self.schema().column_names()):
             raise ValueError
 
+        if not set(include) <= set(self.schema().column_names()):
+            raise ValueError
+
         columns = {c.name: c for c in self.schema().columns()}
         key = [columns[name] for name in key_columns]
         key += [c for c in self.schema().key if c not in key]
-        schema = Schema(tuple(key), tuple())
-        index = Index(schema, self.select([c.name for c in key]))
+        value = [columns[name] for name in include if columns[name] not in key]
+        schema = Schema(tuple(key), tuple(value))
+        hashed = len(key_columns) if hashed else False
+        rows = self.select(schema.column_names())
+        index = self._source._copy(rows, schema=schema, hashed=hashed)
         self._auxiliary_indices[name] = index
+        self._projections = None
+        self._attach_metrics()
+
+    def add_view(self, name, columns, aggregates):
+        if name in self._views:
+            raise ValueError
+
+        view = MaterializedView(self.schema(), columns, aggregates)
+        for row in self._source:
+            view.add(row)
+
+        self._views[name] = view
+        return view
+
+    def approx_count(self, sample_size=1000, rng=None):
+        return self._source.approx_count(sample_size, rng)
+
+    def batch(self):
+        return Batch(self)
+
+    def bulk_insert(self, rows, run_size=100000):
+        schema = self.schema()
+        convert = schema.converter()
+        key_len = len(schema.key)
+        by_key = operator.itemgetter(slice(0, key_len))
+
+        primary = ExternalSort(run_size, by_key)
+        auxiliary = {}
+        for name, index in self._auxiliary_indices.items():
+            project = schema.projector(index.schema().column_names())
+            auxiliary[name] = (project, ExternalSort(run_size))
+
+        for row in rows:
+            if len(row) != len(schema):
+                raise ValueError(row)
+
+            row = convert(row)
+            primary.add(row)
+            for project, index_rows in auxiliary.values():
+                index_rows.add(project(row))
+
+        def unique(rows):
+            previous = None
+            for row in rows:
+                key = row[:key_len]
+                if key == previous:
+                    raise ValueError("duplicate key {}".format(key))
+
+                previous = key
+                yield row
+
+        rows = unique(heapq.merge(self._source, primary, key=by_key))
+        source = self._source._copy(rows, presorted=True)
+
+        # nothing is replaced until every index has been built, so a
+        # duplicate key leaves the table as it was
+        indices = {}
+        for name, index in self._auxiliary_indices.items():
+            _projection, index_rows = auxiliary[name]
+            rows = heapq.merge(index, index_rows)
+            indices[name] = index._copy(rows, presorted=True)
+
+        self._swap(source, indices)
+
+    def cache_info(self):
+        if self._cache is None:
+            return None
+
+        return self._cache.info()
 
     def delete(self):
         deleted = self._source.delete()
         for index in self._auxiliary_indices.values():
             index.delete()
 
+        for view in self._views.values():
+            view.clear()
+
+        if self._cache is not None:
+            self._cache.clear()
+
+    def disable_cache(self):
+        self._cache = None
+
+    def disable_metrics(self):
+        self._metrics = None
+        self._index_metrics = {}
+        self._attach_metrics()
+
+    def enable_cache(self, maxsize=128, max_rows=None):
+        self._cache = QueryCache(maxsize, max_rows)
+
+    def enable_metrics(self, hook=None):
+        self._metrics = Metrics("table", hook)
+        self._index_metrics = {}
+        self._attach_metrics()
+
+    def explain(self, bounds=None, order=None, analyze=False):
+        residual = []
+        if bounds:
+            bounds = self._normalize_bounds(bounds)
+            selection, residual = self._plan_bounds(bounds)
+            if order and selection.supports_order(list(order)):
+                selection = OrderSelection(selection, list(order), False)
+            elif order:
+                selection = SortSelection(selection, list(order))
+        elif order:
+            selection, unordered = self._plan_order(list(order))
+            if unordered or not self.supports_order(list(order)):
+                selection = SortSelection(
+                    TableIndexSliceSelection(self, self._source), list(order))
+        else:
+            selection = TableIndexSliceSelection(self, self._source)
+
+        measured = None
+        if analyze:
+            measured = {}
+            analyzed = _analyze(selection, measured)
+            if residual:
+                filtered = dict(residual)
+                analyzed = _MeasuredSelection(FilterSelection(
+                    analyzed, lambda row: _bounds_contain(filtered, row)))
+
+            start = time.perf_counter()
+            rows = sum(1 for _ in analyzed)
+            seconds = time.perf_counter() - start
+
+        plan = self._describe(selection, measured)
+        if residual:
+            plan = {"operation": "filter", "bounds": dict(residual), "source": plan}
+            plan["supported"] = False
+            if analyze:
+                plan["rows"] = analyzed.rows
+                plan["seconds"] = analyzed.seconds
+
+        if analyze:
+            plan["total_rows"] = rows
+            plan["total_seconds"] = seconds
+
+        return plan
+
     def insert(self, row):
         if len(row) != len(self.schema()):
             raise ValueError
@@ -486,75 +2059,89 @@ class Table(Selection):
 
         self.upsert(key, value)
 
-    def order_by(self, columns, reverse=False):
-        if not self.supports_order(columns):
-            raise IndexError
+    @classmethod
+    def load(cls, path):
+        with SnapshotReader(path) as snapshot:
+            (key, value, options, auxiliary) = snapshot.header
+            schema = Schema(
+                [(name, _SNAPSHOT_CTRS[ctr], *dictionary) for (name, ctr, *dictionary) in key],
+                [(name, _SNAPSHOT_CTRS[ctr], *dictionary) for (name, ctr, *dictionary) in value])
 
-        if not set(self.schema().column_names()) >= set(columns):
-            raise IndexError
+            # every section is in key order, so each tree is built bottom-up
+            table = cls(Index(schema, snapshot.rows(), True, *options))
+            columns = {c.name: c for c in schema.columns()}
+            for (name, key, value, hashed) in auxiliary:
+                index_schema = Schema([columns[c] for c in key], [columns[c] for c in value])
+                table._auxiliary_indices[name] = table._source._copy(
+                    snapshot.rows(), True, index_schema, hashed)
 
-        selection = TableIndexSliceSelection(self, self._source)
-        key_columns = self.schema().key_names()
-        while columns:
-            initial_columns = list(columns)
-            for i in reversed(range(1, len(columns) + 1)):
-                subset = list(columns[:i])
+        return table
 
-                if self._source.supports_order(subset):
-                    selection = TableIndexSliceSelection(self, self._source)
-                    columns = columns[i:]
-                    break
+    def order_by(self, columns, reverse=False):
+        if not set(self.schema().column_names()) >= set(columns):
+            raise IndexError
 
-                for index in self._auxiliary_indices.values():
-                    if index.supports_order(subset):
-                        index_slice = TableIndexSliceSelection(self, index)
-                        selection = MergeSelection(selection, index_slice)
-                        columns = columns[i:]
-                        break
+        selection, residual = self._plan_order(list(columns))
+        if residual or not self.supports_order(columns):
+            # sorted rows are not cached, so that a limit can still use a heap
+            return SortSelection(TableIndexSliceSelection(self, self._source), columns, reverse)
 
-            if columns == initial_columns:
-                raise IndexError
+        if reverse:
+            selection = OrderSelection(selection, columns, reverse)
 
-        return selection
+        return self._cached(("order_by", tuple(columns), reverse), {}, selection)
 
     def rebalance(self):
         self._source.rebalance()
 
+    def save(self, path):
+        def columns(columns):
+            if any(_SNAPSHOT_CTRS.get(c.ctr.__name__) is not c.ctr for c in columns):
+                raise TypeError("a snapshot cannot store the columns {}".format(
+                    [str(c) for c in columns]))
+
+            # a dictionary column is stored by value, and marked so that it
+            # is encoded again when loaded
+            return tuple(
+                (c.name, c.ctr.__name__) + ((True,) if c.dictionary is not None else ())
+                for c in columns)
+
+        source = self._source
+        options = (
+            source._binary_keys, source._compress_prefix, source._hashed,
+            source._bloom_error_rate, source._compact)
+        auxiliary = tuple(
+            (name, tuple(index.schema().key_names()),
+             tuple(index.schema().value_names()), index._hashed)
+            for name, index in self._auxiliary_indices.items())
+
+        header = (columns(self.schema().key), columns(self.schema().value), options, auxiliary)
+        write_snapshot(path, header, [source] + list(self._auxiliary_indices.values()))
+
+    def sample(self, n, rng=None):
+        return self._source.sample(n, rng)
+
     def schema(self):
         return self._source.schema()
 
     def slice(self, bounds):
-        columns = self.schema().column_names()
-        if not set(columns) >= set(bounds.keys()):
+        bounds = self._normalize_bounds(bounds)
+        selection, residual = self._plan_bounds(bounds)
+        if residual:
             raise IndexError
 
-        bounds = [(c, bounds[c]) for c in columns if c in bounds]
-        while bounds and bounds[-1][1] == slice(None):
-            bounds = bounds[:-1]
+        key = ("slice", tuple((c, _freeze(v)) for c, v in bounds))
+        return self._cached(key, dict(bounds), selection)
 
-        selection = TableIndexSliceSelection(self, self._source, {})
-        key_columns = self.schema().key_names()
-        while bounds:
-            initial_bounds = list(bounds)
-            for i in reversed(range(1, len(bounds) + 1)):
-                subset = dict(bounds[:i])
+    def stats(self):
+        stats = self._source.stats()
+        stats["indices"] = {
+            name: index.stats() for name, index in self._auxiliary_indices.items()}
 
-                if self._source.supports_bounds(subset):
-                    selection = TableIndexSliceSelection(self, self._source, subset)
-                    bounds = bounds[i:]
-                    break
-
-                for index in self._auxiliary_indices.values():
-                    if index.supports_bounds(subset):
-                        index_slice = TableIndexSliceSelection(self, index, subset)
-                        selection = MergeSelection(selection, index_slice)
-                        bounds = bounds[i:]
-                        break
+        if self._metrics is not None:
+            stats["maintenance"] = dict(self._metrics.counters)
 
-            if bounds == initial_bounds:
-                raise IndexError
-
-        return selection
+        return stats
 
     def supports_bounds(self, bounds):
         bounds = list(bounds)
@@ -604,19 +2191,7 @@ class Table(Selection):
         if set(value.keys()) > set(self.schema().key_names()):
             raise ValueError
 
-        key_len = len(self.schema().key)
-        value_names = self.schema().value_names()
-        value_labels = dict(zip(value_names, range(len(value_names))))
-
-        for row in self.index():
-            row_key = row[:key_len]
-            row_value = row[key_len:]
-            new_value = tuple(
-                value[c] if c in value else row_value[value_labels[c]]
-                for c in value_names)
-            if row_value != new_value:
-                self.upsert(row_key, new_value)
-
+        self._update_range({}, value)
         return self
 
     def upsert(self, key, value):
@@ -633,20 +2208,94 @@ class Table(Selection):
 
         self._delete_row(key)
         self._source.insert(row)
+        if self._views:
+            self._update_views(None, self._source._convert(row))
 
-        if self._auxiliary_indices:
-            row = dict(zip(self.schema().column_names(), row))
-            for index in self._auxiliary_indices.values():
-                index_row = [row[c] for c in index.schema().column_names()]
-                index.insert(index_row)
+        if self._auxiliary_indices or self._cache is not None:
+            start = time.perf_counter()
+            for (index, project, _project_key) in self._projectors():
+                index.insert(project(row))
+
+            self._maintained("auxiliary_inserts", start)
+            self._invalidate(row)
+
+    def view(self, name):
+        return self._views[name]
+
+    def _attach_metrics(self):
+        indices = dict(self._auxiliary_indices, primary=self._source)
+        for name, index in indices.items():
+            if self._metrics is None:
+                index.set_metrics(None)
+            else:
+                metrics = Metrics(name, self._metrics.hook)
+                index.set_metrics(self._index_metrics.setdefault(name, metrics))
+
+    def _cached(self, key, bounds, selection):
+        if self._cache is None:
+            return selection
+
+        try:
+            hash(key)
+        except TypeError:
+            return selection
+
+        return CachedSelection(self._cache, key, bounds, selection)
+
+    def _describe(self, selection, measured=None):
+        names = {id(index): name for name, index in self._auxiliary_indices.items()}
+        names[id(self._source)] = "primary"
+
+        if isinstance(selection, TableIndexSliceSelection):
+            index = selection._source
+            plan = {
+                "operation": "slice" if selection._bounds else "scan",
+                "index": names[id(index)],
+                "bounds": dict(selection._bounds),
+                "hashed": index.hashes(selection._bounds) if selection._bounds else False,
+            }
+        elif isinstance(selection, MergeSelection):
+            covering = selection._covering(selection.schema().column_names())
+            plan = {
+                "operation": "merge",
+                "covering": covering is not None,
+                "driver": self._describe(selection._right, measured),
+                "lookup": self._describe(selection._source, measured),
+            }
+        elif isinstance(selection, OrderSelection):
+            plan = {
+                "operation": "order",
+                "reverse": selection._reverse,
+                "source": self._describe(selection._source, measured),
+            }
+        elif isinstance(selection, SortSelection):
+            plan = {
+                "operation": "sort",
+                "columns": selection._columns,
+                "reverse": selection._reverse,
+                "limit": selection._limit,
+                "source": self._describe(selection._source, measured),
+            }
+        else:
+            raise NotImplementedError(selection)
+
+        if measured is not None:
+            # a stage which the plan never read is absent from measured
+            measure = measured.get(id(selection))
+            plan["rows"] = measure.rows if measure else 0
+            plan["seconds"] = measure.seconds if measure else 0.
+            if measure and measure.lookups:
+                plan["lookups"] = measure.lookups
+
+        return plan
 
     def _delete_row(self, key):
         key_names = self.schema().key_names()
         if not len(key) == len(key_names):
             raise KeyError
 
-        key_dict = dict(zip(key_names, key))
-        row = list(self.slice(key_dict))
+        # an exact key needs no plan, and must not go through the cache
+        row = list(self._source[key])
         if not row:
             return
         elif len(row) > 1:
@@ -655,11 +2304,143 @@ class Table(Selection):
             row = row[0]
 
         del self._source[key]
-        if self._auxiliary_indices:
-            row = dict(zip(self.schema().column_names(), row))
-            for index in self._auxiliary_indices.values():
-                index_key = [row[c] for c in index.schema().key_names()]
-                del index[index_key]
+        if self._views:
+            self._update_views(row, None)
+
+        if self._auxiliary_indices or self._cache is not None:
+            start = time.perf_counter()
+            for (index, _project, project_key) in self._projectors():
+                del index[list(project_key(row))]
+
+            self._maintained("auxiliary_deletes", start)
+            self._invalidate(row)
+
+    def _delete_range(self, bounds):
+        if not bounds:
+            return self.delete()
+
+        # an index which holds the range in order drops it whole, like the
+        # primary index; the rows are read a batch at a time, before the range
+        # is dropped, only to delete them from the other indices and to update
+        # the views and the cache
+        ranged = [
+            index for index in self._auxiliary_indices.values()
+            if index._hash is None and index.supports_bounds(bounds)]
+        others = [
+            (index, project_key) for (index, _project, project_key) in self._projectors()
+            if all(index is not r for r in ranged)]
+
+        if others or self._views or self._cache is not None:
+            rows = iter(self._source.slice(bounds))
+            for batch in iter(lambda: list(itertools.islice(rows, _BATCH_SIZE)), []):
+                for row in batch:
+                    self._update_views(row, None)
+                    self._invalidate(row)
+
+                start = time.perf_counter()
+                for (index, project_key) in others:
+                    index.remove(project_key(row) for row in batch)
+
+                self._maintained("auxiliary_deletes", start, len(batch) * len(others))
+
+        deleted = len(self._source)
+        del self._source[convert_bounds(bounds)]
+        deleted -= len(self._source)
+
+        start = time.perf_counter()
+        for index in ranged:
+            del index[convert_bounds(bounds)]
+
+        self._maintained("auxiliary_deletes", start, deleted * len(ranged))
+
+    def _indices_for(self, bounds):
+        # a hashed index answers an exact match without descending a tree
+        indices = list(self._auxiliary_indices.values())
+        return sorted(indices, key=lambda index: not index.hashes(bounds))
+
+    def _invalidate(self, row):
+        if self._cache is not None:
+            self._cache.invalidate(dict(zip(self.schema().column_names(), row)))
+
+    def _normalize_bounds(self, bounds):
+        columns = self.schema().column_names()
+        if not set(columns) >= set(bounds.keys()):
+            raise IndexError
+
+        bounds = [(c, bounds[c]) for c in columns if c in bounds]
+        while bounds and bounds[-1][1] == slice(None):
+            bounds = bounds[:-1]
+
+        return bounds
+
+    def _plan_bounds(self, bounds):
+        # returns the selection and whichever bounds no index could take
+        selection = TableIndexSliceSelection(self, self._source, {})
+        while bounds:
+            initial_bounds = list(bounds)
+            for i in reversed(range(1, len(bounds) + 1)):
+                subset = dict(bounds[:i])
+
+                if self._source.supports_bounds(subset):
+                    selection = TableIndexSliceSelection(self, self._source, subset)
+                    bounds = bounds[i:]
+                    break
+
+                for index in self._indices_for(subset):
+                    if index.supports_bounds(subset):
+                        index_slice = TableIndexSliceSelection(self, index, subset)
+                        selection = MergeSelection(selection, index_slice)
+                        bounds = bounds[i:]
+                        break
+
+            if bounds == initial_bounds:
+                break
+
+        return selection, bounds
+
+    def _plan_order(self, columns):
+        selection = TableIndexSliceSelection(self, self._source)
+        while columns:
+            initial_columns = list(columns)
+            for i in reversed(range(1, len(columns) + 1)):
+                subset = list(columns[:i])
+
+                if self._source.supports_order(subset):
+                    selection = TableIndexSliceSelection(self, self._source)
+                    columns = columns[i:]
+                    break
+
+                for index in self._auxiliary_indices.values():
+                    if index.supports_order(subset):
+                        index_slice = TableIndexSliceSelection(self, index)
+                        selection = MergeSelection(selection, index_slice)
+                        columns = columns[i:]
+                        break
+
+            if columns == initial_columns:
+                break
+
+        return selection, columns
+
+    def _maintained(self, counter, start, n=None):
+        if self._metrics is not None:
+            n = len(self._auxiliary_indices) if n is None else n
+            if n:
+                self._metrics.count(counter, n)
+                self._metrics.count("auxiliary_seconds", time.perf_counter() - start)
+
+    def _projectors(self):
+        # the functions which project a row of this table to a row and a key
+        # of each auxiliary index, kept until the set of indices changes
+        if self._projections is None:
+            schema = self.schema()
+            self._projections = [
+                (index,
+                 schema.projector(index.schema().column_names()),
+                 schema.projector(index.schema().key_names()))
+                for index in self._auxiliary_indices.values()]
+
+        return self._projections
 
     def _update_row(self, key, value):
         value_names = self.schema().value_names()
@@ -675,9 +2456,102 @@ class Table(Selection):
             row = row[0]
 
         value_index = dict(zip(value_names, range(len(value_names))))
-        old_value = row[-len(value_names):]
+        old_value = row[len(self.schema().key):]
         new_value = tuple(
             value[c] if c in value else old_value[value_index[c]]
             for c in value_names)
-        self.upsert(key, new_value)
+        self._replace_row(row, new_value)
+
+    def _replace_row(self, row, value):
+        new_row = self._replaced(row, value)
+        if new_row is not None:
+            self._source.replace(new_row[:len(self.schema().key)], new_row)
+
+    def _replaced(self, row, value):
+        # maintains the other indices, the views and the cache for a change to
+        # the value of a row, and returns the new row, or None if it is unchanged;
+        # the caller writes it to the primary index
+        key_len = len(self.schema().key)
+        key = tuple(row[:key_len])
+        new_row = key + tuple(value)
+        if len(new_row) != len(self.schema()):
+            raise ValueError(value)
+
+        column_names = self.schema().column_names()
+        changed = set(
+            column_names[i] for i in range(key_len, len(column_names))
+            if row[i] != new_row[i])
+
+        if not changed:
+            return None
+
+        if self._auxiliary_indices or self._cache is not None:
+            self._invalidate(row)
+            self._invalidate(new_row)
 
+            start = time.perf_counter()
+            replaced = 0
+            for (index, project, project_key) in self._projectors():
+                if changed.isdisjoint(index.schema().column_names()):
+                    continue
+
+                replaced += 1
+                index_key = list(project_key(row))
+                index_row = project(new_row)
+                if changed.isdisjoint(index.schema().key_names()):
+                    index.replace(index_key, index_row)
+                else:
+                    del index[index_key]
+                    index.insert(index_row)
+
+            self._maintained("auxiliary_replaces", start, replaced)
+
+        if self._views:
+            self._update_views(row, self._source._convert(new_row))
+
+        return new_row
+
+    def _swap(self, source, indices):
+        self._source = source
+        self._auxiliary_indices = indices
+        self._projections = None
+        self._attach_metrics()
+
+        for view in self._views.values():
+            view.clear()
+            for row in source:
+                view.add(row)
+
+        if self._cache is not None:
+            self._cache.clear()
+
+    def _update_range(self, bounds, value):
+        # rewrites the rows in a single walk over the range of the primary
+        # index, in key order, with no copy of the rows and no lookup per row
+        value_names = self.schema().value_names()
+        if set(value.keys()) > set(value_names):
+            raise ValueError
+
+        # new values go into the dictionaries before the walk, which they
+        # would otherwise interrupt if their codes had to be renumbered
+        for c in self.schema().value:
+            if c.dictionary is not None and c.name in value:
+                c.dictionary.add(c.ctr(value[c.name]))
+
+        key_len = len(self.schema().key)
+
+        def rewrite(row):
+            old_value = row[key_len:]
+            new_value = tuple(
+                value[c] if c in value else old_value[i]
+                for (i, c) in enumerate(value_names))
+            return self._replaced(row, new_value)
+
+        self._source.rewrite(rewrite, bounds)
+
+    def _update_views(self, old, new):
+        for view in self._views.values():
+            if old is not None:
+                view.remove(old)
+            if new is not None:
+                view.add(new)
@@ -1,6 +1,9 @@
 import itertools
+import os
+import random
+import tempfile
 
-from table import Index, Schema, Table
+from table import Index, Schema, SchemaSelection, Table
 
 
 def new_table(key, value=[]):
@@ -101,6 +104,388 @@ def test_add_index():
     assert actual == [("One", 2, "Three"), ("Four", 5, "Six")]
 
 
+def test_covering_index():
+    pk = (("one", str),)
+    cols = (("two", int), ("three", str), ("four", int))
+    t = new_table(pk, cols)
+    t.insert(("One", 2, "Three", 4))
+    t.insert(("Four", 5, "Six", 7))
+    t.add_index("aux", ["two"], include=["three"])
+    t.insert(("Seven", 8, "Nine", 10))
+
+    selection = t.slice({"two": slice(2, 8)}).select(["three", "one"])
+    assert isinstance(selection._source, SchemaSelection)
+    assert list(selection) == [("Three", "One"), ("Six", "Four")]
+
+    actual = list(t.slice({"two": slice(2, 8)}).select(["four"]))
+    assert actual == [(4,), (7,)]
+
+    t.upsert(("One",), (9, "Ten", 4))
+    t.slice({"two": 5}).delete()
+    actual = list(t.slice({"two": slice(0, 10)}).select(["one", "three"]))
+    assert actual == [("Seven", "Nine"), ("One", "Ten")]
+
+    t.add_index("full", ["four"], include=["two", "three"])
+    actual = list(t.slice({"four": slice(0, 5)}))
+    assert actual == [("One", 9, "Ten", 4)]
+
+    # the cache still lets a covering index answer, and keeps each projection
+    t.enable_cache()
+    selection = t.slice({"two": slice(0, 10)}).select(["three", "one"])
+    assert isinstance(selection._source._source, SchemaSelection)
+    assert list(selection) == [("Nine", "Seven"), ("Ten", "One")]
+    assert list(t.slice({"two": slice(0, 10)}).select(["three", "one"])) == [
+        ("Nine", "Seven"), ("Ten", "One")]
+    assert list(t.slice({"two": slice(0, 10)}).select(["one"])) == [("Seven",), ("One",)]
+    assert t.cache_info().hits == 1 and t.cache_info().currsize == 2
+
+
+def test_bulk_insert():
+    pk = (("one", int), ("two", str))
+    cols = (("three", float),)
+    t = new_table(pk, cols)
+    t.add_index("aux", ["three"])
+    t.insert((0, "0", 100.))
+
+    rows = [(i % 10, str(i), 100 - i) for i in range(100, 0, -1)]
+    t.bulk_insert(rows, run_size=7)
+    assert len(t) == 101
+
+    expected = sorted([(i % 10, str(i), float(100 - i)) for i in range(1, 101)])
+    expected.insert(0, (0, "0", 100.))
+    assert list(t) == expected
+
+    actual = list(t.slice({"three": slice(0, 3)}).select(["one", "two"]))
+    assert actual == [(0, "100"), (9, "99"), (8, "98")]
+
+    try:
+        t.bulk_insert([(1, "1", 5.)], run_size=7)
+        assert False
+    except ValueError:
+        pass
+
+    assert len(t) == 101
+    assert len(list(t.slice({"three": 5.}))) == 1
+
+
+def test_binary_keys():
+    pk = (("type", str), ("key", tuple))
+    values = (("id", int), ("weight", float))
+    t = Table(Index(Schema(pk, values), binary_keys=True))
+    t.add_index("id", ("id",))
+
+    for i in range(20):
+        t.insert(("node" if i % 2 else "edge", (i, -i), i, i / 2))
+
+    assert len(list(t.slice({"type": "node"}))) == 10
+    assert list(t.slice({"type": "node", "key": (1, -1)})) == [("node", (1, -1), 1, .5)]
+    actual = list(t.slice({"type": "edge", "key": slice((4,), (8,))}).select(["id"]))
+    assert actual == [(4,), (6,)]
+    assert list(t.slice({"id": slice(-5, 2)}).select(["id"])) == [(0,), (1,)]
+
+    t.slice({"id": 3}).update({"weight": 0.})
+    t.slice({"type": "edge"}).delete()
+    assert list(t.slice({"id": slice(0, 4)}).select(["id", "weight"])) == [(1, .5), (3, 0.)]
+
+    t.bulk_insert([("edge", (-1,), -1, 0.)])
+    assert list(t.order_by(["id"]).select(["key"]).limit(2)) == [((-1,),), ((1, -1),)]
+
+
+def test_compress_prefix():
+    pk = (("type", str), ("group", int), ("key", int))
+    values = (("value", int),)
+    t = Table(Index(Schema(pk, values), compress_prefix=True))
+    t.add_index("value", ["value"])
+
+    for i in range(500):
+        t.insert(("node", i // 100, i, -i))
+
+    memory = t._source.key_memory()
+    assert memory["stored"] < memory["uncompressed"]
+
+    assert len(list(t.slice({"type": "node", "group": 2}))) == 100
+    assert list(t.slice({"value": slice(-3, -1)}).select(["key"])) == [(3,), (2,)]
+
+    t.slice({"type": "node", "group": 3}).delete()
+    t.rebalance()
+    assert len(t) == 400
+
+
+def test_compact():
+    pk = (("a", int), ("b", int))
+    cols = (("c", float),)
+    t = Table(Index(Schema(pk, cols), compact=True))
+    for i in range(100):
+        t.insert((i % 10, i, i / 2))
+
+    t.add_index("c", ["c"])
+    t.add_index("name", ["b"], include=["c"])
+    assert list(t.slice({"a": 3, "b": slice(20, 50)})) == [
+        (3, 23, 11.5), (3, 33, 16.5), (3, 43, 21.5)]
+    assert list(t.slice({"c": slice(1., 3.)}).select(["b"])) == [(b,) for b in range(2, 6)]
+
+    t.slice({"a": 3}).update({"c": -1.})
+    t.slice({"a": 4}).delete()
+    assert len(list(t.slice({"c": -1.}))) == 10
+    assert len(t) == 90
+
+    t.rebalance()
+    memory = t._source.key_memory()
+    assert memory["stored"] == 90 * 24 < memory["uncompressed"]
+
+
+def test_schema_functions():
+    schema = Schema((("a", int), ("b", str)), (("c", float),))
+    convert = schema.converter()
+    assert convert is Schema((("x", int), ("y", str)), (("z", float),)).converter()
+    assert convert(["1", 2, 3]) == (1, "2", 3.)
+
+    row = (1, "2", 3.)
+    assert all(v1 is v2 for v1, v2 in zip(convert(row), row))
+
+    try:
+        convert((1, "2"))
+        assert False
+    except ValueError:
+        pass
+
+    assert schema.projector(["c", "a"])(row) == (3., 1)
+    assert schema.projector(["b"])(row) == ("2",)
+    assert schema.projector(["b"]) is schema.projector(("b",))
+
+
+def test_save_load():
+    pk = (("a", int), ("b", str))
+    cols = (("c", float), ("d", bytes), ("e", tuple))
+    t = Table(Index(Schema(pk, cols), hashed=1, bloom_error_rate=0.05))
+    t.add_index("c", ["c"], include=["d"])
+    t.add_index("e", ["e"], hashed=True)
+    for i in range(3000):
+        t.insert((i % 7, str(i), i / 4, bytes([i % 256]), (i % 3, "x")))
+
+    t.slice({"a": 3}).delete()
+    path = os.path.join(tempfile.mkdtemp(), "table")
+    t.save(path)
+
+    loaded = Table.load(path)
+    assert loaded.schema() == t.schema()
+    assert list(loaded) == list(t)
+    assert list(loaded._auxiliary_indices) == ["c", "e"]
+    for name, index in t._auxiliary_indices.items():
+        assert loaded._auxiliary_indices[name].schema() == index.schema()
+        assert list(loaded._auxiliary_indices[name]) == list(index)
+
+    assert loaded._source.hashes((1,)) and loaded._auxiliary_indices["e"].hashes(((2, "x"),))
+    assert loaded._source.bloom_info().error_rate == 0.05
+    assert list(loaded.slice({"c": slice(1., 2.)}).select(["b"])) == [("4",), ("5",), ("6",), ("7",)]
+
+    loaded.insert((3, "x", 0., b"", ()))
+    assert len(loaded) == len(t) + 1
+
+    t = new_table((("a", int),), (("b", lambda v: v),))
+    try:
+        t.save(path)
+        assert False
+    except TypeError:
+        pass
+
+    assert len(Table.load(path)) == len(loaded) - 1
+
+
+def test_batch():
+    pk = (("a", int), ("b", int))
+    t = new_table(pk, (("c", str),))
+    t.add_index("c", ["c"])
+    for i in range(100):
+        t.insert((i // 10, i % 10, str(i % 3)))
+
+    before = (list(t), list(t._auxiliary_indices["c"]))
+    with t.batch() as batch:
+        batch.insert((10, 0, "x"))
+        batch.upsert(("3", "3"), ("x",))
+        batch.delete((5, 5))
+        batch.delete((20, 0))
+        batch.insert((5, 5, "y"))
+        assert len(batch) == 4
+
+    assert len(t) == 101
+    assert list(t.slice({"c": "x"})) == [(3, 3, "x"), (10, 0, "x")]
+    assert list(t.slice({"a": 5, "b": 5})) == [(5, 5, "y")]
+
+    # an error while applying undoes everything applied so far
+    index = t._auxiliary_indices["c"]
+    before = (list(t), list(index))
+    inserts = []
+
+    def insert(row):
+        inserts.append(row)
+        if len(inserts) == 2:
+            raise RuntimeError
+
+        type(index).insert(index, row)
+
+    index.insert = insert
+    batch = t.batch()
+    for i in range(5):
+        batch.upsert((0, i), ("z",))
+
+    try:
+        batch.commit()
+        assert False
+    except RuntimeError:
+        pass
+
+    del index.insert
+    assert (list(t), list(index)) == before
+    assert not list(t.slice({"c": "z"}))
+
+    try:
+        with t.batch() as batch:
+            batch.delete((0, 0))
+            batch.insert((0, 1, "0"))
+        assert False
+    except ValueError:
+        pass
+
+    try:
+        with t.batch() as batch:
+            batch.delete((0, 0))
+            raise KeyError
+    except KeyError:
+        pass
+
+    assert (list(t), list(index)) == before
+
+    # a large batch rebuilds the indices from merged rows
+    with t.batch() as batch:
+        for i in range(101, 201):
+            batch.insert((i // 10, i % 10, str(i % 3)))
+
+        batch.delete((0, 0))
+
+    assert len(t) == 200
+    assert t._auxiliary_indices["c"] is not index
+    assert list(t.slice({"c": "1"})) == [row for row in t if row[2] == "1"]
+    assert list(t._auxiliary_indices["c"]) == sorted(
+        (row[2], row[0], row[1]) for row in t)
+
+
+def test_views():
+    pk = (("a", int), ("b", int))
+    t = new_table(pk, (("c", str), ("d", float)))
+    for i in range(30):
+        t.insert((i // 10, i % 10, str(i % 3), float(i)))
+
+    def expected(columns, rows):
+        groups = {}
+        for row in rows:
+            groups.setdefault(tuple(row[i] for i in columns), []).append(row[3])
+
+        return [
+            group + (len(d), sum(d), min(d), max(d))
+            for group, d in sorted(groups.items())]
+
+    aggregates = [("count", None), ("sum", "d"), ("min", "d"), ("max", "d")]
+    by_c = t.add_view("c", ["c"], aggregates)
+    by_ac = t.add_view("ac", ["a", "c"], aggregates)
+    assert list(by_c) == expected([2], t)
+    assert by_c["1"] == (10, 145., 1., 28.)
+
+    t.upsert((0, 1), ("1", 100.))
+    t.insert((5, 0, "3", -1.))
+    t.slice({"a": 2, "b": slice(5, 10)}).delete()
+    t.slice({"a": 1}).update({"d": 0.})
+    with t.batch() as batch:
+        batch.delete((0, 0))
+        batch.upsert((0, 4), ("0", 50.))
+
+    assert t.view("c") is by_c
+    assert list(by_c) == expected([2], t)
+    assert list(by_ac) == expected([0, 2], t)
+    assert len(by_ac) == 10
+
+    # the last row of a group removes it
+    t.slice({"a": 5}).delete()
+    assert "3" not in [row[0] for row in by_c]
+
+    t.bulk_insert([(6, i, "x", float(i)) for i in range(5)])
+    assert by_c["x"] == (5, 10., 0., 4.)
+    assert list(by_ac) == expected([0, 2], t)
+
+    t.delete()
+    assert list(by_c) == []
+
+    try:
+        t.add_view("bad", ["c"], [("median", "d")])
+        assert False
+    except ValueError:
+        pass
+
+
+def test_sort():
+    pk = (("a", int),)
+    t = new_table(pk, (("b", int), ("c", str)))
+    t.add_index("b", ["b"])
+    for i in range(50):
+        t.insert((i, i % 7, str((i * 13) % 50).zfill(2)))
+
+    by_c = sorted(t, key=lambda row: row[2])
+    assert list(t.order_by(["c"])) == by_c
+    assert list(t.order_by(["c"], reverse=True)) == list(reversed(by_c))
+    assert list(t.order_by(["c"]).limit(3)) == by_c[:3]
+    assert list(t.order_by(["c"], reverse=True).limit(4).limit(2)) == by_c[:-3:-1]
+    assert list(t.order_by(["c"]).select(["a"]).limit(2)) == [(row[0],) for row in by_c[:2]]
+
+    # an index order is still preferred, forwards or backwards
+    assert t.explain(order=["b"])["operation"] == "merge"
+    assert list(t.order_by(["b"], reverse=True)) == sorted(
+        t, key=lambda row: (row[1], row[0]), reverse=True)
+
+    plan = t.explain(order=["c"], analyze=True)
+    assert plan["operation"] == "sort" and plan["total_rows"] == 50
+    assert plan["source"]["rows"] == 50
+
+    # sorting spills runs to disk, and selections sort when no index helps
+    selection = t.slice({"b": 3}).order_by(["c"], reverse=True)
+    selection._run_size = 2
+    assert list(selection) == sorted(
+        (row for row in t if row[1] == 3), key=lambda row: row[2], reverse=True)
+
+    # a slice of the primary index is sorted by a column which only an
+    # auxiliary index holds in order, rather than read in primary key order
+    t.add_index("c", ["c"])
+    in_range = [row for row in t if 2 <= row[0] < 30]
+    assert list(t.slice({"a": slice(2, 30)}).order_by(["c"])) == sorted(
+        in_range, key=lambda row: row[2])
+    assert list(t.slice({"a": slice(2, 30)}).order_by(["a"], reverse=True)) == in_range[::-1]
+    assert list(t.slice({"b": 3}).order_by(["b"])) == [row for row in t if row[1] == 3]
+
+
+def test_hash_aggregate():
+    pk = (("a", int),)
+    t = new_table(pk, (("b", int), ("c", str)))
+    t.add_index("b", ["b"])
+    for i in range(200):
+        t.insert((i, i % 7, str(i % 30)))
+
+    # an index order groups by streaming, anything else by hashing
+    assert list(t.group_by(["b"])) == [(b,) for b in range(7)]
+    assert list(t.group_by(["c"])) == [(str(i),) for i in range(30)]
+    assert list(t.select(["b", "c"]).distinct()) == list(dict.fromkeys(
+        (row[1], row[2]) for row in t))
+    assert t.slice({"b": 3}).select(["c"]).distinct().count() == len(
+        set(row[2] for row in t if row[1] == 3))
+
+    # past max_groups, rows with new groups spill to partitions
+    aggregate = t.group_by(["c", "b"])
+    aggregate._max_groups = 4
+    aggregate._fan_out = 3
+    groups = list(aggregate)
+    assert len(groups) == len(set(groups)) == 200
+    assert groups[:4] == [("0", 0), ("1", 1), ("2", 2), ("3", 3)]
+    assert aggregate.schema().column_names() == ["c", "b"]
+
+
 def test_ordering():
     pk = (("one", int), ("two", int), ("three", int))
     t = new_table(pk, [("four", str)])
@@ -241,6 +626,357 @@ def test_update():
     assert actual2 == expected
 
 
+def test_update_in_place():
+    pk = (("one", int),)
+    cols = (("count", int), ("two", int), ("three", str))
+    t = new_table(pk, cols)
+    t.add_index("aux", ["two"], include=["three"])
+
+    for i in range(10):
+        t.insert((i, 0, i % 3, str(i)))
+
+    for _ in range(3):
+        t.slice({"one": 5}).update({"count": 1})
+        t.update({"count": 2})
+
+    assert not t._source._source._rebalance_queue
+    assert not t._auxiliary_indices["aux"]._source._rebalance_queue
+    assert list(t.select(["count"])) == [(2,)] * 10
+
+    t.slice({"one": 4}).update({"three": "four"})
+    assert not t._auxiliary_indices["aux"]._source._rebalance_queue
+    assert list(t.slice({"two": 1}).select(["one", "three"])) == [
+        (1, "1"), (4, "four"), (7, "7")]
+
+    t.slice({"one": 4}).update({"two": 0})
+    assert list(t.slice({"two": 0}).select(["one"])) == [
+        (0,), (3,), (4,), (6,), (9,)]
+    assert len(t) == 10
+
+
+def test_query_cache():
+    pk = (("a", int),)
+    cols = (("b", int), ("c", str))
+    t = new_table(pk, cols)
+    t.add_index("b", ["b"])
+    for i in range(20):
+        t.insert((i, i % 4, str(i)))
+
+    assert t.cache_info() is None
+    t.enable_cache(maxsize=3)
+
+    low = t.slice({"a": slice(1, 5)})
+    assert list(low) == [(i, i % 4, str(i)) for i in range(1, 5)]
+    assert list(low) == [(i, i % 4, str(i)) for i in range(1, 5)]
+    assert len(list(t.slice({"a": slice(1, 5)}))) == 4
+    assert list(t.slice({"b": 2}).select(["a"])) == [(2,), (6,), (10,), (14,), (18,)]
+    assert t.cache_info() == (2, 2, 3, 2)
+
+    # a write outside a cached range leaves it in place
+    t.upsert((10,), (2, "ten"))
+    assert t.cache_info().currsize == 1
+    assert len(list(t.slice({"a": slice(1, 5)}))) == 4
+    assert t.cache_info().hits == 3
+
+    t.slice({"a": 3}).update({"c": "three"})
+    assert list(low)[2] == (3, 3, "three")
+    assert t.cache_info().hits == 3
+
+    t.slice({"a": 4}).delete()
+    assert list(low) == [(1, 1, "1"), (2, 2, "2"), (3, 3, "three")]
+
+    # an update which moves a row between ranges evicts both
+    assert list(t.slice({"b": 1}).select(["a"])) == [(1,), (5,), (9,), (13,), (17,)]
+    t.slice({"a": 5}).update({"b": 2})
+    assert list(t.slice({"b": 1}).select(["a"])) == [(1,), (9,), (13,), (17,)]
+    assert list(t.slice({"b": 2}).select(["a"])) == [(2,), (5,), (6,), (10,), (14,), (18,)]
+
+    for i in range(4):
+        list(t.slice({"b": i}))
+    assert t.cache_info().currsize == 3
+
+    # a partial scan is not cached
+    t.disable_cache()
+    t.enable_cache(max_rows=2)
+    assert next(iter(t.slice({"b": 0}))) == (0, 0, "0")
+    assert list(t.slice({"b": 0}).limit(1)) == [(0, 0, "0")]
+    assert t.cache_info().currsize == 0
+    list(t.slice({"b": 0}))
+    assert t.cache_info().currsize == 0
+    list(t.slice({"a": slice(0, 2)}))
+    assert t.cache_info().currsize == 1
+
+    t.delete()
+    assert t.cache_info().currsize == 0
+    assert list(t.slice({"a": slice(0, 2)})) == []
+
+
+def test_page():
+    def pages(selection, size, reverse=False):
+        rows, cursor = selection.page(size, reverse=reverse)
+        result = [rows]
+        while cursor is not None:
+            rows, cursor = selection.page(size, cursor)
+            result.append(rows)
+
+        return result
+
+    pk = (("a", int), ("b", int))
+    cols = (("c", str),)
+    for binary_keys in (False, True):
+        t = Table(Index(Schema(pk, cols), binary_keys=binary_keys))
+        t.add_index("c", ["c"])
+        for i in range(10):
+            for j in range(3):
+                t.insert((i, j, str(j)))
+
+        rows = list(t)
+        assert sum(pages(t, 7), []) == rows
+        assert [len(p) for p in pages(t, 10)] == [10, 10, 10, 0]
+        assert pages(t.slice({"a": 3}), 2) == [
+            [(3, 0, "0"), (3, 1, "1")], [(3, 2, "2")]]
+        assert pages(t.slice({"a": 3}), 2, reverse=True) == [
+            [(3, 2, "2"), (3, 1, "1")], [(3, 0, "0")]]
+        assert sum(pages(t.slice({"a": slice(2, 4)}), 4, True), []) == rows[11:5:-1]
+
+        odd = t.slice({"c": "1"}).filter(lambda r: r["a"] % 2).select(["a"])
+        assert pages(odd, 2) == [[(1,), (3,)], [(5,), (7,)], [(9,)]]
+        assert pages(odd, 2, reverse=True) == [[(9,), (7,)], [(5,), (3,)], [(1,)]]
+
+        # the scan resumes after the last row, even if that row was deleted
+        first, cursor = t.slice({"a": slice(1, 8)}).page(3)
+        t.slice({"a": 1}).delete()
+        rows, cursor = t.slice({"a": slice(1, 8)}).page(3, cursor)
+        assert rows == [(2, 0, "0"), (2, 1, "1"), (2, 2, "2")]
+
+        try:
+            t.slice({"a": 2}).page(3, cursor)
+            assert False
+        except ValueError:
+            pass
+
+        try:
+            t.limit(3).page(3)
+            assert False
+        except IndexError:
+            pass
+
+
+def test_hash_index():
+    pk = (("a", int), ("b", int))
+    cols = (("c", str), ("d", float))
+    t = Table(Index(Schema(pk, cols), hashed=True))
+    t.add_index("tree", ["c"])
+    t.add_index("hash", ["c"], hashed=True)
+    for i in range(20):
+        t.insert((i // 4, i % 4, str(i % 3), i))
+
+    primary = t._source
+    hashed = t._auxiliary_indices["hash"]
+    assert hashed.hashes({"c": "1"}) and not hashed.hashes({"c": slice("1", "2")})
+    assert not t._auxiliary_indices["tree"].hashes({"c": "1"})
+    assert t._indices_for({"c": "1"}) == [hashed, t._auxiliary_indices["tree"]]
+
+    assert primary.contains((2, 3))
+    assert not primary.contains((2, 4))
+    assert primary.contains((2,))
+    assert list(primary[(4, 1)]) == [(4, 1, "2", 17.)]
+
+    try:
+        t.insert((4, 1, "x", 0))
+        assert False
+    except ValueError:
+        pass
+
+    assert list(t.slice({"c": "2"}).select(["a", "b"])) == [
+        (0, 2), (1, 1), (2, 0), (2, 3), (3, 2), (4, 1)]
+
+    t.slice({"a": 1, "b": 1}).update({"c": "x", "d": 0})
+    t.upsert((4, 1), ("y", 1))
+    t.slice({"a": 2}).delete()
+    assert list(t.slice({"c": "2"}).select(["a", "b"])) == [(0, 2), (3, 2)]
+    assert list(t.slice({"c": "x"})) == [(1, 1, "x", 0.)]
+    assert list(t.slice({"c": "y"})) == list(t.slice({"a": 4, "b": 1}))
+
+    # the hash and the tree agree after every write
+    for index in (primary, hashed):
+        rows = sorted(r for rows in index._hash.values() for r in rows)
+        assert rows == list(index)
+
+    t.bulk_insert([(9, 0, "2", 0)])
+    assert list(t.slice({"c": "2"}).select(["a"])) == [(0,), (3,), (9,)]
+    assert t._source.contains((9, 0))
+
+    t.delete()
+    assert not t._source.contains((0, 0))
+    assert list(t.slice({"c": "2"})) == []
+
+    # every row is deleted while the bucket which holds them is being read
+    t = new_table((("a", int),), (("c", str),))
+    t.add_index("c", ["c"], hashed=True)
+    for i in range(10):
+        t.insert((i, str(i % 2)))
+
+    t.slice({"c": "0"}).delete()
+    assert list(t) == [(i, "1") for i in range(1, 10, 2)]
+    assert list(t.slice({"c": "0"})) == []
+
+
+def test_bloom_filter():
+    pk = (("a", int), ("b", str))
+    cols = (("c", int),)
+    t = Table(Index(Schema(pk, cols), bloom_error_rate=0.01))
+    assert new_table(pk, cols)._source.bloom_info() is None
+
+    for i in range(1500):
+        t.insert((i, str(i), i))
+
+    info = t._source.bloom_info()
+    assert info.capacity >= 1500
+    assert info.error_rate == 0.01
+    assert info.queries == info.negatives + info.false_positives
+
+    assert t._source.contains((5, "5"))
+    assert not t._source.contains((5, "6"))
+    assert list(t.slice({"a": 7, "b": "7"})) == [(7, "7", 7)]
+    assert list(t.slice({"a": 7})) == [(7, "7", 7)]
+
+    t.slice({"a": slice(1, 300)}).delete()
+    assert not t._source.contains((5, "5"))
+    t.rebalance()
+    assert len(t._source._bloom) == len(t) == 1201
+
+    before = t._source.bloom_info()
+    for i in range(10000, 20000):
+        assert not t._source.contains((i, str(i)))
+
+    info = t._source.bloom_info()
+    false_positives = info.false_positives - before.false_positives
+    assert info.queries - before.queries == 10000
+    assert false_positives < 200
+
+    t.delete()
+    assert not t._source.contains((0, "0"))
+    t.insert((0, "0", 0))
+    assert t._source.contains((0, "0"))
+
+
+def test_stats():
+    pk = (("a", int),)
+    cols = (("b", int),)
+    t = new_table(pk, cols)
+    t.add_index("b", ["b"])
+    for i in range(100):
+        t.insert((i, i % 7))
+
+    stats = t.stats()
+    assert stats["rows"] == 100 and stats["tombstones"] == 0
+    assert stats["depth"] > 1
+    assert "counters" not in stats and "maintenance" not in stats
+    assert stats["indices"]["b"]["rows"] == 100
+
+    events = []
+    t.enable_metrics(hook=lambda name, counter, n: events.append((name, counter)))
+    list(t.slice({"a": 5}))
+    for i in range(10, 20):
+        t.slice({"a": i}).delete()
+
+    for i in range(100, 200):
+        t.insert((i, i % 7))
+
+    t.slice({"a": 50}).update({"b": 0})
+    t.add_index("b2", ["b"])
+
+    stats = t.stats()
+    counters = stats["counters"]
+    assert stats["tombstones"] == 10
+    assert counters["tombstones_created"] == 10
+    assert counters["nodes_visited"] >= stats["depth"]
+    assert counters["comparisons"] > 0
+    assert counters["splits"] > 0
+    assert stats["maintenance"]["auxiliary_inserts"] == 100
+    assert stats["maintenance"]["auxiliary_deletes"] == 10
+    assert stats["maintenance"]["auxiliary_replaces"] == 1
+    assert stats["indices"]["b2"]["counters"] == {}
+    assert ("primary", "splits") in events
+    assert ("table", "auxiliary_inserts") in events
+
+    skipped = counters.get("tombstones_skipped", 0)
+    list(t)
+    assert t.stats()["counters"]["tombstones_skipped"] == skipped + 10
+
+    t.rebalance()
+    stats = t.stats()
+    assert stats["tombstones"] == 0
+    assert stats["counters"]["rebalances"] == 1
+    assert stats["counters"]["rebalance_rows"] > 0
+
+    t.bulk_insert([(1000, 1)])
+    assert t.stats()["counters"]["rebalances"] == 1
+
+    t.disable_metrics()
+    assert "counters" not in t.stats()
+
+
+def test_explain():
+    pk = (("a", int),)
+    cols = (("b", int), ("c", str), ("d", int))
+    t = new_table(pk, cols)
+    t.add_index("b", ["b"])
+    t.add_index("c", ["c"], include=["b"])
+    for i in range(20):
+        t.insert((i, i % 4, str(i % 3), i))
+
+    assert t.explain() == {
+        "operation": "scan", "index": "primary", "bounds": {}, "hashed": False}
+
+    plan = t.explain({"a": slice(2, 9), "b": 2})
+    assert plan["operation"] == "merge" and not plan["covering"]
+    assert plan["driver"]["index"] == "b"
+    assert plan["driver"]["bounds"] == {"b": 2}
+    assert plan["lookup"]["index"] == "primary"
+    assert plan["lookup"]["bounds"] == {"a": slice(2, 9)}
+
+    plan = t.explain({"a": slice(2, 9), "b": 2}, analyze=True)
+    assert plan["total_rows"] == plan["rows"] == 2
+    assert plan["driver"]["rows"] == 5
+    assert plan["lookup"]["lookups"] == 5
+    assert plan["lookup"]["rows"] == 2
+    assert plan["seconds"] >= plan["driver"]["seconds"]
+
+    plan = t.explain(order=["c"], analyze=True)
+    assert not plan["covering"] and plan["driver"]["index"] == "c"
+    assert plan["rows"] == plan["driver"]["rows"] == plan["lookup"]["lookups"] == 20
+
+    # bounds which no index takes are left for a filter
+    plan = t.explain({"b": 1, "d": 5})
+    assert plan["operation"] == "filter" and not plan["supported"]
+    assert plan["bounds"] == {"d": 5}
+    assert plan["source"]["driver"]["index"] == "b"
+
+    plan = t.explain(order=["d"])
+    assert plan["operation"] == "sort" and plan["columns"] == ["d"]
+
+    # a slice is only ordered by the index which it scans
+    plan = t.explain({"a": slice(2, 5)}, order=["c"])
+    assert plan["operation"] == "sort" and plan["source"]["index"] == "primary"
+    plan = t.explain({"b": 2}, order=["b"])
+    assert plan["operation"] == "order" and plan["source"]["driver"]["index"] == "b"
+
+    # analyzing a plan with a residual filter measures the filter too
+    plan = t.explain({"b": 1, "d": 5}, analyze=True)
+    assert plan["operation"] == "filter" and plan["bounds"] == {"d": 5}
+    assert plan["total_rows"] == plan["rows"] == 1
+    assert plan["source"]["rows"] == plan["source"]["driver"]["rows"] == 5
+
+    plan = t.explain({"d": slice(5, 8)}, analyze=True)
+    assert plan["operation"] == "filter" and plan["rows"] == 3
+    assert plan["source"]["operation"] == "scan" and plan["source"]["rows"] == 20
+
+    # analyzing a plan does not change the table's own queries
+    assert list(t.slice({"b": 2}).select(["a"])) == [(2,), (6,), (10,), (14,), (18,)]
+
+
 def test_delete():
     pk = (("a", int),)
     cols = (("b", int), ("c", int))
@@ -275,6 +1011,227 @@ def test_delete():
     assert len(list(t.slice({"b": slice(0, 10)}))) == 0
 
 
+def test_delete_range():
+    pk = (("day", int), ("seq", int))
+    cols = (("kind", str),)
+    t = new_table(pk, cols)
+    t.bulk_insert((day, seq, "k{}".format(seq % 3)) for day in range(10) for seq in range(500))
+    t.add_index("kind", ["kind"], hashed=True)
+    t.add_index("day_kind", ["day", "kind"])
+    kinds = t.add_view("kinds", ["kind"], [("count", None)])
+    t.enable_cache()
+    t.enable_metrics()
+    assert len(list(t.slice({"day": 3}))) == 500
+
+    t.slice({"day": 3}).delete()
+    t.slice({"day": slice(5, 8)}).delete()
+    t.slice({"day": 9, "seq": slice(100, 500)}).delete()
+    days = [0, 1, 2, 4, 8]
+    expected = [
+        (day, seq, "k{}".format(seq % 3)) for day in days + [9]
+        for seq in range(500 if day != 9 else 100)]
+
+    assert len(t) == len(expected) == 2600
+    assert list(t) == expected
+    assert list(t.slice({"day": 3})) == []
+    assert list(t.slice({"kind": "k1"})) == [row for row in expected if row[2] == "k1"]
+    assert list(kinds) == [
+        (kind, sum(1 for row in expected if row[2] == kind)) for kind in ("k0", "k1", "k2")]
+
+    # whole subtrees are dropped, so the primary index has no tombstones
+    stats = t.stats()
+    assert stats["tombstones"] == 0
+    assert stats["counters"]["subtrees_detached"] > 0
+    assert "tombstones_created" not in stats["counters"]
+    assert stats["maintenance"]["auxiliary_deletes"] == 2 * (5000 - 2600)
+
+    # an index which leads with the bounded columns drops the range whole too,
+    # and otherwise loses its rows a batch at a time, as for day 9
+    assert stats["indices"]["day_kind"]["tombstones"] == 400
+    assert stats["indices"]["day_kind"]["counters"]["subtrees_detached"] > 0
+    day_kind = t._auxiliary_indices["day_kind"]
+    assert list(day_kind.slice({"day": 9, "kind": "k1"})) == [
+        (9, "k1", seq) for seq in range(100) if seq % 3 == 1]
+    assert list(day_kind.slice({"day": slice(3, 8)})) == [
+        (4, kind, seq) for kind in ("k0", "k1", "k2") for seq in range(500) if seq % 3 == int(kind[1])]
+
+    t.insert((3, 0, "k0"))
+    t.rebalance()
+    assert list(t.slice({"day": slice(2, 5)})) == (
+        [row for row in expected if row[0] == 2] + [(3, 0, "k0")] +
+        [row for row in expected if row[0] == 4])
+
+
+def test_sample():
+    pk = (("day", int), ("seq", int))
+    cols = (("kind", str),)
+    t = new_table(pk, cols)
+    t.bulk_insert((day, seq, "k{}".format(seq % 4)) for day in range(20) for seq in range(1000))
+    t.add_index("kind", ["kind"])
+    for seq in range(0, 1000, 2):
+        t.slice({"day": 5, "seq": seq}).delete()
+
+    rng = random.Random(0)
+    rows = t.slice({"day": 5}).sample(100, rng)
+    assert len(rows) == len(set(rows)) == 100
+    assert rows == sorted(rows)
+    assert all(day == 5 and seq % 2 for (day, seq, _kind) in rows)
+    assert len(t.slice({"day": 5}).sample(1000, rng)) == 500
+
+    # counts over an index are exact, and no more than a sample is read
+    assert t.approx_count() == (19500, 0)
+    assert t.slice({"day": 5}).approx_count() == (500, 0)
+    assert t.slice({"day": slice(2, 4)}).approx_count() == (2000, 0)
+    assert t.select(["day"]).approx_count() == (19500, 0)
+
+    selection = t.slice({"day": slice(10, 20)}).filter(lambda row: row["seq"] < 100)
+    estimate = selection.approx_count(1000, rng)
+    assert abs(estimate.count - 1000) <= estimate.error < 200
+    rows = selection.sample(50, rng)
+    assert len(rows) == 50 and all(day >= 10 and seq < 100 for (day, seq, _kind) in rows)
+
+    # a whole range filters nothing, so its estimate is exact
+    everything = t.slice({"day": 7}).filter(lambda row: True)
+    assert everything.approx_count(2000, rng) == (1000, 0)
+
+    # the auxiliary index is sampled and joined back to the primary rows
+    selection = t.slice({"kind": "k1"})
+    assert selection.approx_count() == (5000, 0)
+    rows = selection.sample(20, rng)
+    assert len(rows) == 20 and all(kind == "k1" for (_day, _seq, kind) in rows)
+    for row in rows:
+        assert list(t.slice({"day": row[0], "seq": row[1]})) == [row]
+
+
+def test_update_streaming():
+    pk = (("a", int),)
+    cols = (("b", int), ("c", str))
+    t = Table(Index(Schema(pk, cols), hashed=True))
+    t.bulk_insert((i, i % 5, str(i)) for i in range(5000))
+    t.add_index("b", ["b"])
+    counts = t.add_view("counts", ["b"], [("count", None)])
+    t.enable_cache()
+    t.enable_metrics()
+    assert len(list(t.slice({"b": 3}))) == 1000
+
+    # the whole table is rewritten in one walk, not looked up row by row
+    t.update({"c": "x"})
+    stats = t.stats()
+    assert stats["counters"]["nodes_visited"] < 5000
+    assert list(t.slice({"a": 7})) == [(7, 2, "x")]
+    assert list(t.slice({"b": 3}).select(["c"])) == [("x",)] * 1000
+
+    t.slice({"a": slice(1000, 2000)}).update({"b": 9})
+    assert counts[(9,)] == (1000,)
+    assert list(t.slice({"a": 1500})) == [(1500, 9, "x")]
+
+    # updating the key of the index being scanned neither skips nor repeats rows
+    t.slice({"b": 1}).update({"b": 0, "c": "moved"})
+    assert list(t.slice({"b": 1})) == []
+    assert len(list(t.slice({"b": 0}))) == 1600
+    assert sum(1 for row in t if row[2] == "moved") == 800
+    assert list(counts) == [(0, 1600), (2, 800), (3, 800), (4, 800), (9, 1000)]
+
+    # rows are read a bounded batch at a time, whether or not the scan resumes
+    for selection in (t.slice({"b": 3}), t.slice({"b": 3}).limit(700)):
+        batches = list(selection._batches(300))
+        assert [len(batch) for batch in batches][:2] == [300, 300]
+        assert max(len(batch) for batch in batches) == 300
+        assert [row for batch in batches for row in batch] == list(selection)
+
+    t.slice({"b": 2}).limit(10).update({"c": "limited"})
+    assert sum(1 for row in t if row[2] == "limited") == 10
+
+    # a limited scan is read in full first, so rows which an update moves
+    # ahead of it are not read again and do not use up the limit
+    moved = Table(Index(Schema((("k", int),), (("v", int),))))
+    moved.bulk_insert((i, i) for i in range(5000))
+    moved.add_index("byv", ["v"])
+    moved.slice({"v": slice(1, None)}).limit(4000).update({"v": 10 ** 6})
+    assert len(list(moved.slice({"v": 10 ** 6}))) == 4000
+    assert list(moved.slice({"v": slice(4001, None)})) == [
+        (i, i) for i in range(4001, 5000)] + [(i, 10 ** 6) for i in range(1, 4001)]
+
+    t.slice({"b": 0}).filter(lambda row: row["c"] == "moved").delete()
+    assert len(t) == 4200
+    assert len(list(t.slice({"b": 0}))) == 800
+    assert list(t) == [row for row in t.slice({"a": slice(0, 5000)})]
+
+
+def test_dictionary():
+    pk = (("type", str, True), ("seq", int))
+    cols = (("colour", str, True), ("size", int))
+    types = ["edge", "face", "node", "vertex"]
+    colours = ["blue", "green", "red"]
+    rows = [
+        (types[i % 4], i, colours[i % 3], i % 10) for i in random.Random(0).sample(range(2000), 2000)]
+    for options in ({}, {"compact": True}, {"binary_keys": True}, {"hashed": 1}):
+        t = Table(Index(Schema(pk, cols), **options))
+        for row in rows[:1000]:
+            t.insert(row)
+
+        t.bulk_insert(rows[1000:])
+        t.add_index("colour", ["colour"])
+        expected = sorted(rows)
+
+        # the tree holds codes, and rows are decoded as they are read
+        assert all(isinstance(v, int) for v in next(iter(t._source._source)))
+        assert t.schema().key[0].dictionary.values() == types
+        assert list(t) == expected
+        assert list(t.slice({"type": "face", "seq": 5})) == [("face", 5, "red", 5)]
+        assert list(t.slice({"type": "graph"})) == []
+        assert list(t.slice({"type": "face", "seq": slice(None, 20)})) == [
+            row for row in expected if row[0] == "face" and row[1] < 20]
+        assert list(t.slice({"type": slice("f", "o")})) == [
+            row for row in expected if "f" <= row[0] < "o"]
+        assert list(t.slice({"type": slice("face", None)}).reversed()) == [
+            row for row in reversed(expected) if row[0] >= "face"]
+        assert list(t.slice({"colour": "red"})) == sorted(
+            (row for row in rows if row[2] == "red"), key=lambda row: (row[2], row[0], row[1]))
+        assert t.slice({"type": "node"}).approx_count() == (500, 0)
+
+        page, cursor = t.slice({"type": "node"}).page(300)
+        assert page + t.slice({"type": "node"}).page(300, cursor)[0] == [
+            row for row in expected if row[0] == "node"]
+
+        t.slice({"type": "edge"}).update({"colour": "purple"})
+        assert list(t.slice({"colour": "purple"}).select(["seq"])) == [
+            (i,) for i in range(0, 2000, 4)]
+
+        t.slice({"type": "vertex", "seq": slice(0, 1000)}).delete()
+        assert list(t.slice({"type": "vertex"}).select(["seq"])) == [
+            (i,) for i in range(1003, 2000, 4)]
+
+    # a presorted build reads a list twice, and spills a one-shot iterator
+    # for its second pass, rather than holding the rows
+    expected = sorted(rows)
+    for keys in (expected, iter(expected)):
+        index = Index(Schema(pk, cols), keys, presorted=True)
+        assert list(index) == expected
+        assert index.schema().value[0].dictionary.values() == colours
+
+    # values which keep landing between the same two codes use them up, and
+    # then every code is renumbered and the indices which store them rebuilt
+    t = new_table(pk, cols)
+    t.add_index("colour", ["colour"])
+    t.insert(("c", 100, "b", 100))
+    for i in range(100):
+        t.insert(("b" + "m" * i, i, "c" + "m" * (99 - i), i))
+
+    assert t.schema().key[0].dictionary.code("c") == 100 << 32
+    assert [row[1] for row in t] == list(range(101))
+    assert [row[1] for row in t.slice({"colour": slice("c", None)})] == list(reversed(range(100)))
+    assert list(t.slice({"type": "b" + "m" * 50}).select(["seq"])) == [(50,)]
+
+    path = os.path.join(tempfile.mkdtemp(), "table")
+    t.save(path)
+    loaded = Table.load(path)
+    assert loaded.schema() == t.schema()
+    assert loaded.schema().key[0].dictionary is not None
+    assert list(loaded) == list(t)
+    assert list(loaded.slice({"colour": "b"})) == [("c", 100, "b", 100)]
+
+
 if __name__ == "__main__":
     test_select_all()
     test_pk_range()
@@ -283,12 +1240,34 @@ if __name__ == "__main__":
     test_filter()
     test_column_select()
     test_add_index()
+    test_covering_index()
+    test_bulk_insert()
+    test_binary_keys()
+    test_compress_prefix()
+    test_compact()
+    test_schema_functions()
+    test_save_load()
+    test_batch()
+    test_views()
+    test_sort()
+    test_hash_aggregate()
     test_ordering()
     test_slice()
     test_slice_multiple_keys()
     test_chaining()
     test_group_by()
     test_update()
+    test_update_in_place()
+    test_query_cache()
+    test_page()
+    test_hash_index()
+    test_bloom_filter()
+    test_stats()
+    test_explain()
     test_delete()
+    test_delete_range()
+    test_sample()
+    test_update_streaming()
+    test_dictionary()
     print("PASS")
 